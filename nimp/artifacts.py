@@ -21,8 +21,13 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 ''' Provides functions for build artifacts '''
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import copy
 import hashlib
+import io
 import glob
 import json
 import logging
@@ -31,10 +36,17 @@ import platform
 import re
 import shutil
 import stat
+import struct
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
 
 import requests
+import urllib3
 
+import nimp.sys.filesystem
 import nimp.system
 import nimp.utils.git
 
@@ -53,44 +65,434 @@ except ImportError:
     BitTornado = None
 
 
+# Archive members compressed at the same time by create_artifact
+ARCHIVE_THREAD_COUNT = os.cpu_count() or 4
+
+# Files downloaded at the same time from HTTP artifact repositories
+DOWNLOAD_THREAD_COUNT = 8
+
+# Attempts to resume an interrupted HTTP download
+_DOWNLOAD_ATTEMPT_MAXIMUM = 5
+
+# Hash of the files listed in artifact manifests
+MANIFEST_HASH_METHOD = 'sha256'
+
+# Default size of local artifact stores (download-fileset --store-size), in bytes
+ARTIFACT_STORE_SIZE = 20 * 1024 * 1024 * 1024
+
+# Compressed members are kept in memory up to this size, then spilled to
+# disk, and members waiting to be written can't use more memory than the
+# pending size
+_ARCHIVE_SPOOL_SIZE = 16 * 1024 * 1024
+_ARCHIVE_PENDING_SIZE = 256 * 1024 * 1024
+_ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+
+_HTTP_SESSION = None
+_HTTP_POOL_SIZE = 0
+_HTTP_SESSION_LOCK = threading.Lock()
+
+
+def _get_http_session(pool_size = DOWNLOAD_THREAD_COUNT):
+    ''' Returns a session shared by all requests to artifact repositories,
+        so that connections are reused. Its connection pool grows to
+        pool_size connections per host, it should be the number of threads
+        about to use it. '''
+    global _HTTP_SESSION, _HTTP_POOL_SIZE # pylint: disable = global-statement
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            _HTTP_SESSION = requests.Session()
+        if pool_size > _HTTP_POOL_SIZE:
+            _HTTP_POOL_SIZE = pool_size
+            adapter = requests.adapters.HTTPAdapter(pool_connections = DOWNLOAD_THREAD_COUNT, pool_maxsize = pool_size)
+            _HTTP_SESSION.mount('http://', adapter)
+            _HTTP_SESSION.mount('https://', adapter)
+        return _HTTP_SESSION
+
+
+class _HttpStream():
+    ''' Content of an HTTP resource, read sequentially. Reads failing because
+        of the connection are resumed with a range request. '''
+
+    def __init__(self, uri):
+        self._uri = uri
+        self._offset = 0
+        self._response = None
+        self._attempt = 0
+        self._open()
+
+    def read(self, size):
+        while True:
+            try:
+                data = self._response.raw.read(size)
+                self._offset += len(data)
+                return data
+            except (OSError, requests.RequestException, urllib3.exceptions.HTTPError) as exception:
+                self._attempt += 1
+                if self._attempt >= _DOWNLOAD_ATTEMPT_MAXIMUM:
+                    raise
+                logging.warning('Download of %s interrupted at %s bytes (%s), resuming', self._uri, self._offset, exception)
+                self._response.close()
+                self._open()
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _open(self):
+        # Offsets of range requests must not be the ones of encoded content
+        headers = { 'Accept-Encoding': 'identity' }
+        if self._offset > 0:
+            headers['Range'] = 'bytes=%d-' % self._offset
+        self._response = _get_http_session().get(self._uri, stream = True, headers = headers)
+        self._response.raise_for_status()
+        if self._offset > 0 and self._response.status_code != 206:
+            self._response.close()
+            raise OSError('Server does not support resuming downloads of %s' % self._uri)
+
+
+class _HashingStream():
+    ''' Hashes data while it is read from another stream '''
+
+    def __init__(self, stream, hash_method):
+        self._stream = stream
+        self._hash = getattr(hashlib, hash_method)() if hash_method is not None else None
+
+    def read(self, size):
+        data = self._stream.read(size)
+        if self._hash is not None:
+            self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest() if self._hash is not None else None
+
+
+def _open_uri(uri):
+    return _HttpStream(uri) if _is_http_url(uri) else open(uri, 'rb')
+
+
+def _load_artifact_hash(artifact_uri):
+    ''' Returns the hash method and value written by create_hash next to an
+        artifact, or (None, None) if there is none '''
+    try:
+        if _is_http_url(artifact_uri):
+            hash_request = _get_http_session().get(artifact_uri + '.hash')
+            if hash_request.status_code == 404:
+                return None, None
+            hash_request.raise_for_status()
+            artifact_hash = hash_request.json()
+        else:
+            if not os.path.isfile(artifact_uri + '.hash'):
+                return None, None
+            with open(artifact_uri + '.hash') as hash_file:
+                artifact_hash = json.load(hash_file)
+    except ValueError as exception:
+        logging.warning('Invalid hash file for %s: %s', artifact_uri, exception)
+        return None, None
+    for hash_method, hash_value in artifact_hash.items():
+        if hash_method in hashlib.algorithms_available:
+            return hash_method, hash_value
+    return None, None
+
+
 def _is_http_url(string):
     return re.match(r'^http[s]?:\/\/.*$', string) is not None
 
-def list_artifacts(artifact_pattern: str, format_arguments, api_context):
-    ''' List all artifacts and their revision using the provided pattern after formatting '''
+def list_artifacts(artifact_pattern: str, format_arguments, api_context, use_index = True):
+    ''' List all artifacts and their revision using the provided pattern after formatting.
+        The collection index is used when there is one, instead of listing the collection,
+        unless use_index is False. Artifacts listed from the index have a name. '''
+
+    artifact_pattern = _format_artifact_pattern(artifact_pattern, format_arguments)
+    artifact_source = _get_artifact_source(artifact_pattern)
+
+    artifact_index = load_artifact_index(artifact_pattern) if use_index else None
+    if artifact_index is not None:
+        logging.debug('Using artifact index for %s', artifact_pattern)
+        # Revisions unknown to Gitea when indexed may have been pushed since
+        unresolved_revisions = [ entry['revision'] for entry in artifact_index if entry['sortable_revision'] is None ]
+        all_timestamps = {}
+        if api_context and unresolved_revisions:
+            all_timestamps = nimp.utils.git.get_gitea_commit_timestamps(api_context, unresolved_revisions)
+        all_artifacts = []
+        for entry in artifact_index:
+            sortable_revision = entry['sortable_revision']
+            if sortable_revision is None:
+                sortable_revision = all_timestamps.get(entry['revision'])
+            if sortable_revision is not None:
+                all_artifacts.append(dict(entry, sortable_revision = sortable_revision, uri = artifact_source + entry['name']))
+        return all_artifacts
+
+    return _list_artifacts_from_source(artifact_pattern, artifact_source, api_context)
+
 
+def artifact_exists(artifact_uri):
+    ''' Checks that an artifact listed by list_artifacts is still there, since
+        indexes of HTTP collections can't be checked for staleness '''
+    if _is_http_url(artifact_uri):
+        head_response = _get_http_session().head(artifact_uri, allow_redirects = True)
+        return head_response.status_code != 404
+    return os.path.exists(nimp.system.sanitize_path(artifact_uri))
+
+
+def _format_artifact_pattern(artifact_pattern, format_arguments):
     format_arguments = copy.deepcopy(format_arguments)
     format_arguments['revision'] = '{revision}'
-    artifact_pattern = artifact_pattern.format(**format_arguments)
+    return artifact_pattern.format(**format_arguments)
+
 
+def _get_artifact_source(artifact_pattern):
     if not _is_http_url(artifact_pattern):
-        artifact_source = nimp.system.sanitize_path(os.path.dirname(artifact_pattern))
-    else:
-        artifact_source = artifact_pattern.rsplit('/', 1)[0] + '/'
+        return nimp.system.sanitize_path(os.path.dirname(artifact_pattern)).rstrip('/') + '/'
+    return artifact_pattern.rsplit('/', 1)[0] + '/'
+
 
+def _list_artifacts_from_source(artifact_pattern, artifact_source, api_context):
     artifact_escaped_name = re.escape(os.path.basename(artifact_pattern)).replace(r'\{revision\}', '{revision}')
     artifact_regex = re.compile(r'^' + artifact_escaped_name.format(revision = r'(?P<revision>[a-zA-Z0-9]+)') + r'(.zip)?$')
 
     all_files = _list_files(artifact_source, False)
-    all_artifacts = []
+    all_matches = []
     for file_uri in all_files:
         file_name = os.path.basename(file_uri.rstrip('/'))
         artifact_match = artifact_regex.match(file_name)
         if artifact_match:
-            group_revision = artifact_match.group('revision')
-            sortable_revision = copy.deepcopy(group_revision)
-            if api_context:
-                sortable_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, group_revision)
-            if sortable_revision is not None:
-                artifact = {
-                    'revision': group_revision,
-                    'sortable_revision': sortable_revision,
-                    'uri': file_uri,
-                }
-                all_artifacts.append(artifact)
+            all_matches.append((file_uri, artifact_match.group('revision')))
+
+    all_timestamps = None
+    if api_context:
+        all_timestamps = nimp.utils.git.get_gitea_commit_timestamps(api_context, [ revision for _, revision in all_matches ])
+
+    all_artifacts = []
+    for file_uri, group_revision in all_matches:
+        sortable_revision = copy.deepcopy(group_revision)
+        if all_timestamps is not None:
+            sortable_revision = all_timestamps[group_revision]
+        if sortable_revision is not None:
+            artifact = {
+                'revision': group_revision,
+                'sortable_revision': sortable_revision,
+                'uri': file_uri,
+            }
+            all_artifacts.append(artifact)
     return all_artifacts
 
 
+def _get_sortable_key(artifact):
+    # Revisions not found on Gitea when indexed come first
+    if artifact['sortable_revision'] is None:
+        return (False, 0)
+    return (True, int(artifact['sortable_revision'], 16))
+
+
+def get_artifact_index_path(artifact_pattern):
+    ''' Returns the path of the index of the collection an artifact pattern,
+        formatted except for its revision, belongs to '''
+    return artifact_pattern.replace('{revision}', '@index') + '.jsonl'
+
+
+def load_artifact_index(artifact_pattern):
+    ''' Loads the index of a collection, as a list of artifacts sorted by
+        revision, or returns None if the collection is not indexed, or if
+        the index of a local collection is stale: artifacts were added or
+        removed by other means (retention cleanup, manual copies, uploads
+        without revision) after it was last updated. '''
+    index_path = get_artifact_index_path(artifact_pattern)
+    artifact_index = _read_artifact_index(index_path)
+    if artifact_index is None:
+        return None
+    all_entries, generation = artifact_index
+    if not _is_http_url(index_path) and _is_artifact_index_stale(nimp.system.sanitize_path(index_path), generation):
+        logging.debug('Ignoring stale artifact index %s', index_path)
+        return None
+    return all_entries
+
+
+def _read_artifact_index(index_path):
+    ''' Returns the entries of an index and its last generation. Lines are
+        either entries, sorted by revision, or generations, appended after
+        each update. An entry added again is only kept at its last position,
+        which is still sorted since it was appended. '''
+    if _is_http_url(index_path):
+        index_response = _get_http_session().get(index_path)
+        if index_response.status_code == 404:
+            return None
+        index_response.raise_for_status()
+        index_content = index_response.text
+    else:
+        index_path = nimp.system.sanitize_path(index_path)
+        if not os.path.isfile(index_path):
+            return None
+        with open(index_path, 'r') as index_file:
+            index_content = index_file.read()
+
+    all_entries = {}
+    generation = None
+    for line in index_content.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if 'generation' in record:
+            generation = record
+        else:
+            all_entries.pop(record['name'], None)
+            all_entries[record['name']] = record
+    return list(all_entries.values()), generation
+
+
+def update_artifact_index(artifact_pattern, format_arguments, revision, api_context, dry_run):
+    ''' Adds an uploaded artifact to the index of its collection. A missing index
+        is first filled with the artifacts already in the collection. '''
+
+    artifact_pattern = _format_artifact_pattern(artifact_pattern, format_arguments)
+    if '{revision}' not in artifact_pattern or _is_http_url(artifact_pattern):
+        return
+
+    artifact_source = _get_artifact_source(artifact_pattern)
+    artifact_path = nimp.system.sanitize_path(artifact_pattern.replace('{revision}', revision))
+    artifact_full_path = _find_artifact(artifact_path)
+    if artifact_full_path is None and not dry_run:
+        raise FileNotFoundError(f'Artifact not found: {artifact_path}')
+
+    sortable_revision = revision
+    if api_context:
+        sortable_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, revision)
+        if sortable_revision is None:
+            logging.warning('Revision %s not found on Gitea, it will be resolved again when listing %s', revision, artifact_path)
+
+    artifact_name = os.path.basename(artifact_path)
+    artifact_size = None
+    artifact_hash = None
+    if artifact_full_path is not None:
+        if os.path.isfile(artifact_full_path):
+            artifact_name += '.zip'
+            artifact_size = os.path.getsize(artifact_full_path)
+            hash_method, hash_value = _load_artifact_hash(artifact_full_path)
+            if hash_method is not None:
+                artifact_hash = { hash_method: hash_value }
+        else:
+            artifact_name += '/'
+            artifact_size = sum(os.path.getsize(os.path.join(artifact_full_path, relative_path))
+                                for relative_path, entry in nimp.sys.filesystem.walk(artifact_full_path) if not entry.is_dir)
+
+    artifact_entry = {
+        'name': artifact_name,
+        'revision': revision,
+        'sortable_revision': sortable_revision,
+        'size': artifact_size,
+        'hash': artifact_hash,
+    }
+
+    index_path = nimp.system.sanitize_path(get_artifact_index_path(artifact_pattern))
+    logging.info('Adding %s to %s', artifact_name, index_path)
+    if dry_run:
+        return
+
+    with _lock_artifact_index(index_path):
+        artifact_index = _read_artifact_index(index_path)
+        all_entries, generation = artifact_index if artifact_index is not None else ([], None)
+        is_stale = artifact_index is None or _is_artifact_index_stale(index_path, generation)
+        if is_stale and artifact_index is not None:
+            # Uploading the artifact modified the collection, which only needs
+            # to be listed again, without resolving revisions, to check that
+            all_names = { artifact['uri'][len(artifact_source):] for artifact in _list_artifacts_from_source(artifact_pattern, artifact_source, None) }
+            is_stale = all_names != { entry['name'] for entry in all_entries } | { artifact_name }
+        if is_stale:
+            # Rebuild missing or stale indexes, keeping what is known of
+            # artifacts still there
+            previous_entries = { entry['name']: entry for entry in all_entries }
+            all_entries = [ _get_index_entry(artifact, artifact_source, previous_entries)
+                            for artifact in _list_artifacts_from_source(artifact_pattern, artifact_source, api_context) ]
+            all_entries.sort(key = _get_sortable_key)
+            _insert_artifact_index_entry(all_entries, artifact_entry)
+            _write_artifact_index(index_path, all_entries)
+        elif not all_entries or _get_sortable_key(artifact_entry) >= _get_sortable_key(all_entries[-1]):
+            # Artifacts are mostly uploaded in revision order
+            with open(index_path, 'a') as index_file:
+                index_file.write(json.dumps(artifact_entry) + '\n')
+        else:
+            _insert_artifact_index_entry(all_entries, artifact_entry)
+            _write_artifact_index(index_path, all_entries)
+
+        # Appending to the index does not modify the collection directory,
+        # unlike the uploaded artifact or a rewritten index
+        generation = {
+            'generation': (generation or {}).get('generation', 0) + 1,
+            'collection_mtime': os.stat(os.path.dirname(index_path) or '.').st_mtime_ns,
+        }
+        with open(index_path, 'a') as index_file:
+            index_file.write(json.dumps(generation) + '\n')
+
+
+def _insert_artifact_index_entry(all_entries, artifact_entry):
+    all_entries[:] = [ entry for entry in all_entries if entry['name'] != artifact_entry['name'] ]
+    all_keys = [ _get_sortable_key(entry) for entry in all_entries ]
+    all_entries.insert(bisect.bisect_right(all_keys, _get_sortable_key(artifact_entry)), artifact_entry)
+
+
+def _write_artifact_index(index_path, all_entries):
+    with open(index_path + '.tmp', 'w') as index_file:
+        for entry in all_entries:
+            index_file.write(json.dumps(entry) + '\n')
+    os.replace(index_path + '.tmp', index_path)
+
+
+def _is_artifact_index_stale(index_path, generation):
+    ''' Adding or removing an artifact changes the modification time of its
+        collection directory, each generation of the index records the one it
+        last saw. Indexes without generation were written by older versions. '''
+    if generation is None:
+        return True
+    try:
+        return os.stat(os.path.dirname(index_path) or '.').st_mtime_ns != generation['collection_mtime']
+    except OSError:
+        return False
+
+
+def _get_index_entry(artifact, artifact_source, previous_entries):
+    name = artifact['uri'][len(artifact_source):]
+    previous_entry = previous_entries.get(name, {})
+    return {
+        'name': name,
+        'revision': artifact['revision'],
+        'sortable_revision': artifact['sortable_revision'],
+        'size': previous_entry.get('size'),
+        'hash': previous_entry.get('hash'),
+    }
+
+
+@contextlib.contextmanager
+def _lock_artifact_index(index_path, stale_delay = 600):
+    ''' Prevents concurrent uploads from losing each other's index entries.
+        Locks are kept out of the collection directory, so that they don't
+        modify it. '''
+    lock_directory = os.path.join(os.path.dirname(index_path), '.locks')
+    lock_path = os.path.join(lock_directory, os.path.basename(index_path) + '.lock')
+    os.makedirs(lock_directory, exist_ok = True)
+
+    def _acquire():
+        try:
+            return os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if time.time() - os.path.getmtime(lock_path) > stale_delay:
+                logging.warning('Removing stale lock %s', lock_path)
+                os.remove(lock_path)
+            raise
+
+    lock_descriptor = nimp.system.try_execute(_acquire, FileExistsError, attempt_maximum = 30, retry_delay = 2)
+    try:
+        yield
+    finally:
+        os.close(lock_descriptor)
+        os.remove(lock_path)
+
+
 def _list_files(source: str, recursive):
     all_files = []
 
@@ -98,7 +500,7 @@ def _list_files(source: str, recursive):
         if not source.endswith('/'):
             source += '/'
 
-        source_request = requests.get(source)
+        source_request = _get_http_session().get(source)
         source_request.raise_for_status()
         file_regex = re.compile(r'<a href="(?P<file_name>[^"/\\\?]+/?)">')
 
@@ -112,16 +514,15 @@ def _list_files(source: str, recursive):
 
     else:
         source = source.rstrip('/')
-        # scandir is way faster than listdir, especially via vpn
-        # and is available in std os lib since python v3.5+
-        for file_name in os.scandir(source):
-            file_path = source + '/' + file_name.name
-            if file_name.is_dir():
-                all_files.append(file_path + '/')
-                if recursive:
-                    all_files.extend(_list_files(file_path, True))
-            else:
-                all_files.append(file_path)
+        # Network shares are walked by several threads, since listing is
+        # mostly waiting for the server, especially via vpn
+        if recursive:
+            all_entries = nimp.sys.filesystem.walk(source)
+        else:
+            all_entries = ((entry.name, entry) for entry in nimp.sys.filesystem.list_dir(source))
+        for relative_path, entry in all_entries:
+            file_path = source + '/' + relative_path.replace(os.sep, '/')
+            all_files.append(file_path + '/' if entry.is_dir else file_path)
 
 
     return all_files
@@ -150,25 +551,31 @@ def download_artifact(workspace_directory, artifact_uri):
     else:
         artifact_uri = artifact_uri.rstrip('/') + '/'
         all_files = [ uri for uri in _list_files(artifact_uri, True) if not uri.endswith('/') ]
-        for file_uri in all_files:
-            file_path = file_uri[ len(artifact_uri) : ]
-            _download_file(file_uri, os.path.join(local_artifact_path, file_path))
+        _download_files([ (file_uri, os.path.join(local_artifact_path, file_uri[ len(artifact_uri) : ])) for file_uri in all_files ])
 
     return local_artifact_path
 
 
+def _download_files(file_collection, thread_count = DOWNLOAD_THREAD_COUNT):
+    ''' Downloads (uri, path) pairs with a pool of threads '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers = thread_count) as executor:
+        for _ in executor.map(lambda it: _download_file(*it), file_collection):
+            pass
+
+
 def _download_file(file_uri, output_path):
     if os.path.exists(output_path):
         os.remove(output_path)
     output_directory = os.path.dirname(output_path)
-    if not os.path.isdir(output_directory):
-        os.makedirs(output_directory)
-
-    if file_uri.startswith('http://') or file_uri.startswith('https://'):
-        file_request = requests.get(file_uri, stream = True)
-        file_request.raise_for_status()
-        with open(output_path, 'wb') as output_file:
-            shutil.copyfileobj(file_request.raw, output_file)
+    os.makedirs(output_directory, exist_ok = True)
+
+    if _is_http_url(file_uri):
+        hash_method, hash_value = _load_artifact_hash(file_uri) if file_uri.endswith('.zip') else (None, None)
+        with _HttpStream(file_uri) as file_stream, open(output_path, 'wb') as output_file:
+            hashing_stream = _HashingStream(file_stream, hash_method)
+            shutil.copyfileobj(hashing_stream, output_file, _ARCHIVE_CHUNK_SIZE)
+        if hash_value is not None and hashing_stream.hexdigest() != hash_value:
+            raise OSError('Downloaded file %s does not match its %s hash' % (file_uri, hash_method))
     else:
         shutil.copyfile(file_uri, output_path)
 
@@ -200,7 +607,7 @@ def install_artifact(artifact_path, destination_directory):
     if platform.system() != 'Windows' and magic is None:
         logging.warning('python-magic is not available, executable permissions will not be set')
 
-    all_files = [ file_path for file_path in _list_files(artifact_path, True) if os.path.isfile(file_path) ]
+    all_files = [ file_path for file_path in _list_files(artifact_path, True) if not file_path.endswith('/') ]
     for source in all_files:
         destination = os.path.join(destination_directory, source[ len(artifact_path) + 1 : ])
         logging.debug('Installing %s to %s', source, destination)
@@ -212,6 +619,479 @@ def install_artifact(artifact_path, destination_directory):
         _try_make_executable(destination)
 
 
+def install_artifact_from_uri(workspace_directory, artifact_uri, destination_directory, thread_count = DOWNLOAD_THREAD_COUNT,
+                              store = None, use_links = False):
+    ''' Installs an artifact in the workspace while downloading it. Archive
+        members, including the ones of nested archives, are extracted
+        directly to their destination, so that each file is written once.
+        Archives are checked against the hash written by create_hash.
+        If a store is given and the artifact has a manifest, only the files
+        missing from the store are downloaded. '''
+
+    # Keep a pooled connection for each download thread
+    _get_http_session(thread_count)
+
+    if store is not None:
+        manifest = _load_artifact_manifest(artifact_uri)
+        if manifest is not None:
+            try:
+                _install_artifact_from_store(artifact_uri, manifest, destination_directory, store, use_links, thread_count)
+                return
+            except _UnsupportedArchiveError as exception:
+                logging.warning('Artifact can not be installed from the store (%s), downloading it', exception)
+
+    if not artifact_uri.endswith('.zip'):
+        artifact_uri = artifact_uri.rstrip('/') + '/'
+        all_files = [ uri for uri in _list_files(artifact_uri, True) if not uri.endswith('/') ]
+        all_destinations = [ os.path.join(destination_directory, uri[ len(artifact_uri) : ]) for uri in all_files ]
+        if _is_http_url(artifact_uri):
+            _download_files(zip(all_files, all_destinations), thread_count)
+        else:
+            nimp.system.copy_files(zip(all_files, all_destinations))
+        if platform.system() != 'Windows' and magic is None:
+            logging.warning('python-magic is not available, executable permissions will not be set')
+        for destination in all_destinations:
+            _try_make_executable(destination)
+        return
+
+    try:
+        hash_method, hash_value = _load_artifact_hash(artifact_uri)
+        # Local archives are cheap to seek, unlike downloaded ones which are
+        # only known to be made of archives once completely read
+        is_archive_package = None if _is_http_url(artifact_uri) else _is_archive_package(artifact_uri)
+        with _open_uri(artifact_uri) as artifact_stream:
+            hashing_stream = _HashingStream(artifact_stream, hash_method)
+            _extract_zip_stream(_ZipStream(hashing_stream), destination_directory, is_archive_package)
+        # Files are already installed, but they will be installed again by
+        # the next attempt
+        if hash_value is not None and hashing_stream.hexdigest() != hash_value:
+            raise OSError('Artifact %s does not match its %s hash' % (artifact_uri, hash_method))
+    except _UnsupportedArchiveError as exception:
+        logging.warning('Archive can not be streamed (%s), downloading it first', exception)
+        local_artifact_path = download_artifact(workspace_directory, artifact_uri)
+        install_artifact(local_artifact_path, destination_directory)
+        shutil.rmtree(local_artifact_path)
+
+
+class _UnsupportedArchiveError(Exception):
+    pass
+
+
+def _is_archive_package(archive_path):
+    ''' Checks from the central directory whether an archive is only made of
+        archives, which are extracted as well '''
+    with zipfile.ZipFile(archive_path) as archive:
+        all_names = archive.namelist()
+    return len(all_names) > 0 and all(name.endswith('.zip') for name in all_names)
+
+
+class ArtifactStore():
+    ''' Content addressed store of the files of downloaded artifacts. The
+        least recently used files are removed beyond a size budget. '''
+
+    def __init__(self, store_directory, size_budget = ARTIFACT_STORE_SIZE):
+        self.store_directory = store_directory
+        self.size_budget = size_budget
+        self._used_paths = set()
+        self._lock = threading.Lock()
+
+    def get_path(self, file_hash):
+        return os.path.join(self.store_directory, file_hash[:2], file_hash)
+
+    def contains(self, file_hash, size):
+        try:
+            return os.stat(self.get_path(file_hash)).st_size == size
+        except OSError:
+            return False
+
+    def add(self, file_hash, hash_method, source_stream):
+        ''' Stores a file read from a stream, checking its hash '''
+        store_path = self.get_path(file_hash)
+        os.makedirs(os.path.dirname(store_path), exist_ok = True)
+        temporary_path = '%s.%d.%d.tmp' % (store_path, os.getpid(), threading.get_ident())
+        try:
+            hashing_stream = _HashingStream(source_stream, hash_method)
+            with open(temporary_path, 'wb') as store_file:
+                shutil.copyfileobj(hashing_stream, store_file, _ARCHIVE_CHUNK_SIZE)
+            if hashing_stream.hexdigest() != file_hash:
+                raise OSError('Downloaded file does not match its %s hash %s' % (hash_method, file_hash))
+            os.replace(temporary_path, store_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def install(self, file_hash, destination, use_links):
+        ''' Installs a stored file by copying it, or by linking it if possible.
+            Linked files must not be modified in place. '''
+        store_path = self.get_path(file_hash)
+        # Access times are shared by links, unlike modification times which
+        # would also change the installed file
+        os.utime(store_path, (time.time(), os.stat(store_path).st_mtime))
+        with self._lock:
+            self._used_paths.add(store_path)
+
+        logging.debug('Installing %s to %s', file_hash, destination)
+        os.makedirs(os.path.dirname(destination), exist_ok = True)
+        if os.path.lexists(destination):
+            os.remove(destination)
+        if use_links:
+            try:
+                os.link(store_path, destination)
+                return
+            except OSError as exception:
+                logging.debug('Failed to link %s (%s), copying it', destination, exception)
+        shutil.copyfile(store_path, destination)
+
+    def evict(self):
+        ''' Removes the least recently used files until the store fits in its
+            budget, keeping the ones installed by this run '''
+        if not os.path.isdir(self.store_directory):
+            return
+        all_files = []
+        for relative_path, entry in nimp.sys.filesystem.walk(self.store_directory, nimp.sys.filesystem.DirectorySnapshot()):
+            file_path = os.path.join(self.store_directory, relative_path)
+            if entry.is_dir or file_path in self._used_paths:
+                continue
+            file_stat = os.stat(file_path)
+            # Files being stored by concurrent runs are left alone
+            if file_path.endswith('.tmp') and time.time() - file_stat.st_mtime < 24 * 3600:
+                continue
+            all_files.append((file_stat.st_atime, file_stat.st_size, file_path))
+
+        store_size = sum(size for _, size, _ in all_files)
+        store_size += sum(os.path.getsize(file_path) for file_path in self._used_paths if os.path.exists(file_path))
+        for _, size, file_path in sorted(all_files):
+            if store_size <= self.size_budget:
+                break
+            logging.debug('Removing %s from the artifact store', file_path)
+            try:
+                os.remove(file_path)
+                store_size -= size
+            except OSError as exception:
+                logging.warning('Failed to remove %s from the artifact store: %s', file_path, exception)
+
+
+def _load_artifact_manifest(artifact_uri):
+    manifest_uri = artifact_uri.rstrip('/') + '.manifest.json'
+    try:
+        if _is_http_url(manifest_uri):
+            manifest_response = _get_http_session().get(manifest_uri)
+            if manifest_response.status_code == 404:
+                return None
+            manifest_response.raise_for_status()
+            return manifest_response.json()
+        if not os.path.isfile(manifest_uri):
+            return None
+        with open(manifest_uri) as manifest_file:
+            return json.load(manifest_file)
+    except ValueError as exception:
+        logging.warning('Invalid manifest for %s: %s', artifact_uri, exception)
+        return None
+
+
+def _install_artifact_from_store(artifact_uri, manifest, destination_directory, store, use_links, thread_count):
+    hash_method = manifest['hash_method']
+    all_entries = manifest['files']
+    if hash_method not in hashlib.algorithms_available:
+        raise _UnsupportedArchiveError('Unknown hash method %s' % hash_method)
+    if artifact_uri.endswith('.zip') and all(entry['name'].endswith('.zip') for entry in all_entries):
+        raise _UnsupportedArchiveError('Archive of archives')
+
+    missing_entries = {}
+    for entry in all_entries:
+        if entry['hash'] not in missing_entries and not store.contains(entry['hash'], entry['size']):
+            missing_entries[entry['hash']] = entry
+    missing_entries = list(missing_entries.values())
+    logging.info('Downloading %d of %d files, %d bytes', len(missing_entries), len(all_entries),
+                 sum(entry['size'] for entry in missing_entries))
+
+    if artifact_uri.endswith('.zip'):
+        if missing_entries:
+            with _open_seekable_uri(artifact_uri) as artifact_file, zipfile.ZipFile(artifact_file) as archive_file:
+                # Read members in archive order, so that reads are sequential
+                missing_entries.sort(key = lambda entry: archive_file.getinfo(entry['name']).header_offset)
+                for entry in missing_entries:
+                    with archive_file.open(entry['name']) as member_file:
+                        store.add(entry['hash'], hash_method, member_file)
+    else:
+        artifact_uri = artifact_uri.rstrip('/') + '/'
+        with concurrent.futures.ThreadPoolExecutor(max_workers = thread_count) as executor:
+            def _add(entry):
+                with _open_uri(artifact_uri + entry['name']) as file_stream:
+                    store.add(entry['hash'], hash_method, file_stream)
+            for _ in executor.map(_add, missing_entries):
+                pass
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = thread_count) as executor:
+        def _install(entry):
+            destination = _get_member_destination(destination_directory, entry['name'])
+            store.install(entry['hash'], destination, use_links)
+            if entry['executable'] and platform.system() != 'Windows':
+                os.chmod(destination, os.stat(destination).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        for _ in executor.map(_install, all_entries):
+            pass
+
+    store.evict()
+
+
+def _open_seekable_uri(uri):
+    if not _is_http_url(uri):
+        return open(uri, 'rb')
+    return io.BufferedReader(_HttpRangeFile(uri), _ARCHIVE_CHUNK_SIZE)
+
+
+class _HttpRangeFile(io.RawIOBase):
+    ''' HTTP resource which can be read at any position, with range requests '''
+
+    def __init__(self, uri):
+        super().__init__()
+        self._uri = uri
+        self._position = 0
+        head_response = _get_http_session().head(uri)
+        head_response.raise_for_status()
+        if head_response.headers.get('Accept-Ranges') != 'bytes':
+            raise _UnsupportedArchiveError('Range requests are not supported')
+        self._size = int(head_response.headers['Content-Length'])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self._size or len(buffer) == 0:
+            return 0
+        end = min(self._position + len(buffer), self._size) - 1
+        headers = { 'Range': 'bytes=%d-%d' % (self._position, end), 'Accept-Encoding': 'identity' }
+        range_response = nimp.system.try_execute(lambda: _get_http_session().get(self._uri, headers = headers),
+                                                 requests.exceptions.ConnectionError, attempt_maximum = _DOWNLOAD_ATTEMPT_MAXIMUM, retry_delay = 1)
+        range_response.raise_for_status()
+        if range_response.status_code != 206:
+            raise _UnsupportedArchiveError('Range requests are not supported')
+        data = range_response.content[ : len(buffer) ]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+class _ZipStream():
+    ''' Sequential reader of a zip archive, which can't seek but can give
+        back data read too far '''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = b''
+        self._offset = 0
+
+    def read(self, size):
+        if self._offset >= len(self._buffer):
+            # Member streams may return more data than asked
+            self._buffer = self._stream.read(size)
+            self._offset = 0
+        data = self._buffer[self._offset : self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise zipfile.BadZipFile('Unexpected end of archive')
+            data += chunk
+        return data
+
+    def unread(self, data):
+        self._buffer = data + self._buffer[self._offset:]
+        self._offset = 0
+
+
+class _ZipMemberStream():
+    ''' Decompressed content of an archive member, its CRC is checked once it
+        was completely read '''
+
+    def __init__(self, archive_stream, name, flag_bits, compress_type, crc, compress_size, file_size, is_zip64):
+        if compress_type not in [ zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED ]:
+            raise _UnsupportedArchiveError('%s uses compression %s' % (name, compress_type))
+        if flag_bits & 0x08 and compress_type == zipfile.ZIP_STORED:
+            raise _UnsupportedArchiveError('%s size is unknown' % name)
+        self._archive_stream = archive_stream
+        self._name = name
+        self._has_data_descriptor = flag_bits & 0x08
+        self._is_zip64 = is_zip64
+        self._decompressor = zlib.decompressobj(-15) if compress_type == zipfile.ZIP_DEFLATED else None
+        self._expected = (crc, file_size)
+        self._remaining_size = compress_size
+        self._crc = 0
+        self._size = 0
+        self._is_complete = False
+
+    def read(self, size = _ARCHIVE_CHUNK_SIZE):
+        data = b''
+        while not data and not self._is_complete:
+            data = self._read_chunk(size)
+            self._crc = zlib.crc32(data, self._crc)
+            self._size += len(data)
+            if self._is_complete:
+                self._check()
+        return data
+
+    def drain(self):
+        ''' Reads the rest of this member '''
+        while self.read():
+            pass
+
+    def _read_chunk(self, size):
+        if self._decompressor is None:
+            data = self._archive_stream.read(min(size, self._remaining_size))
+            if not data and self._remaining_size > 0:
+                raise zipfile.BadZipFile('Unexpected end of archive')
+            self._remaining_size -= len(data)
+            self._is_complete = self._remaining_size == 0
+            return data
+
+        if self._decompressor.eof:
+            self._is_complete = True
+            return b''
+        read_size = size if self._has_data_descriptor else min(size, self._remaining_size)
+        compressed_data = self._archive_stream.read(read_size) if read_size > 0 else b''
+        if not compressed_data:
+            raise zipfile.BadZipFile('Unexpected end of archive')
+        self._remaining_size -= len(compressed_data)
+        data = self._decompressor.decompress(compressed_data)
+        if self._decompressor.eof:
+            self._archive_stream.unread(self._decompressor.unused_data)
+            self._is_complete = True
+        return data
+
+    def _check(self):
+        if self._has_data_descriptor:
+            # Sizes and CRC follow the data, with an optional signature
+            descriptor = self._archive_stream.read_exact(4)
+            if descriptor == b'PK\x07\x08':
+                descriptor = self._archive_stream.read_exact(4)
+            sizes = self._archive_stream.read_exact(16 if self._is_zip64 else 8)
+            file_size = struct.unpack('<2Q' if self._is_zip64 else '<2L', sizes)[1]
+            self._expected = (struct.unpack('<L', descriptor)[0], file_size)
+        if (self._crc, self._size) != self._expected:
+            raise zipfile.BadZipFile('Bad CRC-32 for file %s' % self._name)
+
+
+def _extract_zip_stream(archive_stream, destination_directory, is_archive_package):
+    ''' Extracts members of a zip archive read sequentially. Members of
+        archives only made of archives are extracted as well. If that is not
+        known yet (None), archives are installed as files, and extracted once
+        the archive was completely read without finding any other member.
+        Modes are stored in the central directory, at the end of the archive,
+        they are applied once all members were extracted. '''
+    all_files = {}
+    pending_archives = []
+    while True:
+        signature = archive_stream.read_exact(4)
+        if signature != b'PK\x03\x04':
+            archive_stream.unread(signature)
+            break
+        header = struct.unpack(zipfile.structFileHeader, signature + archive_stream.read_exact(zipfile.sizeFileHeader - 4))
+        _, _, _, flag_bits, compress_type, _, _, crc, compress_size, file_size, name_length, extra_length = header
+        if flag_bits & 0x01:
+            raise _UnsupportedArchiveError('Encrypted archive')
+        name = archive_stream.read_exact(name_length).decode('utf-8' if flag_bits & 0x800 else 'cp437')
+        compress_size, file_size, is_zip64 = _get_zip64_sizes(archive_stream.read_exact(extra_length), compress_size, file_size)
+        member_stream = _ZipMemberStream(archive_stream, name, flag_bits, compress_type, crc, compress_size, file_size, is_zip64)
+
+        destination = _get_member_destination(destination_directory, name)
+        if is_archive_package is None and not name.endswith('.zip'):
+            is_archive_package = False
+        if is_archive_package:
+            logging.debug('Extracting %s to %s', name, destination_directory)
+            _extract_zip_stream(_ZipStream(member_stream), destination_directory, False)
+            member_stream.drain()
+        elif name.endswith('/'):
+            os.makedirs(destination, exist_ok = True)
+            member_stream.drain()
+        else:
+            logging.debug('Installing %s to %s', name, destination)
+            os.makedirs(os.path.dirname(destination), exist_ok = True)
+            if os.path.lexists(destination):
+                os.remove(destination)
+            with open(destination, 'wb') as destination_file:
+                for chunk in iter(member_stream.read, b''):
+                    destination_file.write(chunk)
+            all_files[name] = destination
+            if is_archive_package is None:
+                pending_archives.append(destination)
+
+    _read_zip_central_directory(archive_stream, all_files)
+
+    if is_archive_package is None:
+        for archive_path in pending_archives:
+            logging.debug('Extracting %s to %s', archive_path, destination_directory)
+            with open(archive_path, 'rb') as archive_file:
+                _extract_zip_stream(_ZipStream(archive_file), destination_directory, False)
+            os.remove(archive_path)
+
+
+def _get_zip64_sizes(extra, compress_size, file_size):
+    is_zip64 = False
+    while len(extra) >= 4:
+        extra_id, extra_size = struct.unpack('<2H', extra[:4])
+        if extra_id == 0x0001:
+            is_zip64 = True
+            values = list(struct.unpack('<%dQ' % (extra_size // 8), extra[4 : 4 + extra_size - extra_size % 8]))
+            if file_size == 0xFFFFFFFF and values:
+                file_size = values.pop(0)
+            if compress_size == 0xFFFFFFFF and values:
+                compress_size = values.pop(0)
+        extra = extra[4 + extra_size:]
+    return compress_size, file_size, is_zip64
+
+
+def _get_member_destination(destination_directory, name):
+    # Like ZipFile.extract, members can't be written outside of the destination
+    components = [ it for it in name.replace('\\', '/').split('/') if it not in [ '', '.', '..' ] ]
+    if components and len(components[0]) == 2 and components[0][1] == ':':
+        components = components[1:]
+    return os.path.join(destination_directory, *components) + ('/' if name.endswith('/') else '')
+
+
+def _read_zip_central_directory(archive_stream, all_files):
+    has_modes = False
+    while True:
+        signature = archive_stream.read(4)
+        if signature != b'PK\x01\x02':
+            break
+        record = struct.unpack(zipfile.structCentralDir, signature + archive_stream.read_exact(zipfile.sizeCentralDir - 4))
+        create_system, flag_bits = record[2], record[5]
+        name_length, extra_length, comment_length, external_attr = record[12], record[13], record[14], record[17]
+        name = archive_stream.read_exact(name_length).decode('utf-8' if flag_bits & 0x800 else 'cp437')
+        archive_stream.read_exact(extra_length + comment_length)
+        # Archives created on Windows don't store modes
+        mode = (external_attr >> 16) & 0o777
+        if create_system == 3 and name in all_files and platform.system() != 'Windows':
+            has_modes = True
+            if mode & 0o111:
+                file_path = all_files[name]
+                os.chmod(file_path, os.stat(file_path).st_mode | (mode & 0o111))
+    # End records are not needed, only read them to reach the end of the stream
+    while archive_stream.read(_ARCHIVE_CHUNK_SIZE):
+        pass
+    if not has_modes:
+        for file_path in all_files.values():
+            _try_make_executable(file_path)
+
+
 def _try_make_executable(file_path):
     if platform.system() == 'Windows':
         return
@@ -255,27 +1135,27 @@ def create_artifact(artifact_path, file_collection, archive, compress, dry_run):
     elif archive:
         archive_path = artifact_path + '.zip'
         compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
-        with zipfile.ZipFile(archive_path + '.tmp', 'w', compression = compression) as archive_file:
-            for source, destination in file_collection:
-                if os.path.isdir(source):
-                    continue
-                logging.debug('Adding %s as %s', source, destination)
-                archive_file.write(source, destination)
+        file_collection = [ (source, destination) for source, destination in file_collection if not os.path.isdir(source) ]
+        all_entries = _write_archive(archive_path + '.tmp', file_collection, compression)
+        # Member CRCs were checked while writing, only check the structure
         with zipfile.ZipFile(archive_path + '.tmp', 'r') as archive_file:
-            if archive_file.testzip():
+            if len(archive_file.infolist()) != len(file_collection):
                 raise OSError('Archive is corrupted')
         logging.debug('Renaming %s to %s' % (archive_path + '.tmp', artifact_path))
         shutil.move(archive_path + '.tmp', archive_path)
+        _write_artifact_manifest(archive_path, all_entries)
 
     else:
         artifact_path_tmp = artifact_path + '.tmp'
+        copy_collection = []
         for source, destination in file_collection:
             if os.path.isdir(source):
                 continue
             logging.debug('Adding %s as %s', source, destination)
-            destination = os.path.join(artifact_path_tmp, destination)
-            os.makedirs(os.path.dirname(destination), exist_ok = True)
-            shutil.copyfile(source, destination)
+            copy_collection.append((source, os.path.join(artifact_path_tmp, destination)))
+        nimp.system.copy_files(copy_collection)
+        with concurrent.futures.ThreadPoolExecutor(max_workers = ARCHIVE_THREAD_COUNT) as executor:
+            all_entries = list(executor.map(lambda it: _get_manifest_entry(it[0], os.path.relpath(it[1], artifact_path_tmp)), copy_collection))
         logging.debug('Try : renaming %s to %s' % (artifact_path_tmp, artifact_path))
         try:
             # Sometimes shutils.move copies files instead of moving them, maybe
@@ -286,6 +1166,132 @@ def create_artifact(artifact_path, file_collection, archive, compress, dry_run):
         except Exception as ex:
             logging.debug('Renaming failed (%s), trying alternate method' % (ex))
             shutil.move(artifact_path_tmp, artifact_path)
+        _write_artifact_manifest(artifact_path, all_entries)
+
+
+def _write_archive(archive_path, file_collection, compression):
+    ''' Writes a zip archive, members are compressed by a pool of threads
+        and written in order, zlib releasing the GIL while compressing '''
+    all_entries = []
+
+    def _write_next_member(archive_file, pending_members):
+        member_future, _ = pending_members.popleft()
+        member_info, source, compressed_data, file_hash = member_future.result()
+        _write_archive_member(archive_file, member_info, source, compressed_data)
+        all_entries.append(_create_manifest_entry(member_info.filename, file_hash, member_info.file_size,
+                                                  (member_info.external_attr >> 16) & stat.S_IXUSR))
+
+    with zipfile.ZipFile(archive_path, 'w', compression = compression, allowZip64 = True) as archive_file:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = ARCHIVE_THREAD_COUNT) as executor:
+            # Bound members waiting to be written, by their count and by the
+            # memory their compressed data may use
+            pending_members = collections.deque()
+            for source, destination in file_collection:
+                pending_size = 0
+                if compression != zipfile.ZIP_STORED and os.path.isfile(source):
+                    pending_size = min(os.path.getsize(source), _ARCHIVE_SPOOL_SIZE)
+                while pending_members and (len(pending_members) >= 2 * ARCHIVE_THREAD_COUNT
+                                           or sum(size for _, size in pending_members) + pending_size > _ARCHIVE_PENDING_SIZE):
+                    _write_next_member(archive_file, pending_members)
+                pending_members.append((executor.submit(_compress_archive_member, source, destination, compression), pending_size))
+            while pending_members:
+                _write_next_member(archive_file, pending_members)
+    return all_entries
+
+
+def _compress_archive_member(source, destination, compression):
+    logging.debug('Adding %s as %s', source, destination)
+    member_info = zipfile.ZipInfo.from_file(source, destination)
+    member_info.compress_type = compression
+    crc = 0
+    file_hash = hashlib.new(MANIFEST_HASH_METHOD)
+    if compression == zipfile.ZIP_STORED:
+        # Stored data is read again while written, no need to spool it
+        with open(source, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(_ARCHIVE_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                file_hash.update(chunk)
+        member_info.CRC = crc
+        member_info.compress_size = member_info.file_size
+        return member_info, source, None, file_hash.hexdigest()
+
+    compressed_data = tempfile.SpooledTemporaryFile(max_size = _ARCHIVE_SPOOL_SIZE)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    member_info.file_size = 0
+    with open(source, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(_ARCHIVE_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            file_hash.update(chunk)
+            member_info.file_size += len(chunk)
+            compressed_data.write(compressor.compress(chunk))
+    compressed_data.write(compressor.flush())
+    member_info.CRC = crc
+    member_info.compress_size = compressed_data.tell()
+
+    # Check the compressed data, instead of testing the whole archive later
+    compressed_data.seek(0)
+    decompressor = zlib.decompressobj(-15)
+    decompressed_crc = 0
+    for chunk in iter(lambda: compressed_data.read(_ARCHIVE_CHUNK_SIZE), b''):
+        decompressed_crc = zlib.crc32(decompressor.decompress(chunk), decompressed_crc)
+    decompressed_crc = zlib.crc32(decompressor.flush(), decompressed_crc)
+    if decompressed_crc != crc:
+        raise OSError('Archive member is corrupted: %s' % destination)
+    compressed_data.seek(0)
+    return member_info, source, compressed_data, file_hash.hexdigest()
+
+
+def _write_archive_member(archive_file, member_info, source, compressed_data):
+    with _open_raw_archive_member(archive_file, member_info) as member_stream:
+        if compressed_data is not None:
+            with compressed_data:
+                shutil.copyfileobj(compressed_data, member_stream, _ARCHIVE_CHUNK_SIZE)
+        else:
+            crc = 0
+            written_size = 0
+            with open(source, 'rb') as source_file:
+                for chunk in iter(lambda: source_file.read(_ARCHIVE_CHUNK_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+                    written_size += len(chunk)
+                    member_stream.write(chunk)
+            if crc != member_info.CRC or written_size != member_info.file_size:
+                raise OSError('File changed while archiving: %s' % source)
+
+
+@contextlib.contextmanager
+def _open_raw_archive_member(archive_file, member_info):
+    ''' Like ZipFile.write, but sizes and CRC are known before writing the
+        header, and data is written as is, already compressed if needed.
+        This is the only place relying on ZipFile internals. '''
+    # pylint: disable = protected-access
+    member_info.header_offset = archive_file.fp.tell()
+    archive_file._didModify = True
+    archive_file.fp.write(member_info.FileHeader())
+    yield archive_file.fp
+    archive_file.filelist.append(member_info)
+    archive_file.NameToInfo[member_info.filename] = member_info
+    archive_file.start_dir = archive_file.fp.tell()
+
+
+def _get_manifest_entry(source, name):
+    file_hash = hashlib.new(MANIFEST_HASH_METHOD)
+    with open(source, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(_ARCHIVE_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    source_stat = os.stat(source)
+    return _create_manifest_entry(name.replace(os.sep, '/'), file_hash.hexdigest(), source_stat.st_size, source_stat.st_mode & stat.S_IXUSR)
+
+
+def _create_manifest_entry(name, file_hash, size, is_executable):
+    return { 'name': name, 'hash': file_hash, 'size': size, 'executable': bool(is_executable) }
+
+
+def _write_artifact_manifest(artifact_full_path, all_entries):
+    ''' Lists the files of an artifact with their hash, so that downloads can
+        reuse the files they already have '''
+    manifest = { 'hash_method': MANIFEST_HASH_METHOD, 'files': all_entries }
+    with TempArtifact(artifact_full_path + '.manifest.json', 'w', force = True) as manifest_file:
+        json.dump(manifest, manifest_file)
 
 
 def create_torrent(artifact_path, announce, dry_run):
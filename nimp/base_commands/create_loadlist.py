@@ -25,7 +25,9 @@ import itertools
 import os
 
 import nimp.command
+import nimp.system
 import nimp.utils.p4
+import nimp.utils.slicing
 
 
 class CreateLoadlist(nimp.command.Command):
@@ -38,7 +40,9 @@ class CreateLoadlist(nimp.command.Command):
         parser.add_argument('--dirs', nargs = argparse.ZERO_OR_MORE, help = 'directories to include', default = ['//{p4client}/...'])
         parser.add_argument('--exclude-dirs', nargs = argparse.ZERO_OR_MORE, help = 'directories to exclude', default = None)
         parser.add_argument('--error-on-empty', action = 'store_true', help = 'return an error code if loadlist is empty')
+        parser.add_argument('--no-cache', action = 'store_true', help = 'do not reuse files listed for the same changelists by previous runs')
         nimp.utils.p4.add_arguments(parser)
+        nimp.utils.slicing.add_arguments(parser)
         nimp.command.add_common_arguments(parser, 'dry_run', 'slice_job')
         return True
 
@@ -53,8 +57,8 @@ class CreateLoadlist(nimp.command.Command):
         return list(itertools.product(dirs, extensions))
 
     @staticmethod
-    def _product_paths_and_changelists(env, paths):
-        changelists = [f'@{cl},{cl}' for cl in env.changelists]
+    def _product_paths_and_changelists(paths, changelists):
+        changelists = [f'@{cl},{cl}' for cl in changelists]
         if len(changelists) <= 0:
             changelists = ['#have']
         return list(itertools.product(paths, changelists))
@@ -82,21 +86,10 @@ class CreateLoadlist(nimp.command.Command):
         for dir, ext in self._product_dirs_and_extensions(env, extensions):
             paths.append(f"{dir}{ext}")
 
-        filespecs = []
-        for path, cl in self._product_paths_and_changelists(env, paths):
-            filespecs.append(f"{path}{cl}")
-
-        base_command = [
-            "fstat",
-            # Only list modified files currently accessible
-            "-F", "^headAction=delete & ^headAction=move/delete"
-        ]
-
         modified_files = set()
         exclude_dirs = self._normpath_dirs(env.exclude_dirs)
-        for (filepath, ) in p4._parse_command_output(base_command + filespecs, r"^\.\.\. clientFile(.*)$",
-                                                     hide_output=True, encoding='utf-8'):
-            modified_file_path = os.path.normpath(filepath)
+        for client_file in self._get_client_files(env, p4, paths):
+            modified_file_path = os.path.normpath(client_file)
             if not self._exclude_from_modified_files(exclude_dirs, modified_file_path):
                 modified_files.add(modified_file_path)
 
@@ -104,20 +97,79 @@ class CreateLoadlist(nimp.command.Command):
         modified_files = list(modified_files)
         modified_files.sort()
 
-        if env.slice_job_count is not None and env.slice_job_count > 1:
-            # slice modified files
-            # use a simple heuristic to spread the load between slices
-            # as demanding files tends to be in the same directory
-            slice = []
-            for idx, elem in enumerate(modified_files):
-                if (idx % env.slice_job_count) == (env.slice_job_index - 1):
-                    slice.append(elem)
-
-            modified_files = slice
+        modified_files = nimp.utils.slicing.get_slice(env, modified_files)
 
         return modified_files
 
 
+    def _get_client_files(self, env, p4, paths):
+        # Files modified by a submitted changelist don't change, so they are
+        # cached by changelist: slices and later runs only query new ones.
+        # Pending changelists may still change, and empty results may come
+        # from a changelist not submitted yet or a wrong client view.
+        changelists = [str(cl) for cl in env.changelists]
+        if not changelists or env.no_cache:
+            return self._fstat_client_files(p4, paths, changelists)
+
+        info = next(p4.run_tagged('info', hide_output=True), {})
+        cache_context = [info.get('serverAddress'), info.get('clientName'), info.get('clientRoot'), paths]
+
+        client_files = []
+        missing_changelists = []
+        for cl in changelists:
+            cached_files = nimp.system.load_cache(env, 'loadlist', cache_context + [cl])
+            if cached_files is None:
+                missing_changelists.append(cl)
+            else:
+                client_files += cached_files
+        if not missing_changelists:
+            return client_files
+
+        files_by_changelist = { cl: [] for cl in missing_changelists }
+        is_cacheable = True
+        for record in self._fstat_records(p4, paths, missing_changelists):
+            client_files.append(record['clientFile'])
+            # fstat on a revision range reports the last revision in that range
+            if len(missing_changelists) == 1:
+                files_by_changelist[missing_changelists[0]].append(record['clientFile'])
+            elif record.get('headChange') in files_by_changelist:
+                files_by_changelist[record['headChange']].append(record['clientFile'])
+            else:
+                is_cacheable = False
+
+        if is_cacheable and not env.dry_run:
+            submitted_changelists = self._get_submitted_changelists(p4, [ cl for cl, files in files_by_changelist.items() if files ])
+            for cl, files in files_by_changelist.items():
+                if files and cl in submitted_changelists:
+                    nimp.system.save_cache(env, 'loadlist', cache_context + [cl], files)
+        return client_files
+
+    @staticmethod
+    def _get_submitted_changelists(p4, changelists):
+        if not changelists:
+            return set()
+        # Only describe one file by changelist, they may be large
+        return { record['change'] for record in p4.run_tagged('describe', '-s', '-m', '1', *changelists, hide_output=True)
+                 if record.get('status') == 'submitted' }
+
+    def _fstat_client_files(self, p4, paths, changelists):
+        return [ record['clientFile'] for record in self._fstat_records(p4, paths, changelists) ]
+
+    def _fstat_records(self, p4, paths, changelists):
+        filespecs = []
+        for path, cl in self._product_paths_and_changelists(paths, changelists):
+            filespecs.append(f"{path}{cl}")
+
+        base_command = [
+            "fstat",
+            # Only list modified files currently accessible
+            "-F", "^headAction=delete & ^headAction=move/delete"
+        ]
+
+        for record in p4.run_tagged(*base_command, *filespecs, hide_output=True, encoding='utf-8'):
+            if 'clientFile' in record:
+                yield record
+
     def run(self, env):
         loadlist_files = self.get_modified_files(env, env.extensions)
 
@@ -26,7 +26,6 @@
 import copy
 import logging
 import os
-import shutil
 from pathlib import PurePosixPath
 
 import nimp.artifacts
@@ -45,6 +44,13 @@ class DownloadFileset(nimp.command.Command):
         parser.add_argument('--min-revision', metavar = '<revision>', help = 'find a revision newer or equal to this one')
         parser.add_argument('--destination', metavar = '<path>', help = 'set a destination relative to the workspace')
         parser.add_argument('--track', choices = [ 'binaries', 'symbols', 'package', 'staged' ], help = 'track the installed revision in the workspace status')
+        parser.add_argument('-j', '--jobs', type = int, default = nimp.artifacts.DOWNLOAD_THREAD_COUNT, metavar = '<count>',
+                            help = 'set the number of files downloaded at the same time over HTTP (default: %(default)s)')
+        parser.add_argument('--store-size', type = float, default = 0, metavar = '<GiB>',
+                            help = 'keep downloaded files in a local store of this size, so that later runs do not download'
+                                   ' them again; they are written twice unless --link is used (default: disabled)')
+        parser.add_argument('--link', action = 'store_true',
+                            help = 'install files from the local store as hard links, they must not be modified in place')
         parser.add_argument('--prefer-http', action = 'store_true', help = 'If "artifact_http_repository_source" is provided in env, the download will be done through HTTP request intead of file copy')
 
         parser.add_argument('fileset', metavar = '<fileset>', help = 'fileset to download')
@@ -77,15 +83,20 @@ class DownloadFileset(nimp.command.Command):
         logging.info('Searching %s', artifact_uri_pattern.format(**format_arguments))
         all_artifacts = nimp.system.try_execute(lambda: nimp.artifacts.list_artifacts(artifact_uri_pattern, format_arguments, api_context), OSError)
         artifact_to_download = DownloadFileset._find_matching_artifact(all_artifacts, env.revision, env.min_revision, env.max_revision, api_context)
+        if 'name' in artifact_to_download and not nimp.artifacts.artifact_exists(artifact_to_download['uri']):
+            # The collection index is out of date, it can't be trusted
+            logging.warning('%s is in the artifact index but does not exist anymore, listing artifacts', artifact_to_download['uri'])
+            all_artifacts = nimp.system.try_execute(lambda: nimp.artifacts.list_artifacts(artifact_uri_pattern, format_arguments, api_context, use_index = False), OSError)
+            artifact_to_download = DownloadFileset._find_matching_artifact(all_artifacts, env.revision, env.min_revision, env.max_revision, api_context)
 
-        logging.info('Downloading %s%s', artifact_to_download['uri'], ' (simulation)' if env.dry_run else '')
+        logging.info('Downloading and installing %s in %s%s', artifact_to_download['uri'], install_directory, ' (simulation)' if env.dry_run else '')
         if not env.dry_run:
-            local_artifact_path = nimp.system.try_execute(lambda: nimp.artifacts.download_artifact(env.root_dir, artifact_to_download['uri']), OSError)
-
-        logging.info('Installing %s in %s%s', artifact_to_download['uri'], install_directory, ' (simulation)' if env.dry_run else '')
-        if not env.dry_run:
-            nimp.artifacts.install_artifact(local_artifact_path, install_directory)
-            shutil.rmtree(local_artifact_path)
+            store = None
+            if env.store_size > 0:
+                store = nimp.artifacts.ArtifactStore(os.path.join(env.root_dir, '.nimp', 'store'), int(env.store_size * 1024 ** 3))
+            nimp.system.try_execute(lambda: nimp.artifacts.install_artifact_from_uri(env.root_dir, artifact_to_download['uri'], install_directory,
+                                                                                     max(1, env.jobs), store, env.link),
+                                    OSError)
 
         if env.track:
             workspace_status = nimp.system.load_status(env)
@@ -110,9 +121,10 @@ class DownloadFileset(nimp.command.Command):
         has_revision_input = exact_revision or minimum_revision or maximum_revision
 
         if api_context:
-            exact_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, exact_revision)
-            minimum_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, minimum_revision)
-            maximum_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, maximum_revision)
+            all_timestamps = nimp.utils.git.get_gitea_commit_timestamps(api_context, [ exact_revision, minimum_revision, maximum_revision ])
+            exact_revision = all_timestamps[exact_revision]
+            minimum_revision = all_timestamps[minimum_revision]
+            maximum_revision = all_timestamps[maximum_revision]
             revision_not_found = not exact_revision and not minimum_revision and not maximum_revision
             if has_revision_input and revision_not_found:
                 raise ValueError('Searched commit not found on gitea repo')
@@ -60,7 +60,7 @@ class Fileset(nimp.command.CommandGroup):
 class _Delete(FilesetCommand):
     ''' Loads a fileset and delete mapped files '''
     def _run_fileset(self, env, file_mapper):
-        for path, _ in file_mapper():
+        for path, _ in file_mapper.stream():
             logging.info("Deleting %s", path)
             nimp.system.safe_delete(path)
 
@@ -103,7 +103,7 @@ class _Stash(FilesetCommand):
         logging.info('Creating stash %s', stash_name)
         os.makedirs(stash_directory)
         with open(os.path.join(stash_directory, '.stash.txt'), 'w') as stash_file:
-            for src, _ in file_mapper():
+            for src, _ in file_mapper.stream():
                 if os.path.isfile(src):
                     src_hash = hashlib.md5(src.encode('utf8')).hexdigest()
                     logging.info('Stashing %s as %s', src, src_hash)
@@ -23,6 +23,8 @@
 ''' Perforce related commands. '''
 
 import abc
+import concurrent.futures
+import logging
 import shutil
 
 import nimp.command
@@ -102,6 +104,24 @@ class _Fileset(P4Command):
                             metavar = '<description>',
                             help = 'Changelist description format, will be interpolated with environment value.')
 
+        parser.add_argument('--chunk-size',
+                            metavar = '<count>',
+                            type = int,
+                            default = 2000,
+                            help = 'Maximum number of files given to a single p4 command.')
+
+        parser.add_argument('-j', '--jobs',
+                            metavar = '<count>',
+                            type = int,
+                            default = 4,
+                            help = 'Number of p4 commands to run at the same time.')
+
+        parser.add_argument('--parallel',
+                            metavar = '<threads>',
+                            type = int,
+                            default = None,
+                            help = 'Number of p4 transfer threads used by each sync command.')
+
         nimp.command.add_common_arguments(parser, 'platform', 'configuration',
                                           'target', 'revision', 'free_parameters')
         return True
@@ -119,24 +139,59 @@ class _Fileset(P4Command):
         # key: p4_operation
         # value: [method, uses_a_changelist]
         operations = { 'checkout' : [p4.edit, True],
-                       'reconcile' : [p4.reconcile, True],
+                       'reconcile' : [p4.reconcile_files, True],
                        'revert' : [p4.revert, False],
-                       'sync' : [p4.sync, False], }
+                       'sync' : [lambda *files: p4.sync(*files, parallel = env.parallel), False], }
 
         files = nimp.system.map_files(env)
         if files.load_set(env.fileset) is None:
             return False
-        files = [file[0] for file in files()]
+        files = [file[0] for file in files.stream()]
 
+        operation = operations[env.p4_operation][0]
         if operations[env.p4_operation][1]:
             if env.changelist_description == 'default':
                 changelist = 'default'
             else:
                 description = env.format(env.changelist_description)
                 changelist = p4.get_or_create_changelist(description)
-            return operations[env.p4_operation][0](changelist, *files)
-        else:
-            return operations[env.p4_operation][0](*files)
+            if env.p4_operation == 'reconcile' and not p4.revert_missing_and_unchanged(changelist):
+                return False
+            return _run_sharded(env, lambda chunk: operation(changelist, *chunk), files)
+        return _run_sharded(env, lambda chunk: operation(*chunk), files)
+
+
+def _run_sharded(env, operation, files):
+    ''' Runs operation on chunks of at most env.chunk_size files, using up to
+        env.jobs threads, and reports the outcome of all chunks at once '''
+    chunk_size = max(1, env.chunk_size)
+    chunks = [ files[i:i + chunk_size] for i in range(0, len(files), chunk_size) ]
+    if len(chunks) <= 1:
+        return operation(files)
+
+    failed_chunks = []
+    done_count = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, env.jobs)) as executor:
+        futures = { executor.submit(operation, chunk): chunk for chunk in chunks }
+        for future in concurrent.futures.as_completed(futures):
+            chunk = futures[future]
+            try:
+                success = future.result()
+            except Exception as ex: # pylint: disable = broad-except
+                logging.error('p4 %s failed on %d files: %s', env.p4_operation, len(chunk), ex)
+                success = False
+            if not success:
+                failed_chunks.append(chunk)
+            done_count += len(chunk)
+            logging.info('p4 %s: %d/%d files processed', env.p4_operation, done_count, len(files))
+
+    if failed_chunks:
+        logging.error('p4 %s failed on %d chunks out of %d, covering these files:',
+                      env.p4_operation, len(failed_chunks), len(chunks))
+        for file in sorted(file for chunk in failed_chunks for file in chunk):
+            logging.error('  %s', file)
+        return False
+    return True
 
 
 class _Submit(P4Command):
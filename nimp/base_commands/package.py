@@ -37,15 +37,17 @@ import shutil
 import subprocess
 import xml.etree.ElementTree
 
+from contextlib import contextmanager
+
 import nimp.command
 import nimp.environment
 import nimp.system
+import nimp.sys.content_hash
+import nimp.sys.filesystem
 import nimp.sys.process
 import nimp.unreal
 import nimp.utils.p4
 
-from contextlib import contextmanager
-
 from nimp.sys.platform import create_platform_desc
 
 
@@ -82,6 +84,7 @@ def _try_remove(file_path, dry_run):
     if os.path.exists(file_path):
         logging.info('Removing %s', file_path)
         nimp.system.try_execute(_remove, OSError)
+        nimp.sys.filesystem.invalidate(file_path)
 
 
 def _try_create_directory(file_path, dry_run):
@@ -94,6 +97,7 @@ def _try_create_directory(file_path, dry_run):
     # The operation can fail if Windows Explorer has a handle on the directory
     if not os.path.isdir(file_path):
         nimp.system.try_execute(_create_directory, OSError)
+        nimp.sys.filesystem.invalidate(file_path)
 
 
 def _copy_file(source, destination, dry_run):
@@ -107,6 +111,106 @@ def _copy_file(source, destination, dry_run):
             shutil.copyfile(source, destination)
     else:
         raise FileNotFoundError(source)
+    nimp.sys.filesystem.invalidate(destination)
+
+
+class StageManifest():
+    ''' Files staged by nimp in a stage directory, with the state of their
+        source. It is saved beside the stage directory, so that the next runs
+        only copy files which changed and remove the ones not staged anymore.
+    '''
+
+    def __init__(self, stage_directory, use_links = False):
+        self.stage_directory = stage_directory
+        self.file_path = stage_directory.rstrip('/') + '.nimp-stage.json'
+        self.use_links = use_links
+        self._previous_files = {}
+        self._files = {}
+
+    def load(self):
+        ''' Loads files staged by the previous run '''
+        try:
+            with open(self.file_path) as manifest_file:
+                self._previous_files = json.load(manifest_file)
+        except (OSError, ValueError):
+            self._previous_files = {}
+
+    def stage(self, file_collection, dry_run):
+        ''' Copies (source, destination) files to the stage directory, unless
+            they are already staged '''
+        copy_collection = []
+        source_states = {}
+        for source, destination in file_collection:
+            destination_path = self.stage_directory + '/' + destination
+            key = os.path.normcase(destination)
+            source_stat = os.stat(source)
+            source_states[key] = _get_stage_state(source_stat)
+            if self._is_up_to_date(key, source, source_stat, destination_path):
+                logging.debug('%s is up to date', destination)
+            else:
+                logging.info('Staging %s as %s', source, destination)
+                if not dry_run and not self._link(source, source_stat, destination_path):
+                    copy_collection.append((source, destination_path))
+            self._files[key] = { 'source': source, 'destination': destination, 'state': None }
+
+        if dry_run:
+            return
+        nimp.system.copy_files(copy_collection)
+        for key, entry in self._files.items():
+            if key in source_states:
+                destination_stat = os.stat(self.stage_directory + '/' + entry['destination'])
+                entry['state'] = [ source_states[key], _get_stage_state(destination_stat) ]
+
+    def track(self, destination):
+        ''' Records a file written to the stage directory by other means, so
+            that it is removed by the first run not writing it anymore '''
+        key = os.path.normcase(destination)
+        self._files[key] = { 'source': None, 'destination': destination, 'state': None }
+
+    def save(self, dry_run):
+        ''' Removes files staged by the previous run but not by this one, and
+            saves the manifest for the next run '''
+        for key, entry in self._previous_files.items():
+            if key not in self._files:
+                _try_remove(self.stage_directory + '/' + entry['destination'], dry_run)
+        if dry_run:
+            return
+        temporary_file_path = '%s.%d.tmp' % (self.file_path, os.getpid())
+        with open(temporary_file_path, 'w') as manifest_file:
+            json.dump(self._files, manifest_file)
+        os.replace(temporary_file_path, self.file_path)
+
+    def _is_up_to_date(self, key, source, source_stat, destination_path):
+        try:
+            destination_stat = os.stat(destination_path)
+        except OSError:
+            return False
+        if (source_stat.st_dev, source_stat.st_ino) == (destination_stat.st_dev, destination_stat.st_ino):
+            return True
+        entry = self._previous_files.get(key)
+        if entry is not None and entry['source'] == source:
+            if entry['state'] == [ _get_stage_state(source_stat), _get_stage_state(destination_stat) ]:
+                return True
+        # Modification times may have been reset by a sync, compare content
+        return nimp.sys.content_hash.get_index().is_same_content(source, destination_path)
+
+    def _link(self, source, source_stat, destination_path):
+        os.makedirs(os.path.dirname(destination_path), exist_ok = True)
+        # The staged file may be a link, it must not be written through
+        if os.path.lexists(destination_path):
+            os.remove(destination_path)
+        nimp.sys.filesystem.invalidate(destination_path)
+        if self.use_links and os.stat(os.path.dirname(destination_path)).st_dev == source_stat.st_dev:
+            try:
+                os.link(source, destination_path)
+                return True
+            except OSError as exception:
+                logging.debug('Failed to link %s (%s), copying it', source, exception)
+        return False
+
+
+def _get_stage_state(file_stat):
+    return [ file_stat.st_size, file_stat.st_mtime_ns ]
 
 
 class UnrealPackageConfiguration():
@@ -124,6 +228,7 @@ class UnrealPackageConfiguration():
         self.cook_directory = None
         self.patch_base_directory = None
         self.stage_directory = None
+        self.stage_manifest = None
         self.package_directory = None
         self.uat_logs_directory = None
 
@@ -179,6 +284,13 @@ class Package(nimp.command.Command):
         parser.add_argument('--msixvc', action = 'store_true', help = 'create a MSIXVC package')
         parser.add_argument('--ps4-regions', metavar = '<region>', nargs = '+', help = 'set the PS4 regions to package for')
         parser.add_argument('--dlc', action = 'store_true', help = 'package as a DLC (necessary on PS5)')
+        parser.add_argument('--incremental-stage', action = 'store_true',
+                            help = 'keep the previous stage directory and only stage files which changed;'
+                                   ' only works for non-application packages on Unreal older than 4.24,'
+                                   ' it is ignored when AutomationTool stages the package')
+        parser.add_argument('--link-staged-files', action = 'store_true',
+                            help = 'hardlink staged files to their source when possible (with --incremental-stage),'
+                                   ' staged files must then not be modified in place')
 
         #region Legacy
         parser.add_argument('--layout', metavar = '<file_path>', help = '(deprecated) set the layout file to use for the package (for consoles)')
@@ -322,7 +434,9 @@ class Package(nimp.command.Command):
         Package._load_configuration(package_configuration, ps4_title_directory_collection)
 
         logging.info('')
-        with Package.configure_variant(env, package_configuration.project_directory):
+        # Filesets of all steps share what they read of the filesystem, files
+        # written by nimp are invalidated, and by child processes refreshed
+        with Package.configure_variant(env, package_configuration.project_directory), nimp.sys.filesystem.snapshot_scope():
             setattr(env, 'package_configuration', package_configuration)
             if 'cook' in env.steps:
                 logging.info('=== Cook ===')
@@ -741,7 +855,16 @@ class Package(nimp.command.Command):
         logging.info('')
         Package._clean_uat_logs(package_configuration, env.dry_run)
 
-        if env.unreal_version < 5:
+        # Files staged by AutomationTool are not known to the manifest, so
+        # the ones it doesn't stage anymore would never be removed
+        uat_stages_files = package_configuration.package_type in [ 'application', 'application_patch' ] or env.unreal_version >= 4.24
+        if env.incremental_stage and uat_stages_files:
+            logging.warning('Ignoring --incremental-stage, AutomationTool stages this package')
+        if env.incremental_stage and not uat_stages_files:
+            package_configuration.stage_manifest = StageManifest(package_configuration.stage_directory, env.link_staged_files)
+            package_configuration.stage_manifest.load()
+            nimp.sys.content_hash.enable_index_cache(os.path.join(env.root_dir, '.nimp', 'cache', 'content_hashes.json'))
+        elif env.unreal_version < 5:
             # legacy, this is now handled through uat with -nocleanstage param (engine default is cleanstage)
             _try_remove(package_configuration.stage_directory, env.dry_run)
             _try_create_directory(package_configuration.stage_directory, env.dry_run)
@@ -796,6 +919,14 @@ class Package(nimp.command.Command):
                         empty_file.write('\0')
                     with open(package_configuration.stage_directory + '/AlignmentChunk.bin', 'w') as empty_file:
                         empty_file.write('\0')
+                    nimp.sys.filesystem.invalidate(package_configuration.stage_directory + '/LaunchChunk.bin')
+                    nimp.sys.filesystem.invalidate(package_configuration.stage_directory + '/AlignmentChunk.bin')
+                if package_configuration.stage_manifest is not None:
+                    package_configuration.stage_manifest.track('LaunchChunk.bin')
+                    package_configuration.stage_manifest.track('AlignmentChunk.bin')
+
+        if package_configuration.stage_manifest is not None:
+            package_configuration.stage_manifest.save(env.dry_run)
 
 
     @staticmethod
@@ -883,7 +1014,7 @@ class Package(nimp.command.Command):
                 for source_path, destination_path in mapping_collection:
                     source_path = source_path.format(title_directory = title['title_directory'])
                     destination_path = destination_path.format(title_directory = title['title_directory']).lower()
-                    Package._stage_file(package_configuration.stage_directory, source_path, destination_path, dry_run)
+                    Package._stage_file(package_configuration.stage_directory, source_path, destination_path, dry_run, package_configuration.stage_manifest)
 
         elif package_configuration.target_platform == 'XboxOne':
 
@@ -893,6 +1024,7 @@ class Package(nimp.command.Command):
                 os.remove(package_configuration.stage_directory + '/appdata.bin')
                 os.remove(package_configuration.stage_directory + '/resources.pri')
                 shutil.rmtree(package_configuration.stage_directory + '/Resources')
+                nimp.sys.filesystem.invalidate(package_configuration.stage_directory)
 
             manifest_source = package_configuration.configuration_directory + '/XboxOne/AppxManifest.xml'
             transform_parameters = {}
@@ -900,14 +1032,15 @@ class Package(nimp.command.Command):
                 manifest_destination = 'AppxManifest-%s.xml' % binary_configuration
                 transform_parameters['executable_name'] = Package._get_executable_name(package_configuration, binary_configuration)
                 transform_parameters['configuration'] = binary_configuration
-                Package._stage_and_transform_file(package_configuration.stage_directory, manifest_source, manifest_destination, transform_parameters, dry_run)
+                Package._stage_and_transform_file(package_configuration.stage_directory, manifest_source, manifest_destination, transform_parameters, dry_run,
+                                                  package_configuration.stage_manifest)
 
             resource_file_collection = glob.glob(package_configuration.resource_directory + '/**/*.png', recursive = True)
             resource_file_collection += glob.glob(package_configuration.resource_directory + '/**/*.resw', recursive = True)
             resource_file_collection = [ nimp.system.standardize_path(path) for path in resource_file_collection ]
-            for resource_source in resource_file_collection:
-                resource_destination = 'Resources/' + os.path.relpath(resource_source, package_configuration.resource_directory)
-                Package._stage_file(package_configuration.stage_directory, resource_source, resource_destination, dry_run)
+            resource_file_collection = [ (resource_source, 'Resources/' + os.path.relpath(resource_source, package_configuration.resource_directory))
+                                         for resource_source in resource_file_collection ]
+            Package._stage_files(package_configuration.stage_directory, resource_file_collection, dry_run, package_configuration.stage_manifest)
 
             xdk_root = os.environ.get('DurangoXDK', None) or '/'
             makepri_command = [
@@ -922,6 +1055,7 @@ class Package(nimp.command.Command):
             logging.info('+ %s', ' '.join(makepri_command))
             if not dry_run:
                 subprocess.check_call(makepri_command)
+                nimp.sys.filesystem.invalidate(package_configuration.stage_directory)
 
         elif package_configuration.target_platform == 'Win64' and package_configuration.msixvc:
 
@@ -939,14 +1073,15 @@ class Package(nimp.command.Command):
                 manifest_destination = manifest_destination_format.format(configuration = binary_configuration)
                 transform_parameters['executable_name'] = Package._get_executable_name(package_configuration, binary_configuration)
                 transform_parameters['configuration'] = binary_configuration
-                Package._stage_and_transform_file(package_configuration.stage_directory, manifest_source, manifest_destination, transform_parameters, dry_run)
+                Package._stage_and_transform_file(package_configuration.stage_directory, manifest_source, manifest_destination, transform_parameters, dry_run,
+                                                  package_configuration.stage_manifest)
 
             resource_file_collection = glob.glob(package_configuration.resource_directory + '/**/*.png', recursive = True)
             resource_file_collection += glob.glob(package_configuration.resource_directory + '/**/*.resw', recursive = True)
             resource_file_collection = [ nimp.system.standardize_path(path) for path in resource_file_collection ]
-            for resource_source in resource_file_collection:
-                resource_destination = 'Resources/' + os.path.relpath(resource_source, package_configuration.resource_directory)
-                Package._stage_file(package_configuration.stage_directory, resource_source, resource_destination, dry_run)
+            resource_file_collection = [ (resource_source, 'Resources/' + os.path.relpath(resource_source, package_configuration.resource_directory))
+                                         for resource_source in resource_file_collection ]
+            Package._stage_files(package_configuration.stage_directory, resource_file_collection, dry_run, package_configuration.stage_manifest)
 
             sdk_root = os.environ.get('GamingSDK', None) or '/'
             makepri_command = [
@@ -961,6 +1096,7 @@ class Package(nimp.command.Command):
             logging.info('+ %s', ' '.join(makepri_command))
             if not dry_run:
                 subprocess.check_call(makepri_command)
+                nimp.sys.filesystem.invalidate(package_configuration.stage_directory)
 
     @staticmethod
     def _backup_uat_logs(package_configuration, suffix, dry_run):
@@ -992,7 +1128,8 @@ class Package(nimp.command.Command):
         if package_configuration.target_platform in [ 'Win64', 'XboxOne' ]:
             for binary_configuration in package_configuration.binary_configuration.split('+'):
                 pdb_file_name = Package._get_executable_name(package_configuration, binary_configuration) + '.pdb'
-                Package._stage_file(package_configuration.stage_directory, source + '/' + pdb_file_name, destination + '/' + pdb_file_name, dry_run)
+                Package._stage_file(package_configuration.stage_directory, source + '/' + pdb_file_name, destination + '/' + pdb_file_name, dry_run,
+                                    package_configuration.stage_manifest)
 
 
     @staticmethod
@@ -1012,7 +1149,8 @@ class Package(nimp.command.Command):
                     destination = '{project}-{region}-{configuration}.{layout_file_extension}'.format(**format_parameters).lower()
                     transform_parameters['executable_name'] = Package._get_executable_name(package_configuration, binary_configuration).lower()
                     transform_parameters['configuration'] = binary_configuration.lower()
-                    Package._stage_and_transform_file(package_configuration.stage_directory, source, destination, transform_parameters, dry_run)
+                    Package._stage_and_transform_file(package_configuration.stage_directory, source, destination, transform_parameters, dry_run,
+                                                      package_configuration.stage_manifest)
 
         elif package_configuration.msixvc:
             transform_parameters = {}
@@ -1021,7 +1159,8 @@ class Package(nimp.command.Command):
                 destination = '{project}-{configuration}.xml'.format(**format_parameters)
                 transform_parameters['executable_name'] = Package._get_executable_name(package_configuration, binary_configuration)
                 transform_parameters['configuration'] = binary_configuration
-                Package._stage_and_transform_file(package_configuration.stage_directory, source, destination, transform_parameters, dry_run)
+                Package._stage_and_transform_file(package_configuration.stage_directory, source, destination, transform_parameters, dry_run,
+                                                  package_configuration.stage_manifest)
 
 
     @staticmethod
@@ -1033,10 +1172,9 @@ class Package(nimp.command.Command):
             file_mapper = nimp.system.FileMapper(None, vars(env))
             file_mapper.load_set('content_other')
             all_files = file_mapper.to_list(env.root_dir, '.')
-            for source_file, destination_file in all_files:
-                if package_configuration.target_platform == 'PS4':
-                    destination_file = destination_file.lower()
-                Package._stage_file(package_configuration.stage_directory, source_file, destination_file, env.dry_run)
+            if package_configuration.target_platform == 'PS4':
+                all_files = [ (source_file, destination_file.lower()) for source_file, destination_file in all_files ]
+            Package._stage_files(package_configuration.stage_directory, all_files, env.dry_run, package_configuration.stage_manifest)
         except ImportError:
             pass
 
@@ -1047,22 +1185,36 @@ class Package(nimp.command.Command):
 
 
     @staticmethod
-    def _stage_file(stage_directory, source, destination, dry_run):
-        logging.info('Staging %s as %s', source, destination)
-        if os.path.isdir(source):
-            if not dry_run:
-                shutil.copytree(source, stage_directory + '/' + destination, copy_function = shutil.copyfile)
-        elif os.path.isfile(source):
-            if not dry_run:
-                os.makedirs(os.path.dirname(stage_directory + '/' +destination), exist_ok = True)
-                shutil.copyfile(source, stage_directory + '/' +destination)
-        else:
-            raise FileNotFoundError(source)
+    def _stage_file(stage_directory, source, destination, dry_run, manifest = None):
+        Package._stage_files(stage_directory, [ (source, destination) ], dry_run, manifest)
+
+
+    @staticmethod
+    def _stage_files(stage_directory, file_collection, dry_run, manifest = None):
+        all_files = []
+        for source, destination in file_collection:
+            if manifest is None:
+                logging.info('Staging %s as %s', source, destination)
+            if os.path.isdir(source):
+                all_files.append((source, destination))
+                for relative_path, _ in nimp.sys.filesystem.walk(source):
+                    all_files.append((source + '/' + relative_path, destination + '/' + relative_path))
+            elif os.path.isfile(source):
+                all_files.append((source, destination))
+            else:
+                raise FileNotFoundError(source)
+
+        if manifest is not None:
+            manifest.stage([ (source, destination) for source, destination in all_files if not os.path.isdir(source) ], dry_run)
+        elif not dry_run:
+            nimp.system.copy_files([ (source, stage_directory + '/' + destination) for source, destination in all_files ])
 
 
     @staticmethod
-    def _stage_and_transform_file(stage_directory, source, destination, transform_parameters, dry_run):
+    def _stage_and_transform_file(stage_directory, source, destination, transform_parameters, dry_run, manifest = None):
         logging.info('Staging %s as %s', source, destination)
+        if manifest is not None:
+            manifest.track(destination)
 
         with open(source, 'r') as source_file:
             file_content = source_file.read()
@@ -1097,6 +1249,7 @@ class Package(nimp.command.Command):
         if not dry_run:
             with open(stage_directory + '/' + destination, 'w') as destination_file:
                 destination_file.write(file_content)
+            nimp.sys.filesystem.invalidate(stage_directory + '/' + destination)
 
 
     @staticmethod
@@ -1225,6 +1378,7 @@ class Package(nimp.command.Command):
 
             with open(param_file, 'w+') as f:
                 json.dump(params, f, indent=4)
+            nimp.sys.filesystem.invalidate(param_file)
 
     @staticmethod
     def configure_packaging_for_xsx_dlc(env, package_configuration):
@@ -1234,6 +1388,7 @@ class Package(nimp.command.Command):
         dst_microsoft_game_config = env.format('{uproject_dir}/Saved/StagedBuilds/XSX/Manifest/{unreal_config}/MicrosoftGame.config')
         logging.info('Copying %s to %s', src_microsoft_game_config, dst_microsoft_game_config)
         shutil.copyfile(src_microsoft_game_config, dst_microsoft_game_config)
+        nimp.sys.filesystem.invalidate(dst_microsoft_game_config)
         # `-NoGameOs` is not a vanilla UAT argument. We use it in an internal patch that remvoves the addition of `/gameos [...]` when packaging for xbox.
         package_configuration.extra_options.append('-NoGameOs')
 
@@ -1344,6 +1499,7 @@ class Package(nimp.command.Command):
                 os.remove(source + '/AppxManifest.xml')
                 if os.path.isfile(source + '/appdata.bin'):
                     os.remove(source + '/appdata.bin')
+                nimp.sys.filesystem.invalidate(source)
 
             if package_success != 0:
                 raise RuntimeError('Package generation failed')
@@ -1384,6 +1540,7 @@ class Package(nimp.command.Command):
                     os.remove(source + '/appdata.bin')
                 if os.path.isfile(source + '/MicrosoftGame.config'):
                     os.remove(source + '/MicrosoftGame.config')
+                nimp.sys.filesystem.invalidate(source)
 
             if package_success != 0:
                 raise RuntimeError('Package generation failed')
@@ -29,9 +29,12 @@ import os
 import shutil
 import subprocess
 
+import nimp.artifacts
 import nimp.command
 import nimp.unreal
+import nimp.sys.filesystem
 import nimp.sys.process
+import nimp.system
 from nimp.sys.platform import create_platform_desc
 from nimp.base_commands.package import Package
 
@@ -223,7 +226,11 @@ class ConsoleGameCommand(nimp.command.Command):
         logging.info(f'Copying from {env.fetch} to {env.outdir}')
         if env.dry_run:
             return True
-        return shutil.copytree(env.fetch, env.outdir)
+        file_collection = [ (env.fetch, env.outdir) ]
+        file_collection += [ (os.path.join(env.fetch, relative_path), os.path.join(env.outdir, relative_path))
+                             for relative_path, _ in nimp.sys.filesystem.walk(env.fetch) ]
+        nimp.system.copy_files(file_collection, preserve_metadata = True)
+        return True
 
     
     def deploy(self, env):
@@ -274,6 +281,14 @@ class ConsoleGameCommand(nimp.command.Command):
         if not env.variant:
             raise RuntimeError('"variant" parameter is required to fetch remote packages')
 
+        artifact_index = nimp.artifacts.load_artifact_index(self.get_artifact_repository(env, '{revision}'))
+        if artifact_index:
+            pkg_path = self.fetch_pkg_by_revision(env, artifact_index[-1]['revision'])
+            if os.path.exists(pkg_path):
+                logging.info('Using latest %s package from the artifact index', env.platform)
+                return pkg_path
+            logging.warning('%s is in the artifact index but does not exist anymore', pkg_path)
+
         artifact_repository = self.get_artifact_repository(env, '<revision>') # Path for a given revision
         parent_directory =  os.path.dirname(nimp.system.sanitize_path(artifact_repository)) # Path containing all the revisions
         logging.info(f'Looking for latest {env.platform} package in {parent_directory}')
@@ -33,7 +33,9 @@ import subprocess
 
 import nimp.command
 import nimp.unreal
+import nimp.sys.filesystem
 import nimp.sys.process
+import nimp.system
 import nimp.utils.p4
 from nimp.sys.platform import create_platform_desc
 
@@ -266,7 +268,11 @@ class ConsoleGameCommand(RunLegacyCommand):
         logging.info('Copying from ' + env.fetch + ' to ' + env.outdir)
         if env.dry_run:
             return True
-        return shutil.copytree(env.fetch, env.outdir)
+        file_collection = [ (env.fetch, env.outdir) ]
+        file_collection += [ (os.path.join(env.fetch, relative_path), os.path.join(env.outdir, relative_path))
+                             for relative_path, _ in nimp.sys.filesystem.walk(env.fetch) ]
+        nimp.system.copy_files(file_collection, preserve_metadata = True)
+        return True
 
     
     def deploy(self, env):
@@ -27,18 +27,16 @@ import shutil
 
 import nimp.command
 import nimp.model.symbol_server
+import nimp.sys.filesystem
 import nimp.system
 
 
 def _list_files(source):
     all_files = []
 
-    for file_path in os.listdir(source):
-        file_path = os.path.join(source, file_path)
-        if os.path.isdir(file_path):
-            all_files.extend(_list_files(file_path))
-        else:
-            all_files.append(file_path)
+    for relative_path, entry in nimp.sys.filesystem.walk(source):
+        if not entry.is_dir:
+            all_files.append(os.path.join(source, relative_path))
 
     return all_files
 
@@ -29,6 +29,7 @@ import zipfile
 
 import nimp.command
 import nimp.artifacts
+import nimp.utils.git
 
 
 def _try_remove(file_path, dry_run):
@@ -66,7 +67,8 @@ class UploadFileset(nimp.command.Command):
         if env.torrent and not hasattr(env, 'torrent_tracker_announce'):
             env.torrent_tracker_announce = None
 
-        artifact_path = f'{env.artifact_repository_destination}/{env.artifact_collection[env.fileset]}'
+        artifact_pattern = f'{env.artifact_repository_destination}/{env.artifact_collection[env.fileset]}'
+        artifact_path = artifact_pattern
         if env.slice_job_index and env.slice_job_count:
             artifact_path = f'{artifact_path}/slice-{env.slice_job_index}-of-{env.slice_job_count}'
         artifact_path = nimp.system.sanitize_path(env.format(artifact_path))
@@ -76,6 +78,8 @@ class UploadFileset(nimp.command.Command):
                 raise ValueError('Artifact already exists: %s' % artifact_path)
             else:
                 _try_remove(artifact_path + '.torrent', env.dry_run)
+                _try_remove(artifact_path + '.manifest.json', env.dry_run)
+                _try_remove(artifact_path + '.zip.manifest.json', env.dry_run)
                 _try_remove(artifact_path + '.zip', env.dry_run)
                 _try_remove(artifact_path, env.dry_run)
 
@@ -100,5 +104,10 @@ class UploadFileset(nimp.command.Command):
         if env.hash is not None:
             logging.info(f'Creating hash for {artifact_path}')
             nimp.artifacts.create_hash(artifact_path, env.hash, env.dry_run)
+        if env.revision:
+            api_context = nimp.utils.git.initialize_gitea_api_context(env)
+            nimp.system.try_execute(
+                lambda: nimp.artifacts.update_artifact_index(artifact_pattern, vars(env), env.revision, api_context, env.dry_run),
+                OSError)
 
         return True
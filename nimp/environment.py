@@ -27,9 +27,11 @@ import argparse
 import re
 import logging
 import os
-import pkg_resources
 import sys
 import time
+import weakref
+
+import pkg_resources
 
 import nimp.command
 from nimp.exceptions import NimpCommandFailed
@@ -50,12 +52,86 @@ _SUMMARY_HANDLERS = { # pylint: disable = invalid-name
 }
 
 
+# Bumped each time an environment attribute changes, so that cached
+# interpolated strings can tell they may be outdated
+_ATTRIBUTES_VERSION = [ 0 ] # pylint: disable = invalid-name
+
+# Format caches of Environment instances, kept out of their attributes
+_ENVIRONMENT_FORMAT_CACHES = weakref.WeakKeyDictionary() # pylint: disable = invalid-name
+
+# Environment instances by id of their attributes, see is_environment_attributes
+_ENVIRONMENTS_BY_ATTRIBUTES = weakref.WeakValueDictionary() # pylint: disable = invalid-name
+
+# Number of strings interpolated with the current time, see interpolate
+_STRFTIME_COUNT = [ 0 ] # pylint: disable = invalid-name
+
+
+def interpolate(fmt, format_args):
+    ''' Interpolates given string with format arguments, then time.strftime '''
+    result = fmt.format(**format_args) if '{' in fmt or '}' in fmt else fmt
+    return _strftime(result)
+
+
+def is_environment_attributes(format_args):
+    ''' Checks whether format arguments are the attributes of an environment,
+        whose changes are tracked by format caches, unlike plain dictionaries
+        which may be modified in place '''
+    environment = _ENVIRONMENTS_BY_ATTRIBUTES.get(id(format_args))
+    return environment is not None and vars(environment) is format_args
+
+
+def get_strftime_count():
+    ''' Returns how many interpolated strings depended on the current time,
+        to know if results computed from them can be reused later '''
+    return _STRFTIME_COUNT[0]
+
+
+def _strftime(result):
+    if '%' not in result:
+        return result
+    _STRFTIME_COUNT[0] += 1
+    return time.strftime(result)
+
+
+class FormatCache():
+    ''' Remembers strings interpolated with the attributes of an environment
+        until one of them changes. Values modified in place (like lists) are
+        not tracked. '''
+    def __init__(self):
+        self._version = None
+        self._results = {}
+
+    def format(self, fmt, format_args):
+        ''' Same as interpolate, reusing previous results '''
+        if '{' not in fmt and '}' not in fmt:
+            return _strftime(fmt)
+
+        if self._version != _ATTRIBUTES_VERSION[0]:
+            self._results.clear()
+            self._version = _ATTRIBUTES_VERSION[0]
+        result = self._results.get(fmt)
+        if result is None:
+            result = fmt.format(**format_args)
+            self._results[fmt] = result
+        # Only the strftime part depends on the current time
+        return _strftime(result)
+
+
 class Environment:
     ''' Environment '''
     config_loaders = []
     argument_loaders = []
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        _ATTRIBUTES_VERSION[0] += 1
+
+    def __delattr__(self, name):
+        super().__delattr__(name)
+        _ATTRIBUTES_VERSION[0] += 1
+
     def __init__(self):
+        _ENVIRONMENTS_BY_ATTRIBUTES[id(vars(self))] = self
         self.command = None
         self.command_list = []
         self.environment = {}
@@ -267,11 +343,14 @@ class Environment:
         ''' Interpolates given string with config values & command line para-
             meters set in the environment '''
         assert isinstance(fmt, str)
-        kwargs = vars(self).copy()
-        kwargs.update(override_kwargs)
-        result = fmt.format(**kwargs)
-        result = time.strftime(result)
-        return result
+        if override_kwargs:
+            kwargs = vars(self).copy()
+            kwargs.update(override_kwargs)
+            return interpolate(fmt, kwargs)
+        format_cache = _ENVIRONMENT_FORMAT_CACHES.get(self)
+        if format_cache is None:
+            format_cache = _ENVIRONMENT_FORMAT_CACHES.setdefault(self, FormatCache())
+        return format_cache.format(fmt, vars(self))
 
     def call(self, method, *args, **override_kwargs):
         ''' Calls a method after interpolating its arguments '''
@@ -25,7 +25,6 @@ import datetime
 import logging
 import glob
 import os
-import shutil
 
 import nimp.system
 
@@ -97,13 +96,14 @@ class SymbolServer:
             all_files = glob.glob(os.path.join(source, "**"), recursive = True)
             all_files = [ path for path in all_files if os.path.isfile(path) ]
 
+            copy_collection = []
             for source_file in all_files:
                 destination_file = os.path.join(self.server_path, os.path.relpath(source_file, source))
                 logging.info("Copying '%s' to '%s'", source_file, destination_file)
+                copy_collection.append((source_file, destination_file))
 
-                if not dry_run:
-                    os.makedirs(os.path.dirname(destination_file), exist_ok = True)
-                    shutil.copyfile(source_file, destination_file)
+            if not dry_run:
+                nimp.system.copy_files(copy_collection)
 
     def list_symbols_to_clean(self, all_symbols):
         now = datetime.datetime.now()
@@ -23,6 +23,8 @@
 ''' System functions '''
 
 __all__ = [
+    'content_hash',
+    'filesystem',
     'platform',
     'process',
 ]
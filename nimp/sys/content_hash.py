@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Content hashes of files, reused while their size and modification time
+    don't change '''
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+import nimp.sys.filesystem
+
+# Read size when hashing file content
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _create_hash():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size = 16)
+
+
+# Hashes from another algorithm can't be compared, it is saved with the index
+HASH_ALGORITHM = 'xxh3_128' if xxhash is not None else 'blake2b_128'
+
+
+class ContentHashIndex():
+    ''' Content hashes of files, keyed by path. A file is hashed again only
+        if its size or modification time changed since it was indexed. The
+        index can be saved to disk and reused by the next runs. '''
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._is_persistent = False
+
+    def get_hash(self, path, snapshot = None):
+        ''' Returns the content hash of given file, or None if it doesn't
+            exist '''
+        snapshot = snapshot if snapshot is not None else nimp.sys.filesystem.get_snapshot()
+        path_stat = snapshot.stat(path)
+        if path_stat is None:
+            return None
+        key = os.path.normcase(os.path.abspath(path))
+        state = [ path_stat.st_size, path_stat.st_mtime_ns ]
+        with self._lock:
+            indexed_state = self._hashes.get(key)
+        if indexed_state is not None and indexed_state[:2] == state:
+            return indexed_state[2]
+
+        content_hash = _create_hash()
+        try:
+            with open(path, 'rb') as content:
+                for chunk in iter(lambda: content.read(_CHUNK_SIZE), b''):
+                    content_hash.update(chunk)
+        except OSError:
+            return None
+        with self._lock:
+            self._hashes[key] = state + [ content_hash.hexdigest() ]
+        return content_hash.hexdigest()
+
+    def is_same_content(self, src, dest, snapshot = None):
+        ''' Checks if given files exist and have the same content. Sizes are
+            compared first, files are hashed only if they match. '''
+        snapshot = snapshot if snapshot is not None else nimp.sys.filesystem.get_snapshot()
+        src_stat = snapshot.stat(src)
+        dest_stat = snapshot.stat(dest)
+        if src_stat is None or dest_stat is None or src_stat.st_size != dest_stat.st_size:
+            return False
+        src_hash = self.get_hash(src, snapshot)
+        return src_hash is not None and src_hash == self.get_hash(dest, snapshot)
+
+    def load(self, cache_file_path):
+        ''' Loads hashes saved by a previous run '''
+        self._is_persistent = True
+        try:
+            with open(cache_file_path) as cache_file:
+                saved_index = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        if saved_index.get('algorithm') != HASH_ALGORITHM:
+            return
+        with self._lock:
+            for key, state in saved_index['hashes'].items():
+                self._hashes.setdefault(key, state)
+
+    def save(self, cache_file_path):
+        ''' Saves hashes known by this process, removed files are dropped '''
+        with self._lock:
+            hashes = { key: state for key, state in self._hashes.items() if os.path.exists(key) }
+        os.makedirs(os.path.dirname(cache_file_path), exist_ok = True)
+        temporary_file_path = '%s.%d.tmp' % (cache_file_path, os.getpid())
+        with open(temporary_file_path, 'w') as cache_file:
+            json.dump({ 'algorithm': HASH_ALGORITHM, 'hashes': hashes }, cache_file)
+        os.replace(temporary_file_path, cache_file_path)
+
+
+_INDEX = ContentHashIndex()
+
+
+def get_index():
+    ''' Returns the content hash index shared by this process '''
+    return _INDEX
+
+
+def reset_index():
+    ''' Forgets all hashes known by this process '''
+    global _INDEX # pylint: disable = global-statement
+    _INDEX = ContentHashIndex()
+
+
+def enable_index_cache(cache_file_path):
+    ''' Reuses hashes of previous runs saved to given file, and saves them
+        back when this process exits '''
+    if _INDEX._is_persistent: # pylint: disable = protected-access
+        return
+    logging.debug('Using content hash index %s', cache_file_path)
+    index = _INDEX
+    index.load(cache_file_path)
+    atexit.register(index.save, cache_file_path)
@@ -0,0 +1,645 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Filesystem enumeration utilities '''
+
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import re
+import stat
+import threading
+
+import glob2
+
+import nimp.sys.platform
+
+_MAGIC_CHECK = re.compile('[*?[]')
+
+# Stands for a '**' component in compiled glob patterns
+_GLOBSTAR = object()
+
+# Directory entry, as seen by the snapshot
+DirectoryEntry = collections.namedtuple('DirectoryEntry', [ 'name', 'is_dir', 'is_file', 'is_symlink' ])
+
+
+class DirectorySnapshot():
+    ''' Directory listings and file stats, fetched once and reused until
+        invalidated. Listings can be saved to disk and reused by the next
+        runs if directory modification times didn't change. '''
+    def __init__(self):
+        # Snapshots are filled by walk() threads, but the filesystem is read
+        # without holding the lock
+        self._lock = threading.RLock()
+        self._listings = {}
+        self._entries = {}
+        self._stats = {}
+        self._saved_listings = {}
+        self._listing_mtimes = {}
+        self._is_persistent = False
+        self._fingerprints = []
+
+    def list_dir(self, path):
+        ''' Returns entries of given directory sorted by name, or an empty
+            list if it can't be listed '''
+        key = _get_snapshot_key(path)
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is None:
+                listing = self._load_saved_listing(key)
+            needs_mtime = self._is_persistent or bool(self._fingerprints)
+        if listing is None:
+            listing = {}
+            mtime = None
+            try:
+                if needs_mtime:
+                    mtime = os.stat(key).st_mtime_ns
+                with os.scandir(key) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir, is_file, is_symlink = entry.is_dir(), entry.is_file(), entry.is_symlink()
+                        except OSError:
+                            continue
+                        listing[os.path.normcase(entry.name)] = DirectoryEntry(entry.name, is_dir, is_file, is_symlink)
+            except OSError:
+                pass
+            with self._lock:
+                if mtime is not None:
+                    self._listing_mtimes[key] = mtime
+                listing = self._listings.setdefault(key, listing)
+        with self._lock:
+            self._record_listing(key)
+        return sorted(listing.values(), key = lambda it: it.name)
+
+    def get_entry(self, path):
+        ''' Returns the entry of given path, or None if it doesn't exist '''
+        key = _get_snapshot_key(path)
+        parent, name = os.path.split(key)
+        with self._lock:
+            if parent in self._listings and name:
+                self._record_listing(parent)
+                return self._listings[parent].get(name)
+            is_cached = key in self._entries
+        entry = None if is_cached else _get_entry(key)
+        with self._lock:
+            entry = self._entries.setdefault(key, entry)
+            for fingerprint in self._fingerprints:
+                fingerprint.entries[key] = entry
+        return entry
+
+    def lexists(self, path):
+        ''' Like os.path.lexists '''
+        return self.get_entry(path) is not None
+
+    def exists(self, path):
+        ''' Like os.path.exists '''
+        entry = self.get_entry(path)
+        return entry is not None and (not entry.is_symlink or entry.is_dir or entry.is_file)
+
+    def isdir(self, path):
+        ''' Like os.path.isdir '''
+        entry = self.get_entry(path)
+        return entry is not None and entry.is_dir
+
+    def isfile(self, path):
+        ''' Like os.path.isfile '''
+        entry = self.get_entry(path)
+        return entry is not None and entry.is_file
+
+    def stat(self, path):
+        ''' Like os.stat, but returns None if the file doesn't exist '''
+        key = _get_snapshot_key(path)
+        with self._lock:
+            is_cached = key in self._stats
+        path_stat = None
+        if not is_cached:
+            try:
+                path_stat = os.stat(key)
+            except OSError:
+                pass
+        with self._lock:
+            path_stat = self._stats.setdefault(key, path_stat)
+            for fingerprint in self._fingerprints:
+                fingerprint.stats[key] = _get_stat_state(path_stat)
+        return path_stat
+
+    def getmtime(self, path):
+        ''' Like os.path.getmtime '''
+        path_stat = self.stat(path)
+        if path_stat is None:
+            raise FileNotFoundError(path)
+        return path_stat.st_mtime
+
+    def invalidate(self, path):
+        ''' Forgets everything known about given path, its children and its
+            parent directories, after it was modified '''
+        key = _get_snapshot_key(path)
+        prefix = key.rstrip(os.sep) + os.sep
+        with self._lock:
+            for cache in [ self._listings, self._entries, self._stats, self._saved_listings ]:
+                for cached_key in [ it for it in cache if it == key or it.startswith(prefix) ]:
+                    del cache[cached_key]
+            # Parent directories may have been created or removed as well
+            parent = os.path.dirname(key)
+            while parent:
+                for cache in [ self._listings, self._entries, self._stats, self._saved_listings ]:
+                    cache.pop(parent, None)
+                if os.path.dirname(parent) == parent:
+                    break
+                parent = os.path.dirname(parent)
+
+    def refresh(self):
+        ''' Forgets everything known about the filesystem, which may have
+            been modified by other means (e.g. child processes). Listings
+            which can be saved are kept, to be reused if the modification
+            time of their directory didn't change. '''
+        with self._lock:
+            listing_mtimes = {}
+            if self._is_persistent:
+                for key, listing in self._listings.items():
+                    mtime = self._listing_mtimes.get(key)
+                    if mtime is not None:
+                        self._saved_listings[key] = (mtime, list(listing.values()))
+                        listing_mtimes[key] = mtime
+            self._listings.clear()
+            self._entries.clear()
+            self._stats.clear()
+            self._listing_mtimes = listing_mtimes
+
+    @contextlib.contextmanager
+    def record(self):
+        ''' Records everything read through this snapshot in the returned
+            SnapshotFingerprint, to later check if it changed '''
+        fingerprint = SnapshotFingerprint()
+        with self._lock:
+            self._fingerprints.append(fingerprint)
+        try:
+            yield fingerprint
+        finally:
+            with self._lock:
+                self._fingerprints.remove(fingerprint)
+
+    def record_untracked_access(self):
+        ''' Notifies that the filesystem was read without this snapshot, so
+            that current fingerprints know they are incomplete '''
+        with self._lock:
+            for fingerprint in self._fingerprints:
+                fingerprint.is_complete = False
+
+    def load(self, cache_file_path):
+        ''' Loads listings saved by a previous run, they will be used if the
+            modification time of their directory didn't change '''
+        with self._lock:
+            self._is_persistent = True
+        try:
+            with open(cache_file_path) as cache_file:
+                saved_listings = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for key, (mtime, entries) in saved_listings.items():
+                self._saved_listings[key] = (mtime, [ DirectoryEntry(*it) for it in entries ])
+
+    def save(self, cache_file_path):
+        ''' Saves listings validated or fetched during this run '''
+        saved_listings = {}
+        with self._lock:
+            for key, mtime in self._listing_mtimes.items():
+                if key in self._listings:
+                    saved_listings[key] = (mtime, [ list(it) for it in self._listings[key].values() ])
+                elif key in self._saved_listings:
+                    # Listed before a refresh, and not needed since
+                    saved_listings[key] = (mtime, [ list(it) for it in self._saved_listings[key][1] ])
+        os.makedirs(os.path.dirname(cache_file_path), exist_ok = True)
+        temporary_file_path = '%s.%d.tmp' % (cache_file_path, os.getpid())
+        with open(temporary_file_path, 'w') as cache_file:
+            json.dump(saved_listings, cache_file)
+        os.replace(temporary_file_path, cache_file_path)
+
+    def _load_saved_listing(self, key):
+        saved_listing = self._saved_listings.pop(key, None)
+        if saved_listing is None:
+            return None
+        mtime, entries = saved_listing
+        try:
+            if os.stat(key).st_mtime_ns != mtime:
+                return None
+        except OSError:
+            return None
+        self._listing_mtimes[key] = mtime
+        listing = { os.path.normcase(it.name): it for it in entries }
+        self._listings[key] = listing
+        return listing
+
+    def _record_listing(self, key):
+        if not self._fingerprints:
+            return
+        if key not in self._listing_mtimes:
+            try:
+                self._listing_mtimes[key] = os.stat(key).st_mtime_ns
+            except OSError:
+                self._listing_mtimes[key] = None
+        for fingerprint in self._fingerprints:
+            fingerprint.listings[key] = self._listing_mtimes[key]
+
+
+class SnapshotFingerprint():
+    ''' Filesystem state read through a DirectorySnapshot: directory
+        modification times, entry types and file stats '''
+    def __init__(self, listings = None, entries = None, stats = None):
+        self.listings = listings or {}
+        self.entries = entries or {}
+        self.stats = stats or {}
+        # False if the filesystem was also read without the snapshot
+        self.is_complete = True
+
+    def is_valid(self):
+        ''' Checks that the filesystem still looks the same '''
+        for path, mtime in self.listings.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                if mtime is not None:
+                    return False
+        for path, entry in self.entries.items():
+            if _get_entry(path) != entry:
+                return False
+        for path, stat_state in self.stats.items():
+            try:
+                if _get_stat_state(os.stat(path)) != stat_state:
+                    return False
+            except OSError:
+                if stat_state is not None:
+                    return False
+        return True
+
+    def to_json(self):
+        ''' Returns a JSON serializable version of this fingerprint '''
+        return { 'listings': self.listings,
+                 'entries': { path: entry and list(entry) for path, entry in self.entries.items() },
+                 'stats': self.stats }
+
+    @staticmethod
+    def from_json(value):
+        ''' Loads a fingerprint returned by to_json '''
+        entries = { path: entry and DirectoryEntry(*entry) for path, entry in value['entries'].items() }
+        stats = { path: stat_state and tuple(stat_state) for path, stat_state in value['stats'].items() }
+        return SnapshotFingerprint(value['listings'], entries, stats)
+
+
+_SNAPSHOT = DirectorySnapshot()
+_SNAPSHOT_SCOPE_DEPTH = 0
+_SNAPSHOT_SCOPE_LOCK = threading.Lock()
+
+
+def get_snapshot():
+    ''' Returns the directory snapshot shared by this process '''
+    return _SNAPSHOT
+
+
+def reset_snapshot():
+    ''' Forgets everything known about the filesystem by this process '''
+    global _SNAPSHOT # pylint: disable = global-statement
+    _SNAPSHOT = DirectorySnapshot()
+
+
+def refresh_snapshot():
+    ''' Makes the directory snapshot shared by this process forget what it
+        knows, after files may have been modified without notifying it '''
+    _SNAPSHOT.refresh()
+
+
+@contextlib.contextmanager
+def snapshot_scope():
+    ''' Refreshes the shared directory snapshot when entering the outermost
+        scope, so that what was read in a scope is reused until its end, and
+        files written between two scopes are seen '''
+    global _SNAPSHOT_SCOPE_DEPTH # pylint: disable = global-statement
+    with _SNAPSHOT_SCOPE_LOCK:
+        if _SNAPSHOT_SCOPE_DEPTH == 0:
+            _SNAPSHOT.refresh()
+        _SNAPSHOT_SCOPE_DEPTH += 1
+    try:
+        yield _SNAPSHOT
+    finally:
+        with _SNAPSHOT_SCOPE_LOCK:
+            _SNAPSHOT_SCOPE_DEPTH -= 1
+
+
+def enable_snapshot_cache(cache_file_path):
+    ''' Reuses directory listings of previous runs saved to given file, and
+        saves them back when this process exits '''
+    if _SNAPSHOT._is_persistent: # pylint: disable = protected-access
+        return
+    logging.debug('Using directory snapshot cache %s', cache_file_path)
+    snapshot = _SNAPSHOT
+    snapshot.load(cache_file_path)
+    atexit.register(snapshot.save, cache_file_path)
+
+
+def invalidate(path):
+    ''' Notifies the directory snapshot that given path was modified '''
+    _SNAPSHOT.invalidate(path)
+
+
+def has_magic(path):
+    ''' Checks whether given path contains glob wildcards '''
+    return _MAGIC_CHECK.search(path) is not None
+
+
+# Directories listed at the same time by walk, directory listing is mostly
+# I/O latency bound on network shares
+WALK_THREAD_COUNT = 8
+
+
+def list_dir(path):
+    ''' Returns entries of given directory sorted by name '''
+    with os.scandir(path) as entries:
+        return sorted((DirectoryEntry(it.name, it.is_dir(), it.is_file(), it.is_symlink()) for it in entries),
+                      key = lambda it: it.name)
+
+
+def walk(top, snapshot = None, thread_count = WALK_THREAD_COUNT):
+    ''' Yields (relative path, DirectoryEntry) for all files and directories
+        below top, following symbolic links. Entries of a directory come in
+        alphabetical order, followed by the content of its subdirectories.
+        Subdirectories are listed ahead by a pool of threads. Listing errors
+        are raised, unless a snapshot is used. '''
+    list_function = snapshot.list_dir if snapshot is not None else list_dir
+    with concurrent.futures.ThreadPoolExecutor(max_workers = thread_count) as executor:
+        stack = [ ('', executor.submit(list_function, top)) ]
+        while stack:
+            relative_path, listing = stack.pop()
+            subdirectories = []
+            for entry in listing.result():
+                child_relative_path = os.path.join(relative_path, entry.name)
+                yield child_relative_path, entry
+                if entry.is_dir:
+                    child_listing = executor.submit(list_function, os.path.join(top, child_relative_path))
+                    subdirectories.append((child_relative_path, child_listing))
+            stack += reversed(subdirectories)
+
+
+def glob_many(glob_paths):
+    ''' Globs several patterns at once, and returns the matches of each of
+        them, like glob2.glob(glob_path, include_hidden = True) would.
+        Patterns sharing a base directory are matched while walking this
+        directory only once. '''
+    results = [ [] for _ in glob_paths ]
+    patterns_by_root = {}
+    for index, glob_path in enumerate(glob_paths):
+        if not has_magic(glob_path):
+            if get_snapshot().lexists(glob_path):
+                results[index].append(glob_path)
+            continue
+        pattern = _GlobPattern.compile(index, glob_path)
+        if pattern is None:
+            get_snapshot().record_untracked_access()
+            results[index] = [ str(it) for it in glob2.glob(glob_path, include_hidden = True) ]
+            continue
+        patterns_by_root.setdefault(pattern.root, []).append(pattern)
+
+    # Patterns whose base directory is inside another one's are rebased on it,
+    # so that this subtree is listed once
+    walk_roots = []
+    for root in sorted(patterns_by_root, key = len):
+        parent = next((it for it in walk_roots if _is_sub_path(root, it)), None)
+        if parent is None:
+            walk_roots.append(root)
+        else:
+            patterns_by_root[parent] += [ it.rebase(parent) for it in patterns_by_root.pop(root) ]
+
+    for root in walk_roots:
+        _walk_glob_root(root, patterns_by_root[root], results)
+    return results
+
+
+class _GlobPattern():
+    ''' A glob pattern split into a literal base directory, and components
+        matched while walking it '''
+    def __init__(self, index, root, components):
+        self.index = index
+        self.root = root
+        self.components = components
+        if _GLOBSTAR in components:
+            self.globstar_index = components.index(_GLOBSTAR)
+        else:
+            self.globstar_index = None
+
+        flags = 0 if _is_case_sensitive() else re.IGNORECASE
+        self.regex_source = _translate_components(components)
+        self.regex = re.compile(self.regex_source, flags)
+        prefix_length = len(components) if self.globstar_index is None else self.globstar_index
+        self.prefix_regexes = [ re.compile(it, flags) for it in components[:prefix_length] ]
+
+        # Like glob2, symbolic links are not followed while walking '**', but
+        # components following a '**' list them. To know where '**' matches
+        # end, capture them, as short as possible.
+        self.span_regex = re.compile(_translate_components(components, capture_globstars = True), flags)
+
+    @staticmethod
+    def compile(index, glob_path):
+        ''' Splits glob_path, returns None for patterns the walker can't handle
+            (trailing separators or relative components after wildcards) '''
+        if nimp.sys.platform.is_windows():
+            glob_path = glob_path.replace('/', '\\')
+        drive, path = os.path.splitdrive(glob_path)
+        parts = path.split(os.sep)
+        magic_index = next(idx for idx, part in enumerate(parts) if has_magic(part))
+
+        root_parts = parts[:magic_index]
+        root = os.sep if root_parts == [ '' ] else os.sep.join(root_parts)
+        components = parts[magic_index:]
+        if any(it in ('', '.', '..') for it in components):
+            return None
+        # glob2.glob ends up matching wildcard components ignoring case (its
+        # case_sensitive argument is shifted to None), while literal ones are
+        # checked on the file system
+        components = [ _GLOBSTAR if it == '**' else
+                       '(?i:%s)' % _translate_component(it) if has_magic(it) else re.escape(it)
+                       for it in components ]
+        return _GlobPattern(index, drive + root, components)
+
+    def rebase(self, root):
+        ''' Returns the same pattern, relative to a parent directory of its root '''
+        relative_root = os.path.relpath(self.root or os.curdir, root or os.curdir)
+        if relative_root == os.curdir:
+            return self
+        literal_components = [ re.escape(it) for it in relative_root.split(os.sep) ]
+        return _GlobPattern(self.index, root, literal_components + self.components)
+
+    def can_descend(self, components, link_depths):
+        ''' Checks whether files matching this pattern may be found below the
+            directory made of given components, reached through symbolic links
+            at given depths '''
+        depth = len(components) - 1
+        if self.globstar_index is None and depth >= len(self.components) - 1:
+            return False
+        # Each link after the first '**' has to end a '**' match, or to match
+        # another component, this also stops walking symbolic link loops
+        if len(self._get_globstar_link_depths(link_depths)) > len(self.components):
+            return False
+        for regex, component in zip(self.prefix_regexes, components):
+            if regex.fullmatch(component) is None:
+                return False
+        return True
+
+    def matches(self, relative_path, link_depths):
+        ''' Checks whether a path relative to the root matches this pattern '''
+        globstar_link_depths = self._get_globstar_link_depths(link_depths)
+        if not globstar_link_depths:
+            return self.regex.fullmatch(relative_path) is not None
+
+        match = self.span_regex.fullmatch(relative_path)
+        if match is None:
+            return False
+        for group_index in range(1, len(match.groups()) + 1):
+            # Links are fine at the last directory matched by '**'
+            start = relative_path.count('/', 0, match.start(group_index))
+            span = match.group(group_index)
+            end = start + len([ it for it in span.split('/') if it ]) - 1
+            if any(start <= it < end for it in globstar_link_depths):
+                return False
+        return True
+
+    def _get_globstar_link_depths(self, link_depths):
+        if self.globstar_index is None:
+            return ()
+        return [ it for it in link_depths if it >= self.globstar_index ]
+
+
+def _walk_glob_root(root, patterns, results):
+    flags = 0 if _is_case_sensitive() else re.IGNORECASE
+    any_match = re.compile('|'.join('(?:%s)' % it.regex_source for it in patterns), flags)
+
+    # Directories to list: components relative to root, and depths of the
+    # symbolic links followed to reach them
+    stack = [ ((), ()) ]
+    snapshot = get_snapshot()
+    while stack:
+        components, link_depths = stack.pop()
+        subdirectories = []
+        for entry in snapshot.list_dir(os.path.join(root or os.curdir, *components)):
+            child_components = components + (entry.name,)
+            relative_path = '/'.join(child_components)
+            if any_match.fullmatch(relative_path) is not None:
+                path = os.path.join(root, *child_components)
+                for pattern in patterns:
+                    if pattern.matches(relative_path, link_depths):
+                        results[pattern.index].append(path)
+
+            if not entry.is_dir:
+                continue
+            child_link_depths = link_depths + (len(components),) if entry.is_symlink else link_depths
+            if any(it.can_descend(child_components, child_link_depths) for it in patterns):
+                subdirectories.append((child_components, child_link_depths))
+
+        # Keep a deterministic order: directories are listed alphabetically
+        stack += reversed(subdirectories)
+
+
+def _translate_components(components, capture_globstars = False):
+    regex = ''
+    for index, component in enumerate(components):
+        is_last = index == len(components) - 1
+        if component is _GLOBSTAR and capture_globstars:
+            regex += '([^/]+(?:/[^/]+)*)' if is_last else '((?:[^/]+/)*?)'
+        elif component is _GLOBSTAR:
+            regex += '[^/]+(?:/[^/]+)*' if is_last else '(?:[^/]+/)*'
+        else:
+            regex += component if is_last else component + '/'
+    return regex
+
+
+def _translate_component(component):
+    ''' Translates a path component to a regular expression, like
+        fnmatch.translate, but without letting wildcards match separators '''
+    index, length, regex = 0, len(component), ''
+    while index < length:
+        char = component[index]
+        index += 1
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            end = index
+            if end < length and component[end] == '!':
+                end += 1
+            if end < length and component[end] == ']':
+                end += 1
+            while end < length and component[end] != ']':
+                end += 1
+            if end >= length:
+                regex += '\\['
+            else:
+                chars = component[index:end].replace('\\', '\\\\')
+                chars = re.sub('([&~|[])', r'\\\1', chars)
+                index = end + 1
+                if chars[0] == '!':
+                    chars = '^/' + chars[1:]
+                elif chars[0] == '^':
+                    chars = '\\' + chars
+                regex += '[%s]' % chars
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+def _is_sub_path(path, parent):
+    if os.path.isabs(path) != os.path.isabs(parent) or os.pardir in path.split(os.sep) + parent.split(os.sep):
+        return False
+    try:
+        relative_path = os.path.relpath(path or os.curdir, parent or os.curdir)
+    except ValueError:
+        return False
+    return relative_path != os.pardir and not relative_path.startswith(os.pardir + os.sep)
+
+
+def _get_entry(path):
+    try:
+        is_symlink = os.path.islink(path)
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            return DirectoryEntry(os.path.basename(path), False, False, True) if is_symlink else None
+        return DirectoryEntry(os.path.basename(path), stat.S_ISDIR(path_stat.st_mode),
+                              stat.S_ISREG(path_stat.st_mode), is_symlink)
+    except OSError:
+        return None
+
+
+def _get_stat_state(path_stat):
+    return (path_stat.st_mtime_ns, path_stat.st_size) if path_stat is not None else None
+
+
+def _get_snapshot_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _is_case_sensitive():
+    return not nimp.sys.platform.is_windows()
@@ -27,18 +27,37 @@ import logging
 import locale
 import os
 import os.path
+import select
+import selectors
 import struct
 import subprocess
+import tempfile
 import threading
 import time
 
+import nimp.sys.filesystem
 import nimp.sys.platform
 
 
+# The selector-based pump multiplexes child output on the calling thread;
+# Windows pipes can't be polled, so it falls back to one thread per pipe.
+_USE_SELECTOR_PUMP = not nimp.sys.platform.is_windows()
+
+_READ_CHUNK_SIZE = 65536
+
+# Captured output bigger than this is moved from memory to a temporary file
+SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+
 def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
          capture_output=False, capture_debug=False, hide_output=False,
-         dry_run=False, timeout=None):
-    ''' Calls a process redirecting its output to nimp's output '''
+         dry_run=False, timeout=None, spool_output=False):
+    ''' Calls a process redirecting its output to nimp's output
+
+        When capture_output is set, returns a tuple with the exit code, stdout
+        and stderr. These are strings, unless spool_output is also set, in
+        which case they are :class:`SpooledOutput` objects to be read line by
+        line and closed by the caller. '''
     command = _sanitize_command(command)
     if not hide_output:
         logging.info('%s "%s" in "%s"', '[DRY-RUN]' if dry_run else 'Running', command, os.path.abspath(cwd))
@@ -66,24 +85,249 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
         logging.error(ex)
         return 1
 
+    if not capture_output:
+        all_captures = [ None, None, None ]
+    elif spool_output:
+        all_captures = [ SpooledOutput(), SpooledOutput(), None ]
+    else:
+        all_captures = [ [], [], None ]
+
+    # Checked once per call: when nobody listens to child output, don't
+    # build one LogRecord per line, and don't even decode if not capturing.
+    logger = logging.getLogger('child_processes')
+    log_output = not hide_output and logger.isEnabledFor(logging.INFO) and logger.hasHandlers()
+    raw_handlers = _get_raw_output_handlers(logger) if log_output else None
+    decode = _get_block_decoder(encoding)
+
+    def _output_lines(index, data):
+        if all_captures[index] is None and not log_output:
+            return
+        text = decode(data)
+        if all_captures[index] is not None:
+            all_captures[index].append(text)
+        if log_output:
+            lines = text.split('\n')
+            if text.endswith('\n'):
+                lines.pop()
+            if '\r' in text:
+                lines = [ line.strip('\r') for line in lines ]
+            if raw_handlers:
+                _write_raw_lines(raw_handlers, lines)
+            else:
+                for line in lines:
+                    # Same as logger.info, minus the costly stack inspection
+                    logger.handle(logger.makeRecord(logger.name, logging.INFO, command[0], 0, line, None, None))
+
+    stdin_data = stdin.encode(encoding) if stdin is not None else None
+
+    try:
+        if debug_pipe is None and _USE_SELECTOR_PUMP:
+            exit_code = _selector_pump(process, command, stdin_data, heartbeat, timeout, _output_lines)
+        else:
+            exit_code = _thread_pump(process, command, stdin_data, heartbeat, timeout, debug_pipe, _output_lines)
+    except BaseException:
+        if spool_output:
+            all_captures[0].close()
+            all_captures[1].close()
+        raise
+    finally:
+        # The child process may have written anything
+        nimp.sys.filesystem.refresh_snapshot()
+
+    if not hide_output:
+        logging.info('Finished with exit code %d (0x%08x)', exit_code, exit_code)
+
+    if capture_output and spool_output:
+        return exit_code, all_captures[0], all_captures[1]
+    if capture_output:
+        return exit_code, ''.join(all_captures[0]), ''.join(all_captures[1])
+    return exit_code
+
+
+class SpooledOutput():
+    ''' Captured process output. It is kept in memory up to max_size bytes,
+        then moved to a temporary file, so that huge outputs can be parsed
+        line by line without ever being loaded as a whole. '''
+    def __init__(self, max_size = None):
+        self._file = tempfile.SpooledTemporaryFile(max_size = max_size if max_size is not None else SPOOL_MAX_SIZE,
+                                                   mode = 'w+', encoding = 'utf-8', newline = '\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        ''' Iterates over captured lines, line endings included '''
+        self._file.seek(0)
+        return iter(self._file)
+
+    def append(self, text):
+        ''' Adds text at the end of the captured output '''
+        self._file.write(text)
+
+    def read(self):
+        ''' Returns the whole captured output as a string '''
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        ''' Releases memory or removes the temporary file '''
+        self._file.close()
+
+    @property
+    def spilled(self):
+        ''' True if output was too big to stay in memory '''
+        return self._file._rolled # pylint: disable = protected-access
+
+
+def _get_raw_output_handlers(logger):
+    ''' Returns the handlers of the child process logger if they only ever
+        print the bare message, so lines can be written to their streams
+        without building log records; returns None otherwise (e.g. when
+        the summary handler or a log file handler is attached) '''
+    if logger.propagate or logger.filters:
+        return None
+    for handler in logger.handlers:
+        if type(handler) is not logging.StreamHandler or handler.filters: # pylint: disable = unidiomatic-typecheck
+            return None
+        if handler.level > logging.INFO or handler.formatter is None:
+            return None
+        if handler.formatter._fmt != '%(message)s': # pylint: disable = protected-access
+            return None
+    return list(logger.handlers)
+
+
+def _write_raw_lines(handlers, lines):
+    if not lines:
+        return
+    for handler in handlers:
+        data = handler.terminator.join(lines) + handler.terminator
+        handler.acquire()
+        try:
+            handler.stream.write(data)
+            handler.flush()
+        finally:
+            handler.release()
+
+
+def _get_block_decoder(decoding_format):
+    # Try to decode as UTF-8 with BOM first; if it fails, try CP850 on
+    # Windows, or UTF-8 with BOM and error substitution elsewhere. If
+    # it fails again, try CP850 with error substitution.
+    force_ascii = locale.getpreferredencoding().lower() != 'utf-8'
+    fallback_encodings = [
+        ('ascii', 'backslashreplace') if force_ascii else ('utf-8-sig', 'strict'),
+        ('cp850', 'strict') if nimp.sys.platform.is_windows() else ('utf-8-sig', 'replace'),
+        ('cp850', 'replace')
+    ]
+
+    def _decode_line(line):
+        for encoding, errors in fallback_encodings:
+            try:
+                return line.decode(encoding, errors=errors)
+            except UnicodeError:
+                pass
+        return ''
+
+    def _decode(data):
+        ''' Decodes a block of complete lines at once; only when the block
+            isn't valid for the requested encoding is each of its lines
+            decoded separately, so one bad line doesn't taint the others '''
+        try:
+            return data.decode(decoding_format)
+        except UnicodeError:
+            pass
+        lines = data.split(b'\n')
+        for index, line in enumerate(lines):
+            try:
+                lines[index] = line.decode(decoding_format)
+            except UnicodeError:
+                lines[index] = _decode_line(line)
+        return '\n'.join(lines)
+
+    return _decode
+
+
+def _selector_pump(process, command, stdin_data, heartbeat, timeout, output_lines):
+    ''' Forwards child output line by line from a single thread, waking up
+        only when a pipe is ready or when a heartbeat / timeout is due '''
+    now = time.monotonic()
+    deadline = now + timeout if timeout is not None else None
+    next_heartbeat = now + heartbeat if heartbeat > 0 else None
+
+    pending = {}
+    stdin_offset = 0
+    with selectors.DefaultSelector() as selector:
+        for index, pipe in enumerate([ process.stdout, process.stderr ]):
+            selector.register(pipe, selectors.EVENT_READ, index)
+            pending[index] = b''
+        if stdin_data is not None:
+            if stdin_data:
+                selector.register(process.stdin, selectors.EVENT_WRITE, None)
+            else:
+                process.stdin.close()
+
+        while selector.get_map():
+            wakeups = [ it for it in (deadline, next_heartbeat) if it is not None ]
+            wait_time = max(0, min(wakeups) - time.monotonic()) if wakeups else None
+
+            for key, _ in selector.select(wait_time):
+                if key.fileobj is process.stdin:
+                    chunk = stdin_data[stdin_offset:stdin_offset + select.PIPE_BUF]
+                    try:
+                        stdin_offset += os.write(key.fd, chunk)
+                    except BrokenPipeError:
+                        stdin_offset = len(stdin_data)
+                    if stdin_offset >= len(stdin_data):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    continue
+
+                index = key.data
+                data = os.read(key.fd, _READ_CHUNK_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    if pending[index]:
+                        output_lines(index, pending[index])
+                    continue
+
+                # Only hand over complete lines so that neither a line nor a
+                # multi-byte character is split between two blocks
+                data = pending[index] + data
+                cut = data.rfind(b'\n') + 1
+                pending[index] = data[cut:]
+                if cut:
+                    output_lines(index, data[:cut])
+
+            now = time.monotonic()
+            if next_heartbeat is not None and now >= next_heartbeat:
+                logging.info("Keepalive for %s", command[0])
+                next_heartbeat += heartbeat
+            if deadline is not None and now >= deadline:
+                raise subprocess.TimeoutExpired(command, timeout)
+
+    return process.wait(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+def _thread_pump(process, command, stdin_data, heartbeat, timeout, debug_pipe, output_lines):
+    ''' Forwards child output using one reader thread per pipe '''
     if debug_pipe:
         debug_pipe.attach(process.pid)
         debug_pipe.start()
 
-    # FIXME: put all this in a class instead!
     all_pipes = [ process.stdout,
                   process.stderr,
                   debug_pipe.output if debug_pipe else None ]
 
-    all_captures = [ [] if capture_output else None,
-                     [] if capture_output else None,
-                     None ]
-
     debug_info = [ False ]
+    running = [ True ]
 
     def _heartbeat_worker(heartbeat):
         last_time = time.monotonic()
-        while process is not None:
+        while running[0]:
             if heartbeat > 0 and time.monotonic() > last_time + heartbeat:
                 logging.info("Keepalive for %s", command[0])
                 last_time += heartbeat
@@ -93,34 +337,12 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
         in_pipe.write(data)
         in_pipe.close()
 
-    def _output_worker(index, decoding_format):
+    def _output_worker(index):
         in_pipe = all_pipes[index]
-        capture_array = all_captures[index]
         if in_pipe is None:
             return
-        force_ascii = locale.getpreferredencoding().lower() != 'utf-8'
-        while process is not None:
-            logger = logging.getLogger('child_processes')
-            # Try to decode as UTF-8 with BOM first; if it fails, try CP850 on
-            # Windows, or UTF-8 with BOM and error substitution elsewhere. If
-            # it fails again, try CP850 with error substitution.
-            encodings = [
-                (decoding_format, 'strict'),
-                ('ascii', 'backslashreplace') if force_ascii else ('utf-8-sig', 'strict'),
-                ('cp850', 'strict') if nimp.sys.platform.is_windows() else ('utf-8-sig', 'replace'),
-                ('cp850', 'replace')
-            ]
+        while running[0]:
             for data in iter(in_pipe.readline, b''):
-                for encoding, errors in encodings:
-                    try:
-                        line = data.decode(encoding, errors=errors)
-                        break
-                    except UnicodeError:
-                        pass
-
-                if capture_array is not None:
-                    capture_array.append(line)
-
                 # Stop reading data from stdout if data has arrived on OutputDebugString
                 if index == 2:
                     debug_info[0] = True
@@ -129,20 +351,18 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
                     all_pipes[0].close()
                     return
 
-                if not hide_output:
-                    logger.info(line.strip('\n').strip('\r'))
+                output_lines(index, data)
 
             # Sleep for 10 milliseconds if there was no data,
             # or we’ll hog the CPU.
             time.sleep(0.010)
 
-
     # Default threads
-    all_workers = [threading.Thread(target=_output_worker, args=(i, encoding)) for i in range(3)]
+    all_workers = [threading.Thread(target=_output_worker, args=(i, )) for i in range(3)]
 
     # Thread to feed stdin data if necessary
-    if stdin is not None:
-        all_workers.append(threading.Thread(target=_input_worker, args=(process.stdin, stdin.encode(encoding))))
+    if stdin_data is not None:
+        all_workers.append(threading.Thread(target=_input_worker, args=(process.stdin, stdin_data)))
 
     # Send keepalive to stderr if requested
     if heartbeat > 0:
@@ -154,20 +374,14 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
     try:
         exit_code = process.wait(timeout)
     finally:
-        process = None
+        running[0] = False
         # For some reason, must be done _before_ threads are joined, or
         # we get stuck waiting for something!
         if debug_pipe:
             debug_pipe.stop()
-            debug_pipe = None
         for thread in all_workers:
             thread.join()
 
-    if not hide_output:
-        logging.info('Finished with exit code %d (0x%08x)', exit_code, exit_code)
-
-    if capture_output:
-        return exit_code, ''.join(all_captures[0]), ''.join(all_captures[1])
     return exit_code
 
 
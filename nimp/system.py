@@ -22,20 +22,25 @@
 
 ''' System utilities (paths, processes) '''
 
+import concurrent.futures
+import errno
 import fnmatch
+import hashlib
 import json
 import logging
 import os
 import re
 import shutil
 import stat
+import sys
 import time
+import types
 import importlib
 import pkg_resources
 
-import glob2
-
 import nimp.environment
+import nimp.sys.content_hash
+import nimp.sys.filesystem
 import nimp.sys.platform
 import nimp.sys.process
 
@@ -76,6 +81,7 @@ def try_remove(file_path, dry_run):
                     os.remove(file_path)
             except OSError as exception:
                 logging.warning("Failed to remove %s: %s", file_path, exception)
+            nimp.sys.filesystem.invalidate(file_path)
 
 def split_path(path):
     ''' Returns an array of path elements '''
@@ -121,7 +127,10 @@ def safe_rmtree(path):
     def remove_readonly(func, path, excinfo):
         os.chmod(path, stat.S_IWRITE)
         func(path)
-    shutil.rmtree(path, onerror=remove_readonly)
+    try:
+        shutil.rmtree(path, onerror=remove_readonly)
+    finally:
+        nimp.sys.filesystem.invalidate(path)
 
 
 def safe_makedirs(path):
@@ -132,6 +141,7 @@ def safe_makedirs(path):
 
     try:
         os.makedirs(path)
+        nimp.sys.filesystem.invalidate(path)
     except FileExistsError:
         # Maybe someone else created the directory for us; if so, ignore error
         if os.path.exists(path):
@@ -167,6 +177,7 @@ def robocopy(src, dest, ignore_older=False, preserve_metadata=True):
                 copy_function = shutil.copy2 if preserve_metadata else shutil.copy
                 copy_function(src, dest)
                 os.chmod(dest, stat.S_IRWXU)
+                nimp.sys.filesystem.invalidate(dest)
                 break
             except IOError as ex:
                 logging.warning('I/O error %s : %s', ex.errno, ex.strerror)
@@ -185,6 +196,86 @@ def robocopy(src, dest, ignore_older=False, preserve_metadata=True):
 
     return True
 
+# Files copied at the same time by copy_files, copies to and from network
+# shares are mostly latency bound
+COPY_THREAD_COUNT = 8
+
+
+def copy_files(file_collection, preserve_metadata = False, thread_count = COPY_THREAD_COUNT,
+               attempt_maximum = 3, retry_delay = 5):
+    ''' Copies (source, destination) pairs with a pool of threads. Directories
+        in the collection are created, destination directories are created
+        first, each file copy is retried after I/O errors. Returns the number
+        of copied bytes. '''
+    file_collection = list(file_collection)
+    directory_collection = set()
+    copy_collection = []
+    for source, destination in file_collection:
+        if os.path.isdir(source):
+            directory_collection.add(destination)
+        else:
+            directory_collection.add(os.path.dirname(destination))
+            copy_collection.append((source, destination))
+    # Parent directories are created along with their children
+    directory_collection.discard('')
+    for directory in sorted(directory_collection, reverse = True):
+        if not os.path.isdir(directory):
+            safe_makedirs(directory)
+
+    def _copy(source, destination):
+        logging.debug('Copying "%s" to "%s"', source, destination)
+        def _copy_once():
+            _copy_file_data(source, destination)
+            if preserve_metadata:
+                shutil.copystat(source, destination)
+            return os.path.getsize(destination)
+        return try_execute(_copy_once, OSError, attempt_maximum = attempt_maximum, retry_delay = retry_delay)
+
+    start_time = time.monotonic()
+    copied_size = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = thread_count) as executor:
+            for size in executor.map(lambda it: _copy(*it), copy_collection):
+                copied_size += size
+    finally:
+        # Invalidating each file would scan the directory snapshot as often
+        for directory in directory_collection:
+            nimp.sys.filesystem.invalidate(directory)
+
+    duration = max(time.monotonic() - start_time, 0.001)
+    logging.info('Copied %s files (%.1f MiB) in %.1fs, %.1f MiB/s', len(copy_collection),
+                 copied_size / (1024 * 1024), duration, copied_size / (1024 * 1024) / duration)
+    return copied_size
+
+
+def _copy_file_data(source, destination):
+    ''' Copies file content, letting the kernel do it on Linux, where
+        copy_file_range can clone or copy server side '''
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(source, destination)
+        return
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        remaining_size = os.fstat(source_file.fileno()).st_size
+        copied_size = 0
+        try:
+            while remaining_size > 0:
+                size = os.copy_file_range(source_file.fileno(), destination_file.fileno(), min(remaining_size, 1 << 30))
+                if size == 0:
+                    break
+                copied_size += size
+                remaining_size -= size
+        except OSError as exception:
+            # Not supported by this kernel or across these filesystems
+            if copied_size > 0 or exception.errno not in [ errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP ]:
+                raise
+        if remaining_size > 0 or copied_size == 0:
+            # Fall back to sendfile or buffered copies, which also handle
+            # files whose size isn't known in advance
+            source_file.seek(copied_size)
+            destination_file.seek(copied_size)
+            shutil.copyfileobj(source_file, destination_file)
+
+
 def safe_delete(path):
     ''' 'Robust' delete. '''
 
@@ -196,6 +287,7 @@ def safe_delete(path):
             os.remove(path)
         except OSError:
             pass
+        nimp.sys.filesystem.invalidate(path)
 
 
 def all_map(mapper, fileset):
@@ -229,6 +321,10 @@ def map_files(env):
     def _default_mapper(_, dest):
         yield (env.root_dir if ctx[0].root_based else None, dest)
 
+    if getattr(env, 'cache_directory_snapshot', False):
+        cache_file_path = os.path.join(env.root_dir, '.nimp', 'cache', 'directory_snapshot.json')
+        nimp.sys.filesystem.enable_snapshot_cache(cache_file_path)
+
     ret = FileMapper(_default_mapper, format_args = vars(env))
     ctx[0] = ret
     return ret
@@ -243,22 +339,67 @@ class FileMapper():
         self._mapper = mapper
         self._next = []
         self._format_args = format_args if format_args is not None else {}
+        # Plain dictionaries may be modified in place, only the attributes of
+        # environments are tracked by format caches
+        self._format_cache = None
+        if nimp.environment.is_environment_attributes(self._format_args):
+            self._format_cache = nimp.environment.FormatCache()
+        # True for nodes whose output depends on the order of their input
+        self._is_order_sensitive = False
+        # Filesets loaded on this node, and whether they depend on the time
+        self._loaded_sets = []
         # True for legacy mode: filesets are relative to {root_dir}, not current directory
         # Newer filesets should explicitly use {root_dir} or {unreal_dir} etc.
         self.root_based = True
 
     def __call__(self, src = None, dest = None):
+        return self._evaluate_in_scope(src, dest, None)
+
+    def stream(self, src = None, dest = None):
+        ''' Same as calling this mapper, but yields files as they are found
+            instead of sorting them at each node. Use it when the caller sorts
+            results itself or doesn't care about their order.
+        '''
+        return self._evaluate_in_scope(src, dest, self._get_ordered_nodes())
+
+    def _evaluate_in_scope(self, src, dest, ordered_nodes):
+        # The directory snapshot is only trusted during an evaluation, files
+        # may have been written by any means since the previous one
+        with nimp.sys.filesystem.snapshot_scope():
+            yield from self._evaluate(src, dest, ordered_nodes)
+
+    def _evaluate(self, src, dest, ordered_nodes):
         results = self._mapper(src, dest) if self._mapper else [(src, dest)]
-        for result in sorted(results, key = lambda t: t[1] or t[0] or ""):
+        if ordered_nodes is None or self in ordered_nodes:
+            results = sorted(results, key = lambda t: t[1] or t[0] or "")
+        for result in results:
             for next_mapper in self._next:
-                for next_result in next_mapper(*result):
-                    yield next_result
+                # pylint: disable=protected-access
+                yield from next_mapper._evaluate(*result, ordered_nodes)
             # Only test the left element because some filemappers only worry about source
             if not self._next and result[0] is not None:
                 yield result
 
+    def _get_ordered_nodes(self):
+        ''' Returns nodes that have to keep sorting their results when
+            streaming, because an order-sensitive node (like once()) follows
+            them.
+        '''
+        ordered_nodes = set()
+        def _visit(node):
+            # pylint: disable=protected-access
+            is_order_sensitive = node._is_order_sensitive
+            for next_mapper in node._next:
+                if _visit(next_mapper):
+                    ordered_nodes.add(node)
+                    is_order_sensitive = True
+            return is_order_sensitive
+        _visit(self)
+        return ordered_nodes
+
     def glob(self, *patterns):
         ''' Globs given patterns, feedding the resulting files '''
+        formatted_patterns = [ self._format(pattern) for pattern in patterns ]
         def _glob_mapper(src, dest):
             src = sanitize_path(src)
             dest = sanitize_path(dest)
@@ -267,17 +408,14 @@ class FileMapper():
             else:
                 source_path_len = len(split_path(src))
 
-            for pattern in patterns:
-                found = False
-                pattern = self._format(pattern)
-                if src is None:
-                    glob_path = pattern
-                else:
-                    glob_path = os.path.join(src, pattern)
+            if src is None:
+                glob_paths = formatted_patterns
+            else:
+                glob_paths = [ os.path.join(src, pattern) for pattern in formatted_patterns ]
 
-                for glob_source in glob2.glob(glob_path, include_hidden=True):
-                    found = True
-                    glob_source = str(glob_source)
+            all_glob_sources = nimp.sys.filesystem.glob_many(glob_paths)
+            for pattern, glob_path, glob_sources in zip(formatted_patterns, glob_paths, all_glob_sources):
+                for glob_source in glob_sources:
                     # This is merely equivalent to os.path.relpath(src, self._source_path)
                     # except it will handle globs pattern in the base path.
                     glob_source = os.path.normpath(glob_source)
@@ -290,7 +428,7 @@ class FileMapper():
                         new_dest = None
 
                     yield (glob_source, new_dest)
-                if not found:
+                if not glob_sources:
                     logging.info('No match for "%s" in "%s" (aka. "%s")', pattern, src, glob_path)
         return self.append(_glob_mapper)
 
@@ -320,7 +458,9 @@ class FileMapper():
         if set_module is None:
             raise ModuleNotFoundError(f"No module named 'filesets.{set_module_name}'")
 
+        strftime_count = nimp.environment.get_strftime_count()
         set_module.map(self)
+        self._loaded_sets.append((set_module, nimp.environment.get_strftime_count() != strftime_count))
         return self.get_leaves()
 
     def get_leaves(self):
@@ -358,21 +498,25 @@ class FileMapper():
         return self._exclude(True, *patterns)
 
     def _exclude(self, ignore_case, *patterns):
+        # Same as calling fnmatch.fnmatch with each pattern, in a single match
+        patterns = [ os.path.normcase(self._format(pattern)) for pattern in patterns ]
+        if ignore_case:
+            patterns = [ pattern.lower() for pattern in patterns ]
+        patterns = dict.fromkeys(patterns)
+        exclude_regex = re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns) or '(?!)')
+
         def _exclude_mapper(src, dest):
-            for pattern in patterns:
-                pattern = self._format(pattern)
-                real_src = src.lower() if ignore_case else src
-                real_pattern = pattern.lower() if ignore_case else pattern
-                if fnmatch.fnmatch(real_src, real_pattern):
-                    logging.debug("Excluding file %s", src)
-                    return
+            real_src = os.path.normcase(src)
+            if exclude_regex.match(real_src.lower() if ignore_case else real_src):
+                logging.debug("Excluding file %s", src)
+                return
             yield (src, dest)
         return self.append(_exclude_mapper)
 
     def files(self):
         ''' Discards directories from processed paths '''
         def _files_mapper(src, dest):
-            if os.path.isfile(src):
+            if nimp.sys.filesystem.get_snapshot().isfile(src):
                 yield (src, dest)
         return self.append(_files_mapper)
 
@@ -400,7 +544,10 @@ class FileMapper():
                 processed_files.add(src)
                 yield (src, dest)
 
-        return self.append(_once_mapper)
+        next_mapper = self.append(_once_mapper)
+        # The first destination found for each source is kept
+        next_mapper._is_order_sensitive = True # pylint: disable=protected-access
+        return next_mapper
 
     def newer(self):
         ''' Ignore files when source is newer than destination.
@@ -408,13 +555,35 @@ class FileMapper():
         def _newer_mapper(src, dest):
             if src is None or dest is None:
                 raise Exception("newer() called on empty fileset")
-            if not os.path.exists(dest):
+            snapshot = nimp.sys.filesystem.get_snapshot()
+            if not snapshot.exists(dest):
                 yield (src, dest)
-            elif os.path.getmtime(src) > os.path.getmtime(dest):
+            elif snapshot.getmtime(src) > snapshot.getmtime(dest):
                 yield (src, dest)
 
         return self.append(_newer_mapper)
 
+    def changed(self):
+        ''' Ignore files when destination has the same content as source.
+            Content hashes are kept in the workspace, so that unchanged files
+            are only read again if their size or modification time changed.
+        '''
+        if 'root_dir' in self._format_args:
+            cache_file_path = os.path.join(self._format_args['root_dir'], '.nimp', 'cache', 'content_hashes.json')
+            nimp.sys.content_hash.enable_index_cache(cache_file_path)
+
+        def _changed_mapper(src, dest):
+            if src is None or dest is None:
+                raise Exception("changed() called on empty fileset")
+            snapshot = nimp.sys.filesystem.get_snapshot()
+            # Directories have no content, they are always kept
+            if not snapshot.isfile(src) or not snapshot.isfile(dest):
+                yield (src, dest)
+            elif not nimp.sys.content_hash.get_index().is_same_content(src, dest, snapshot):
+                yield (src, dest)
+
+        return self.append(_changed_mapper)
+
     def recursive(self):
         ''' Recurvively list all children of processed source if it is a
             directory.
@@ -423,15 +592,15 @@ class FileMapper():
             if src is None:
                 raise Exception("recursive() called on empty fileset")
             yield (src, dest)
-            if os.path.isdir(src):
-                for file in os.listdir(src):
-                    child_source = os.path.normpath(os.path.join(src, file))
+            snapshot = nimp.sys.filesystem.get_snapshot()
+            if snapshot.isdir(src):
+                for relative_path, _ in nimp.sys.filesystem.walk(src, snapshot):
+                    child_source = os.path.normpath(os.path.join(src, relative_path))
                     if dest is not None:
-                        child_dest = os.path.normpath(os.path.join(dest, file))
+                        child_dest = os.path.normpath(os.path.join(dest, relative_path))
                     else:
-                        child_dest = os.path.normpath(file)
-                    for child_source, child_destination in _recursive_mapper(child_source, child_dest):
-                        yield (child_source, child_destination)
+                        child_dest = os.path.normpath(relative_path)
+                    yield (child_source, child_dest)
         return self.append(_recursive_mapper)
 
     def replace(self, pattern, repl, flags = 0):
@@ -474,9 +643,9 @@ class FileMapper():
         ''' Formats given string using format arguments defined on all the
             nodes of the list.
         '''
-        result = fmt.format(**self._format_args)
-        result = time.strftime(result)
-        return result
+        if self._format_cache is None:
+            return nimp.environment.interpolate(fmt, self._format_args)
+        return self._format_cache.format(fmt, self._format_args)
 
     def __getattr__(self, name):
         ''' Usefull to simply retrieve format arguments, in config files for example.
@@ -489,9 +658,64 @@ class FileMapper():
     def to_list(self, mapper_source = None, mapper_destination = None):
         ''' Helper to execute a file mapper and organize the result '''
         default_result = [(standardize_path(mapper_source), standardize_path(mapper_destination))]
-        all_files = self(mapper_source, mapper_destination)
-        all_files = list(sorted(set(((standardize_path(src), standardize_path(dest)) for src, dest in all_files))))
-        return all_files if all_files != default_result else []
+
+        # Filesets results can be cached across runs, see _get_list_cache_key
+        cache_key = self._get_list_cache_key(mapper_source, mapper_destination)
+        if cache_key is not None:
+            cache_env = types.SimpleNamespace(root_dir = self._format_args['root_dir'])
+            cached_list = load_cache(cache_env, 'filesets', cache_key)
+            if cached_list is not None:
+                fingerprint = nimp.sys.filesystem.SnapshotFingerprint.from_json(cached_list['fingerprint'])
+                if fingerprint.is_valid():
+                    logging.debug('Reusing cached files list')
+                    return [ tuple(it) for it in cached_list['files'] ]
+
+        strftime_count = nimp.environment.get_strftime_count()
+        with nimp.sys.filesystem.get_snapshot().record() as fingerprint:
+            all_files = self.stream(mapper_source, mapper_destination)
+            all_files = sorted(set(((standardize_path(src), standardize_path(dest)) for src, dest in all_files)))
+        all_files = all_files if all_files != default_result else []
+
+        if cache_key is not None and fingerprint.is_complete and nimp.environment.get_strftime_count() == strftime_count:
+            save_cache(cache_env, 'filesets', cache_key, { 'fingerprint': fingerprint.to_json(), 'files': all_files })
+        return all_files
+
+    def _get_list_cache_key(self, mapper_source, mapper_destination):
+        ''' Returns the key of cached to_list results, or None if they can't
+            be cached: only filesets evaluated with cache_filesets set in the
+            configuration are. Results stay valid while fileset modules,
+            format arguments, and files and directories read through the
+            directory snapshot are unchanged.
+        '''
+        if not self._format_args.get('cache_filesets') or 'root_dir' not in self._format_args:
+            return None
+
+        all_nodes = []
+        def _visit(node):
+            all_nodes.append(node)
+            for next_mapper in node._next: # pylint: disable=protected-access
+                _visit(next_mapper)
+        _visit(self)
+        # pylint: disable=protected-access
+        loaded_sets = [ loaded_set for node in all_nodes for loaded_set in node._loaded_sets ]
+        if not loaded_sets or any(is_time_dependent for _, is_time_dependent in loaded_sets):
+            return None
+
+        # Filesets may use helper modules from their package
+        fileset_modules = { module for module, _ in loaded_sets }
+        fileset_modules.update(module for name, module in list(sys.modules.items())
+                               if 'filesets' in name.split('.') and getattr(module, '__file__', None))
+        fileset_modules.add(sys.modules[__name__])
+        module_hashes = {}
+        for module in fileset_modules:
+            with open(module.__file__, 'rb') as module_file:
+                module_hashes[module.__name__] = hashlib.sha1(module_file.read()).hexdigest()
+
+        # Format arguments hold some objects, only their type is considered
+        all_format_args = { id(node._format_args): node._format_args for node in all_nodes }
+        format_args = json.dumps(list(all_format_args.values()), sort_keys = True,
+                                 default = lambda value: type(value).__name__)
+        return [ module_hashes, format_args, os.path.abspath(mapper_source or '.'), mapper_source, mapper_destination ]
 
 def load_status(env):
     ''' Loads the workspace status '''
@@ -507,3 +731,30 @@ def save_status(env, status):
     status_file_path = os.path.join(env.root_dir, '.nimp', 'status.json')
     with open(status_file_path, 'w') as status_file:
         return json.dump(status, status_file, indent = 4)
+
+
+def load_cache(env, category, key):
+    ''' Loads a value stored by save_cache in the workspace cache, returns
+        None if there is none '''
+    try:
+        with open(_get_cache_file_path(env, category, key)) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(env, category, key, value):
+    ''' Stores a JSON serializable value in the workspace cache, so that other
+        nimp runs on this workspace can reuse it '''
+    cache_file_path = _get_cache_file_path(env, category, key)
+    safe_makedirs(os.path.dirname(cache_file_path))
+    # Write to a temporary file first, concurrent nimp runs may read this entry
+    temporary_file_path = '%s.%d.tmp' % (cache_file_path, os.getpid())
+    with open(temporary_file_path, 'w') as cache_file:
+        json.dump(value, cache_file)
+    os.replace(temporary_file_path, cache_file_path)
+
+
+def _get_cache_file_path(env, category, key):
+    key_hash = hashlib.sha1(json.dumps(key, sort_keys = True).encode('utf-8')).hexdigest()
+    return os.path.join(env.root_dir, '.nimp', 'cache', category, key_hash + '.json')
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Artifact unit tests '''
+
+import io
+import json
+import os
+import stat
+import tempfile
+import unittest
+import unittest.mock
+import zipfile
+import zlib
+
+import nimp.artifacts
+import nimp.sys.platform
+import nimp.tests.utils
+
+class _ArtifactTests(unittest.TestCase):
+
+    def test_create_archive(self):
+        ''' Archived artifacts should hold the content and mode of all files '''
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'source', 'directory'))
+            all_files = { 'small.txt': b'small', 'directory/large.bin': os.urandom(3 * 1024 * 1024) + b'0' * 1024 * 1024 }
+            for name, content in all_files.items():
+                with open(os.path.join(root, 'source', name), 'wb') as source_file:
+                    source_file.write(content)
+            os.chmod(os.path.join(root, 'source', 'small.txt'), 0o755)
+            file_collection = [ (os.path.join(root, 'source', 'directory'), 'directory') ]
+            file_collection += [ (os.path.join(root, 'source', name), name) for name in all_files ]
+
+            for compress in [ False, True ]:
+                artifact_path = os.path.join(root, 'artifact_%s' % compress)
+                nimp.artifacts.create_artifact(artifact_path, file_collection, True, compress, False)
+                with zipfile.ZipFile(artifact_path + '.zip') as archive_file:
+                    self.assertIsNone(archive_file.testzip())
+                    self.assertListEqual(archive_file.namelist(), list(all_files))
+                    for name, content in all_files.items():
+                        self.assertEqual(archive_file.read(name), content)
+                    if not nimp.sys.platform.is_windows():
+                        self.assertTrue(stat.S_IMODE(archive_file.getinfo('small.txt').external_attr >> 16) & stat.S_IXUSR)
+
+    def test_raw_archive_member(self):
+        ''' Raw members should be written like ZipFile does, this relies on
+            ZipFile internals which may change between Python versions '''
+        content = b'raw member' * 1024
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        compressed_content = compressor.compress(content) + compressor.flush()
+        archive_data = io.BytesIO()
+        with zipfile.ZipFile(archive_data, 'w', compression = zipfile.ZIP_DEFLATED) as archive_file:
+            archive_file.writestr('before.txt', 'before')
+            member_info = zipfile.ZipInfo('raw.txt')
+            member_info.compress_type = zipfile.ZIP_DEFLATED
+            member_info.file_size = len(content)
+            member_info.compress_size = len(compressed_content)
+            member_info.CRC = zlib.crc32(content)
+            with nimp.artifacts._open_raw_archive_member(archive_file, member_info) as member_stream: # pylint: disable = protected-access
+                member_stream.write(compressed_content)
+            archive_file.writestr('after.txt', 'after')
+        with zipfile.ZipFile(archive_data) as archive_file:
+            self.assertIsNone(archive_file.testzip())
+            self.assertListEqual(archive_file.namelist(), [ 'before.txt', 'raw.txt', 'after.txt' ])
+            self.assertEqual(archive_file.read('raw.txt'), content)
+            self.assertEqual(archive_file.read('after.txt'), b'after')
+
+    def test_install_archive(self):
+        ''' Archives and nested archives should be extracted while read '''
+        with tempfile.TemporaryDirectory() as root:
+            inner_archives = []
+            for index, compression in enumerate([ zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED ]):
+                inner_archive = io.BytesIO()
+                with zipfile.ZipFile(inner_archive, 'w', compression = compression) as archive_file:
+                    archive_file.writestr('inner%d/file.txt' % index, 'inner %d' % index)
+                    executable_info = zipfile.ZipInfo('inner%d/tool' % index)
+                    executable_info.create_system = 3
+                    executable_info.external_attr = 0o755 << 16
+                    archive_file.writestr(executable_info, '#!/bin/sh')
+                inner_archives.append(inner_archive.getvalue())
+
+            # Written to an unseekable stream, sizes follow the data of deflated members
+            class _UnseekableStream(io.RawIOBase):
+                def __init__(self, stream):
+                    self.stream = stream
+                def writable(self):
+                    return True
+                def write(self, data):
+                    return self.stream.write(data)
+            with open(os.path.join(root, 'package.zip'), 'wb') as package_file:
+                with zipfile.ZipFile(_UnseekableStream(package_file), 'w', compression = zipfile.ZIP_DEFLATED) as archive_file:
+                    for index, inner_archive in enumerate(inner_archives):
+                        archive_file.writestr('part%d.zip' % index, inner_archive)
+
+            nimp.artifacts.install_artifact_from_uri(root, os.path.join(root, 'package.zip'), os.path.join(root, 'workspace'))
+            for index in range(2):
+                with open(os.path.join(root, 'workspace', 'inner%d' % index, 'file.txt')) as installed_file:
+                    self.assertEqual(installed_file.read(), 'inner %d' % index)
+                if not nimp.sys.platform.is_windows():
+                    self.assertTrue(os.stat(os.path.join(root, 'workspace', 'inner%d' % index, 'tool')).st_mode & stat.S_IXUSR)
+            self.assertFalse(os.path.exists(os.path.join(root, 'workspace', 'part0.zip')))
+
+            # Corrupted members should be detected
+            with zipfile.ZipFile(os.path.join(root, 'corrupted.zip'), 'w') as archive_file:
+                archive_file.writestr('file.txt', 'content')
+            with open(os.path.join(root, 'corrupted.zip'), 'r+b') as archive_file:
+                archive_data = archive_file.read()
+                archive_file.seek(archive_data.index(b'content'))
+                archive_file.write(b'CONTENT')
+            with self.assertRaises(zipfile.BadZipFile):
+                nimp.artifacts.install_artifact_from_uri(root, os.path.join(root, 'corrupted.zip'), os.path.join(root, 'workspace'))
+
+    def test_install_mixed_archive(self):
+        ''' Archives should only be extracted if all members are archives,
+            even when that is only known once the archive was read '''
+        with tempfile.TemporaryDirectory() as root:
+            inner_archive = io.BytesIO()
+            with zipfile.ZipFile(inner_archive, 'w') as archive_file:
+                archive_file.writestr('x.txt', 'x')
+            os.makedirs(os.path.join(root, 'repository'))
+            with zipfile.ZipFile(os.path.join(root, 'repository', 'mixed.zip'), 'w') as archive_file:
+                archive_file.writestr('a.zip', inner_archive.getvalue())
+                archive_file.writestr('b.txt', 'b')
+            with zipfile.ZipFile(os.path.join(root, 'repository', 'package.zip'), 'w') as archive_file:
+                archive_file.writestr('a.zip', inner_archive.getvalue())
+
+            with nimp.tests.utils.serve_http(os.path.join(root, 'repository')) as (url, _):
+                for index, repository in enumerate([ os.path.join(root, 'repository') + '/', url ]):
+                    destination = os.path.join(root, 'workspace%d' % index)
+                    nimp.artifacts.install_artifact_from_uri(root, repository + 'mixed.zip', destination)
+                    self.assertListEqual(sorted(os.listdir(destination)), [ 'a.zip', 'b.txt' ])
+                    nimp.artifacts.install_artifact_from_uri(root, repository + 'package.zip', destination + '_package')
+                    self.assertListEqual(os.listdir(destination + '_package'), [ 'x.txt' ])
+
+    def test_http_install(self):
+        ''' HTTP downloads should be resumed after failures and be checked
+            against artifact hashes '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = { 'file%d.bin' % index: os.urandom(100 * 1024) for index in range(10) }
+            for name, content in all_files.items():
+                nimp.tests.utils.create_file(os.path.join(root, 'source', name), '')
+                with open(os.path.join(root, 'source', name), 'wb') as source_file:
+                    source_file.write(content)
+            os.makedirs(os.path.join(root, 'repository'))
+            file_collection = [ (os.path.join(root, 'source', name), name) for name in all_files ]
+            for archive in [ False, True ]:
+                artifact_path = os.path.join(root, 'repository', 'artifact_%s' % archive)
+                nimp.artifacts.create_artifact(artifact_path, file_collection, archive, True, False)
+            nimp.artifacts.create_hash(os.path.join(root, 'repository', 'artifact_True'), 'sha256', False)
+
+            def _check_installed(destination):
+                for name, content in all_files.items():
+                    with open(os.path.join(root, destination, name), 'rb') as installed_file:
+                        self.assertEqual(installed_file.read(), content, name)
+
+            with nimp.tests.utils.serve_http(os.path.join(root, 'repository')) as (url, _):
+                nimp.artifacts.install_artifact_from_uri(root, url + 'artifact_False', os.path.join(root, 'directory'), thread_count = 16)
+                _check_installed('directory')
+                # Each download thread should keep its pooled connection
+                adapter = nimp.artifacts._get_http_session().get_adapter(url) # pylint: disable = protected-access
+                self.assertGreaterEqual(adapter._pool_maxsize, 16) # pylint: disable = protected-access
+
+            with nimp.tests.utils.serve_http(os.path.join(root, 'repository'), failures = { '/artifact_True.zip': [ 50000, 200000 ] }) as (url, requests):
+                nimp.artifacts.install_artifact_from_uri(root, url + 'artifact_True.zip', os.path.join(root, 'archive'))
+                _check_installed('archive')
+                self.assertListEqual([ it for it in requests if it[0] == '/artifact_True.zip' ],
+                                     [ ('/artifact_True.zip', None), ('/artifact_True.zip', 'bytes=50000-'),
+                                       ('/artifact_True.zip', 'bytes=250000-') ])
+
+            with open(os.path.join(root, 'repository', 'artifact_True.zip.hash'), 'w') as hash_file:
+                json.dump({ 'sha256': '0' * 64 }, hash_file)
+            with nimp.tests.utils.serve_http(os.path.join(root, 'repository')) as (url, _):
+                with self.assertRaises(OSError):
+                    nimp.artifacts.install_artifact_from_uri(root, url + 'artifact_True.zip', os.path.join(root, 'archive'))
+
+    def test_artifact_index(self):
+        ''' Uploaded artifacts should be listed from the collection index,
+            which is first filled with the artifacts already there '''
+        with tempfile.TemporaryDirectory() as root:
+            nimp.tests.utils.create_file(os.path.join(root, 'source', 'file.txt'), 'content')
+            file_collection = [ (os.path.join(root, 'source', 'file.txt'), 'file.txt') ]
+            artifact_pattern = '{root}/repository/{fileset}_{revision}'
+            format_arguments = { 'root': root, 'fileset': 'binaries' }
+            os.makedirs(os.path.join(root, 'repository'))
+            for revision, archive in [ ('12', False), ('9', True), ('100', True) ]:
+                nimp.artifacts.create_artifact(os.path.join(root, 'repository', 'binaries_' + revision), file_collection, archive, False, False)
+            os.makedirs(os.path.join(root, 'repository', 'other_11'))
+
+            expected = nimp.artifacts.list_artifacts(artifact_pattern, format_arguments, None)
+            self.assertIsNone(nimp.artifacts.load_artifact_index(artifact_pattern.format(revision = '{revision}', **format_arguments)))
+            nimp.artifacts.update_artifact_index(artifact_pattern, format_arguments, '100', None, False)
+            nimp.artifacts.create_artifact(os.path.join(root, 'repository', 'binaries_101'), file_collection, True, False, False)
+            nimp.artifacts.create_hash(os.path.join(root, 'repository', 'binaries_101'), 'sha256', False)
+            index_path = nimp.artifacts.get_artifact_index_path(artifact_pattern.format(revision = '{revision}', **format_arguments))
+            with open(index_path) as index_file:
+                index_content = index_file.read()
+            nimp.artifacts.update_artifact_index(artifact_pattern, format_arguments, '101', None, False)
+            # New entries are appended
+            with open(index_path) as index_file:
+                self.assertTrue(index_file.read().startswith(index_content))
+
+            artifact_index = nimp.artifacts.load_artifact_index(artifact_pattern.format(revision = '{revision}', **format_arguments))
+            self.assertListEqual([ entry['name'] for entry in artifact_index ], [ 'binaries_9.zip', 'binaries_12/', 'binaries_100.zip', 'binaries_101.zip' ])
+            self.assertEqual(artifact_index[-1]['size'], os.path.getsize(os.path.join(root, 'repository', 'binaries_101.zip')))
+            self.assertListEqual(list(artifact_index[-1]['hash']), [ 'sha256' ])
+
+            with unittest.mock.patch('nimp.artifacts._list_files') as list_files:
+                all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, format_arguments, None)
+                list_files.assert_not_called()
+            self.assertListEqual(sorted((it['revision'], it['uri']) for it in all_artifacts),
+                                 sorted([ (it['revision'], it['uri']) for it in expected ]
+                                        + [ ('101', os.path.join(root, 'repository', 'binaries_101.zip').replace(os.sep, '/')) ]))
+
+            with nimp.tests.utils.serve_http(os.path.join(root, 'repository')) as (url, _):
+                all_artifacts = nimp.artifacts.list_artifacts(url + '{fileset}_{revision}', format_arguments, None)
+                self.assertListEqual([ it['uri'] for it in all_artifacts ], [ url + entry['name'] for entry in artifact_index ])
+
+            # Artifacts removed or added without updating the index
+            os.remove(os.path.join(root, 'repository', 'binaries_100.zip'))
+            nimp.artifacts.create_artifact(os.path.join(root, 'repository', 'binaries_102'), file_collection, True, False, False)
+            with nimp.tests.utils.serve_http(os.path.join(root, 'repository')) as (url, _):
+                self.assertFalse(nimp.artifacts.artifact_exists(url + 'binaries_100.zip'))
+                self.assertTrue(nimp.artifacts.artifact_exists(url + 'binaries_101.zip'))
+            self.assertIsNone(nimp.artifacts.load_artifact_index(artifact_pattern.format(revision = '{revision}', **format_arguments)))
+            all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, format_arguments, None)
+            self.assertListEqual(sorted(it['revision'] for it in all_artifacts), [ '101', '102', '12', '9' ])
+
+            # Stale indexes are rebuilt, keeping known sizes and hashes
+            nimp.artifacts.create_artifact(os.path.join(root, 'repository', 'binaries_103'), file_collection, True, False, False)
+            nimp.artifacts.update_artifact_index(artifact_pattern, format_arguments, '103', None, False)
+            artifact_index = nimp.artifacts.load_artifact_index(artifact_pattern.format(revision = '{revision}', **format_arguments))
+            self.assertListEqual([ entry['name'] for entry in artifact_index ],
+                                 [ 'binaries_9.zip', 'binaries_12/', 'binaries_101.zip', 'binaries_102.zip', 'binaries_103.zip' ])
+            self.assertListEqual(list(artifact_index[2]['hash']), [ 'sha256' ])
+
+            # Entries stay sorted when artifacts are uploaded out of order, or again
+            nimp.artifacts.create_artifact(os.path.join(root, 'repository', 'binaries_50'), file_collection, True, False, False)
+            for revision in [ '50', '103' ]:
+                nimp.artifacts.update_artifact_index(artifact_pattern, format_arguments, revision, None, False)
+            artifact_index = nimp.artifacts.load_artifact_index(artifact_pattern.format(revision = '{revision}', **format_arguments))
+            self.assertListEqual([ entry['name'] for entry in artifact_index ],
+                                 [ 'binaries_9.zip', 'binaries_12/', 'binaries_50.zip', 'binaries_101.zip', 'binaries_102.zip', 'binaries_103.zip' ])
+
+    def test_store_install(self):
+        ''' Files already in the store should not be downloaded again, and the
+            least recently used ones should be removed beyond the budget '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = { 'file%d.bin' % index: os.urandom(1024 * 1024) for index in range(10) }
+            file_collection = [ (os.path.join(root, 'source', name), os.path.join('directory', name)) for name in all_files ]
+            os.makedirs(os.path.join(root, 'repository'))
+
+            def _create_artifacts(name):
+                for source, _ in file_collection:
+                    nimp.tests.utils.create_file(source, '')
+                    with open(source, 'wb') as source_file:
+                        source_file.write(all_files[os.path.basename(source)])
+                for archive in [ False, True ]:
+                    nimp.artifacts.create_artifact(os.path.join(root, 'repository', '%s_%s' % (name, archive)), file_collection, archive, False, False)
+
+            def _check_installed(destination):
+                for name, content in all_files.items():
+                    with open(os.path.join(root, destination, 'directory', name), 'rb') as installed_file:
+                        self.assertEqual(installed_file.read(), content, name)
+
+            _create_artifacts('old')
+            with open(os.path.join(root, 'repository', 'old_True.zip.manifest.json')) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.assertListEqual([ entry['name'] for entry in manifest['files'] ], [ 'directory/' + name for name in all_files ])
+            store = nimp.artifacts.ArtifactStore(os.path.join(root, 'store'))
+            nimp.artifacts.install_artifact_from_uri(root, os.path.join(root, 'repository', 'old_True.zip'), os.path.join(root, 'old'), store = store)
+            _check_installed('old')
+
+            all_files['file3.bin'] = os.urandom(1024 * 1024)
+            _create_artifacts('new')
+            with nimp.tests.utils.serve_http(os.path.join(root, 'repository')) as (url, requests):
+                store = nimp.artifacts.ArtifactStore(os.path.join(root, 'store'), 0)
+                nimp.artifacts.install_artifact_from_uri(root, url + 'new_True.zip', os.path.join(root, 'archive'), store = store, use_links = True)
+                _check_installed('archive')
+                ranges = [ [ int(it) for it in byte_range[ len('bytes=') : ].split('-') ] for _, byte_range in requests if byte_range is not None ]
+                self.assertGreater(sum(end + 1 - start for start, end in ranges), len(all_files['file3.bin']))
+                self.assertLess(sum(end + 1 - start for start, end in ranges), os.path.getsize(os.path.join(root, 'repository', 'new_True.zip')) / 3)
+                if not nimp.sys.platform.is_windows():
+                    self.assertEqual(os.stat(os.path.join(root, 'archive', 'directory', 'file3.bin')).st_nlink, 2)
+
+                all_files['file5.bin'] = os.urandom(1024 * 1024)
+                _create_artifacts('newer')
+                del requests[:]
+                store = nimp.artifacts.ArtifactStore(os.path.join(root, 'store'), 0)
+                nimp.artifacts.install_artifact_from_uri(root, url + 'newer_False', os.path.join(root, 'directory'), store = store)
+                _check_installed('directory')
+                self.assertListEqual([ path for path, _ in requests if path.endswith('.bin') ], [ '/newer_False/directory/file5.bin' ])
+
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(os.path.join(root, 'store'))), len(all_files))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Loadlist creation unit tests '''
+
+import argparse
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import nimp.base_commands.create_loadlist
+
+class _FakeP4:
+    ''' Answers fstat with one file by requested changelist, except for
+        empty ones '''
+    def __init__(self, pending_changelists = (), empty_changelists = ()):
+        self.fstat_calls = []
+        self.pending_changelists = pending_changelists
+        self.empty_changelists = empty_changelists
+
+    def run_tagged(self, *args, **_):
+        if args[0] == 'info':
+            yield { 'serverAddress': 'perforce:1666', 'clientName': 'ws', 'clientRoot': '/p4root' }
+            return
+        if args[0] == 'describe':
+            for cl in args[4:]:
+                yield { 'change': cl, 'status': 'pending' if cl in self.pending_changelists else 'submitted' }
+            return
+        self.fstat_calls.append(args)
+        for filespec in args[3:]:
+            path, cl = filespec.split('@')[0], filespec.split(',')[-1]
+            if cl not in self.empty_changelists:
+                yield { 'clientFile': '/p4root/%s/%s' % (cl, path[-6:]), 'headChange': cl }
+
+class _CreateLoadlistTests(unittest.TestCase):
+
+    def test_fstat_cache(self):
+        ''' Files of already listed changelists should come from the cache '''
+        fake_p4 = _FakeP4()
+        command = nimp.base_commands.create_loadlist.CreateLoadlist()
+        with tempfile.TemporaryDirectory() as root_dir, \
+             unittest.mock.patch('nimp.utils.p4.get_client', return_value = fake_p4):
+            def _get_files(*changelists, slice_job_index = None, slice_job_count = None):
+                env = argparse.Namespace(root_dir = root_dir, changelists = list(changelists), dirs = [ '//ws/' ],
+                                         exclude_dirs = None, no_cache = False, dry_run = False,
+                                         slice_job_index = slice_job_index, slice_job_count = slice_job_count,
+                                         format = lambda it: it)
+                return command.get_modified_files(env, [ '.uasset' ])
+
+            files = [ os.path.normpath('/p4root/%s/uasset' % cl) for cl in [ '10', '11', '12' ] ]
+            self.assertListEqual(_get_files('10', '11'), files[:2])
+            self.assertListEqual(_get_files('10', '11', '12', slice_job_index = 1, slice_job_count = 2),
+                                 [ files[0], files[2] ])
+            self.assertListEqual(_get_files('10', '11', '12', slice_job_index = 2, slice_job_count = 2),
+                                 [ files[1] ])
+
+        self.assertListEqual(fake_p4.fstat_calls, [ ('fstat', '-F', '^headAction=delete & ^headAction=move/delete',
+                                                     '//ws/.uasset@10,10', '//ws/.uasset@11,11'),
+                                                    ('fstat', '-F', '^headAction=delete & ^headAction=move/delete',
+                                                     '//ws/.uasset@12,12') ])
+
+    def test_fstat_cache_submitted(self):
+        ''' Only files of submitted changelists should be cached, and empty
+            results should never be '''
+        fake_p4 = _FakeP4(pending_changelists = [ '11' ], empty_changelists = [ '12' ])
+        command = nimp.base_commands.create_loadlist.CreateLoadlist()
+        with tempfile.TemporaryDirectory() as root_dir, \
+             unittest.mock.patch('nimp.utils.p4.get_client', return_value = fake_p4):
+            env = argparse.Namespace(root_dir = root_dir, changelists = [ '10', '11', '12' ], dirs = [ '//ws/' ],
+                                     exclude_dirs = None, no_cache = False, dry_run = False,
+                                     slice_job_index = None, slice_job_count = None, format = lambda it: it)
+            for _ in range(2):
+                self.assertListEqual(command.get_modified_files(env, [ '.uasset' ]),
+                                     [ os.path.normpath('/p4root/%s/uasset' % cl) for cl in [ '10', '11' ] ])
+
+        self.assertListEqual([ call[3:] for call in fake_p4.fstat_calls ],
+                             [ ('//ws/.uasset@10,10', '//ws/.uasset@11,11', '//ws/.uasset@12,12'),
+                               ('//ws/.uasset@11,11', '//ws/.uasset@12,12') ])
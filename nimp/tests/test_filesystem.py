@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Filesystem utilities unit tests '''
+
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import glob2
+
+import nimp.sys.content_hash
+import nimp.sys.filesystem
+import nimp.sys.platform
+
+_TREE = [ 'Engine/Binaries/Win64/a.dll', 'Engine/Binaries/Win64/a.pdb', 'Engine/Binaries/Linux/.hidden',
+          'Engine/Plugins/P[1]/Binaries/Win64/b.dll', 'Game/Content/Maps/Map.umap', 'Game/c.txt',
+          'Game/Content/FOO.TXT', 'Game/Content/Maps/Other.UMAP' ]
+
+_PATTERNS = [ '**', '**/*.dll', 'Engine/**/*.pdb', '*/Binaries/*/*', 'Engine/Plugins/*/Binaries/**',
+              '**/Win64/*', '[EG]*/[!B]*', '**/.hidden', 'Engine/Plugins/P[[]1]/**', 'Game/c.txt',
+              'Game/missing', 'Engine/Binaries/../*', 'Game/**/', '**/*.txt', '**/*.Umap',
+              'game/*/maps/*', '*/content/*', '*/Content/foo.txt', '[eg]AME/**/M*' ]
+
+class _GlobTests(unittest.TestCase):
+
+    def test_glob_many(self):
+        ''' Globbing several patterns at once should match like glob2 '''
+        with tempfile.TemporaryDirectory() as root:
+            for path in _TREE:
+                os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok = True)
+                open(os.path.join(root, path), 'w').close()
+            if not nimp.sys.platform.is_windows():
+                os.symlink(os.path.join(root, 'Game'), os.path.join(root, 'Engine', 'GameLink'))
+
+            glob_paths = [ os.path.join(root, it) for it in _PATTERNS ]
+            for glob_path, matches in zip(glob_paths, nimp.sys.filesystem.glob_many(glob_paths)):
+                expected = glob2.glob(glob_path, include_hidden = True)
+                self.assertListEqual(sorted(os.path.normpath(it) for it in matches),
+                                     sorted(os.path.normpath(str(it)) for it in expected), glob_path)
+
+class _DirectorySnapshotTests(unittest.TestCase):
+
+    def test_snapshot(self):
+        ''' Snapshots should list directories once, until invalidated '''
+        with tempfile.TemporaryDirectory() as root:
+            open(os.path.join(root, 'a.txt'), 'w').close()
+            os.mkdir(os.path.join(root, 'b'))
+            snapshot = nimp.sys.filesystem.DirectorySnapshot()
+            self.assertListEqual([ it.name for it in snapshot.list_dir(root) ], [ 'a.txt', 'b' ])
+            self.assertTrue(snapshot.isfile(os.path.join(root, 'a.txt')))
+            self.assertTrue(snapshot.isdir(os.path.join(root, 'b')))
+            self.assertFalse(snapshot.exists(os.path.join(root, 'c.txt')))
+
+            open(os.path.join(root, 'c.txt'), 'w').close()
+            self.assertFalse(snapshot.exists(os.path.join(root, 'c.txt')))
+            snapshot.invalidate(os.path.join(root, 'c.txt'))
+            self.assertTrue(snapshot.isfile(os.path.join(root, 'c.txt')))
+
+    def test_snapshot_cache(self):
+        ''' Saved listings should only be reused if their directory didn't change '''
+        with tempfile.TemporaryDirectory() as root:
+            cache_file_path = os.path.join(root, 'cache', 'snapshot.json')
+            os.mkdir(os.path.join(root, 'a'))
+            os.mkdir(os.path.join(root, 'b'))
+            snapshot = nimp.sys.filesystem.DirectorySnapshot()
+            snapshot.load(cache_file_path)
+            snapshot.list_dir(os.path.join(root, 'a'))
+            snapshot.list_dir(os.path.join(root, 'b'))
+            snapshot.save(cache_file_path)
+
+            # Make 'a' look unchanged, while 'b' really changed
+            a_stat = os.stat(os.path.join(root, 'a'))
+            open(os.path.join(root, 'a', 'hidden_from_cache'), 'w').close()
+            os.utime(os.path.join(root, 'a'), ns = (a_stat.st_atime_ns, a_stat.st_mtime_ns))
+            open(os.path.join(root, 'b', 'new'), 'w').close()
+
+            snapshot = nimp.sys.filesystem.DirectorySnapshot()
+            snapshot.load(cache_file_path)
+            self.assertListEqual(snapshot.list_dir(os.path.join(root, 'a')), [])
+            self.assertListEqual([ it.name for it in snapshot.list_dir(os.path.join(root, 'b')) ], [ 'new' ])
+
+    def test_snapshot_refresh_while_walking(self):
+        ''' Snapshots should be refreshed safely while walk threads fill them '''
+        with tempfile.TemporaryDirectory() as root:
+            for index in range(64):
+                os.makedirs(os.path.join(root, str(index), 'sub'))
+            with unittest.mock.patch.object(nimp.sys.filesystem, '_SNAPSHOT', nimp.sys.filesystem.DirectorySnapshot()):
+                walker = threading.Thread(target = lambda: list(nimp.sys.filesystem.walk(root, thread_count = 8)))
+                walker.start()
+                while walker.is_alive():
+                    nimp.sys.filesystem.refresh_snapshot()
+                    nimp.sys.filesystem.invalidate(os.path.join(root, '0'))
+                walker.join()
+                self.assertEqual(len(list(nimp.sys.filesystem.walk(root))), 128)
+
+class _WalkTests(unittest.TestCase):
+
+    def test_walk(self):
+        ''' Walking a tree with several threads should give a stable order '''
+        with tempfile.TemporaryDirectory() as root:
+            for path in _TREE:
+                os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok = True)
+                open(os.path.join(root, path), 'w').close()
+
+            expected = sorted(os.path.relpath(os.path.join(directory, name), root)
+                              for directory, dirs, files in os.walk(root) for name in dirs + files)
+            for thread_count in [ 1, 4 ]:
+                walked = [ (path, entry.is_dir) for path, entry in nimp.sys.filesystem.walk(root, thread_count = thread_count) ]
+                self.assertListEqual(sorted(path for path, _ in walked), expected)
+                self.assertListEqual(walked[:2], [ ('Engine', True), ('Game', True) ])
+                self.assertIn((os.path.join('Game', 'c.txt'), False), walked)
+                self.assertListEqual(walked, [ (path, entry.is_dir) for path, entry in nimp.sys.filesystem.walk(root) ])
+
+class _ContentHashTests(unittest.TestCase):
+
+    def test_content_hash_index(self):
+        ''' Files should only be hashed again if their size or modification
+            time changed, including in later runs '''
+        with tempfile.TemporaryDirectory() as root:
+            cache_file_path = os.path.join(root, 'cache', 'hashes.json')
+            for name, content in [ ('a', 'same'), ('b', 'same'), ('c', 'diff') ]:
+                with open(os.path.join(root, name), 'w') as content_file:
+                    content_file.write(content)
+            index = nimp.sys.content_hash.ContentHashIndex()
+            snapshot = nimp.sys.filesystem.DirectorySnapshot()
+            self.assertTrue(index.is_same_content(os.path.join(root, 'a'), os.path.join(root, 'b'), snapshot))
+            self.assertFalse(index.is_same_content(os.path.join(root, 'a'), os.path.join(root, 'c'), snapshot))
+            self.assertFalse(index.is_same_content(os.path.join(root, 'a'), os.path.join(root, 'd'), snapshot))
+            index.save(cache_file_path)
+
+            index = nimp.sys.content_hash.ContentHashIndex()
+            index.load(cache_file_path)
+            with unittest.mock.patch('nimp.sys.content_hash._create_hash') as create_hash:
+                self.assertTrue(index.is_same_content(os.path.join(root, 'a'), os.path.join(root, 'b'), snapshot))
+                create_hash.assert_not_called()
+
+            with open(os.path.join(root, 'b'), 'w') as content_file:
+                content_file.write('else')
+            os.utime(os.path.join(root, 'b'), ns = (0, 0))
+            self.assertFalse(index.is_same_content(os.path.join(root, 'a'), os.path.join(root, 'b'),
+                                                   nimp.sys.filesystem.DirectorySnapshot()))
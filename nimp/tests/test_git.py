@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+''' Git utilities unit tests '''
+
+import os
+import tempfile
+import threading
+import types
+import unittest
+import unittest.mock
+
+from giteapy.rest import ApiException
+
+import nimp.artifacts
+import nimp.base_commands.download_fileset
+import nimp.utils.git
+
+class _FakeRepositoryApi():
+    ''' Answers commit requests for known commits, counting them '''
+
+    def __init__(self, all_commits):
+        self.all_commits = all_commits
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def repo_get_single_commit(self, owner, repo, sha):
+        with self._lock:
+            self.requests.append(sha)
+        if sha not in self.all_commits:
+            raise ApiException(status = 404, reason = 'Not Found')
+        committer = types.SimpleNamespace(_date = self.all_commits[sha])
+        return types.SimpleNamespace(commit = types.SimpleNamespace(committer = committer))
+
+class _GiteaTests(unittest.TestCase):
+
+    def _initialize(self, root, all_commits):
+        env = types.SimpleNamespace(root_dir = root, branch = 'main', gitea_branches = [ 'main' ], gitea_host = 'https://gitea',
+                                    gitea_access_token = 'token', gitea_repo_owner = 'owner', gitea_repo_name = 'repo')
+        api_instance = _FakeRepositoryApi(all_commits)
+        with unittest.mock.patch('giteapy.RepositoryApi', return_value = api_instance):
+            return nimp.utils.git.initialize_gitea_api_context(env), api_instance
+
+    def test_commit_timestamps(self):
+        ''' Commit timestamps should be requested once, even in later runs '''
+        all_commits = { '%040x' % index: '2020-01-01T00:%02d:00+00:00' % (index % 60) for index in range(200) }
+        with tempfile.TemporaryDirectory() as root:
+            gitea_context, api_instance = self._initialize(root, all_commits)
+            all_timestamps = nimp.utils.git.get_gitea_commit_timestamps(gitea_context, list(all_commits) + [ 'unknown', None ])
+            self.assertEqual(len(api_instance.requests), len(all_commits) + 1)
+            self.assertIsNone(all_timestamps['unknown'])
+            self.assertIsNone(all_timestamps[None])
+            self.assertEqual(int(all_timestamps['%040x' % 1]) - int(all_timestamps['%040x' % 0]), 60)
+
+            gitea_context, api_instance = self._initialize(root, all_commits)
+            self.assertDictEqual(nimp.utils.git.get_gitea_commit_timestamps(gitea_context, list(all_commits) + [ 'unknown', None ]), all_timestamps)
+            self.assertListEqual(api_instance.requests, [ 'unknown' ])
+
+    def test_list_artifacts(self):
+        ''' Listing artifacts and finding one should request each commit once '''
+        all_commits = { '%040x' % index: '2020-01-01T%02d:00:00+00:00' % index for index in range(20) }
+        with tempfile.TemporaryDirectory() as root:
+            for sha in all_commits:
+                os.makedirs(os.path.join(root, 'repository', 'binaries_' + sha))
+            gitea_context, api_instance = self._initialize(root, all_commits)
+            all_artifacts = nimp.artifacts.list_artifacts('{root_dir}/repository/binaries_{revision}', { 'root_dir': root }, gitea_context)
+            self.assertEqual(len(all_artifacts), len(all_commits))
+            self.assertCountEqual(api_instance.requests, list(all_commits))
+
+            find_matching_artifact = nimp.base_commands.download_fileset.DownloadFileset._find_matching_artifact
+            artifact = find_matching_artifact(all_artifacts, None, None, '%040x' % 10, gitea_context)
+            self.assertEqual(artifact['revision'], '%040x' % 10)
+            self.assertEqual(len(api_instance.requests), len(all_commits))
+
+    def test_index_unknown_revision(self):
+        ''' Artifacts of revisions not on Gitea yet should be indexed, and
+            listed once their revision is found '''
+        all_commits = { '%040x' % index: '2020-01-01T%02d:00:00+00:00' % index for index in range(2) }
+        with tempfile.TemporaryDirectory() as root:
+            for sha in list(all_commits) + [ '%040x' % 2 ]:
+                os.makedirs(os.path.join(root, 'repository', 'binaries_' + sha))
+            artifact_pattern = '{root_dir}/repository/binaries_{revision}'
+            gitea_context, _ = self._initialize(root, all_commits)
+            with self.assertLogs(level = 'WARNING'):
+                nimp.artifacts.update_artifact_index(artifact_pattern, { 'root_dir': root }, '%040x' % 2, gitea_context, False)
+            all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, { 'root_dir': root }, gitea_context)
+            self.assertCountEqual([ it['revision'] for it in all_artifacts ], list(all_commits))
+
+            all_commits['%040x' % 2] = '2020-01-01T02:00:00+00:00'
+            gitea_context, _ = self._initialize(root, all_commits)
+            all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, { 'root_dir': root }, gitea_context)
+            self.assertCountEqual([ it['revision'] for it in all_artifacts ], list(all_commits))
+            self.assertTrue(all('name' in it for it in all_artifacts))
@@ -24,10 +24,12 @@
 
 import contextlib
 import os
+import threading
 import unittest
 import unittest.mock
 import argparse
 
+import nimp.base_commands.p4
 import nimp.tests.utils
 import nimp.utils.p4
 
@@ -47,6 +49,8 @@ class P4Mock(nimp.tests.utils.MockCommand):
         self._changelists = {}
         self._files = {}
         self._current_changelist = 0
+        # Commands run on this mock, to check how many p4 calls were made
+        self.history = []
         self._parser = argparse.ArgumentParser(prog = 'p4')
         self._init_args(self._parser)
 
@@ -69,6 +73,7 @@ class P4Mock(nimp.tests.utils.MockCommand):
         return cl_number
 
     def get_result(self, command, stdin=None):
+        self.history.append(command)
         args = self._parser.parse_args(command)
 
         if args.x not in ['-', None]:
@@ -101,6 +106,7 @@ class P4Mock(nimp.tests.utils.MockCommand):
         self._init_revert(subparsers)
         self._init_submit(subparsers)
         self._init_sync(subparsers)
+        P4Mock._init_where(subparsers)
 
     def _get_file_status(self, filename):
         for _, change in reversed(sorted(self._changelists.items())):
@@ -193,6 +199,7 @@ class P4Mock(nimp.tests.utils.MockCommand):
 
         parser = subparsers.add_parser('changes')
         parser.add_argument('-c', '--changes_client')
+        parser.add_argument('-l', action = 'store_true')
         parser.add_argument('-m', default = 0)
         parser.add_argument('-s', '--status', choices = ['pending', 'submitted', 'shelved'])
         parser.set_defaults(command_to_run = _changes_command)
@@ -291,7 +298,7 @@ class P4Mock(nimp.tests.utils.MockCommand):
             if filename.endswith('/...'):
                 dirname = filename[:-4]
                 for root, _, filenames in os.walk(dirname):
-                    for child in filenames:
+                    for child in sorted(filenames):
                         child_file = os.path.join(root, child)
                         child_file = os.path.relpath(child_file, '/p4')
                         file_stdout, file_stderr = _get_file_fstat(child_file)
@@ -379,7 +386,7 @@ class P4Mock(nimp.tests.utils.MockCommand):
                 if path.endswith('/...'):
                     directory = path[:-4]
                     for root, _, filenames in os.walk(directory):
-                        for child in filenames:
+                        for child in sorted(filenames):
                             child_file = os.path.join(root, child)
                             files_to_reconcile.add(child_file)
                 else:
@@ -407,7 +414,9 @@ class P4Mock(nimp.tests.utils.MockCommand):
             return (0, '', '')
 
         parser = subparsers.add_parser('reconcile')
+        parser.add_argument('-a', action = 'store_true')
         parser.add_argument('-c')
+        parser.add_argument('-f', action = 'store_true')
         parser.set_defaults(command_to_run = _reconcile_command)
 
     def _init_revert(self, subparsers):
@@ -554,6 +563,24 @@ class P4Mock(nimp.tests.utils.MockCommand):
         parser.add_argument('-o', action ='store_true')
         parser.set_defaults(command_to_run = _user_command)
 
+    @staticmethod
+    def _init_where(subparsers):
+        def _where_command(args, stdin):
+            files = list(args.files)
+            if stdin is not None:
+                files += [ it for it in stdin.split('\n') if it ]
+            output = ''
+            for depot_file in files:
+                rel_path = depot_file[len('//test_client/'):] if depot_file.startswith('//test_client/') else os.path.relpath(depot_file, '/p4')
+                output += ('... depotFile //test_client/%s\n'
+                           '... clientFile //test_client/%s\n'
+                           '... path %s\n\n') % (rel_path, rel_path, os.path.join('/p4', rel_path))
+            return (0, output, '')
+
+        parser = subparsers.add_parser('where')
+        parser.add_argument('files', nargs='*')
+        parser.set_defaults(command_to_run = _where_command)
+
 @contextlib.contextmanager
 def mock_p4():
     ''' Returns a p4 mock '''
@@ -570,6 +597,9 @@ class _P4Tests(unittest.TestCase):
                                     password = 'test_password',
                                     client = 'test_client')
 
+    def setUp(self):
+        nimp.utils.p4._PENDING_CHANGELISTS.clear()
+
     def _assert_action_is(self, filename, action):
         files_status = list(self._p4.get_files_status(filename))
         self.assertTrue(len(files_status) == 1)
@@ -650,6 +680,25 @@ class _P4Tests(unittest.TestCase):
             already_existing_cl = self._p4.get_or_create_changelist('changelist description')
             self.assertEqual(already_existing_cl, cl_number)
 
+    def test_get_or_create_changelist_call_count(self):
+        ''' get_or_create_changelist should find an existing changelist in a
+            single query, and remember it afterwards '''
+        with mock_p4() as mock:
+            all_cl_numbers = [self._p4.get_or_create_changelist('changelist %d' % i) for i in range(10)]
+            nimp.utils.p4._PENDING_CHANGELISTS.clear()
+            mock.history.clear()
+
+            # p4 info and p4 changes, whatever the pending changelist count
+            self.assertEqual(self._p4.get_or_create_changelist('Changelist 5'), all_cl_numbers[5])
+            self.assertEqual(len(mock.history), 2)
+
+            self.assertEqual(self._p4.get_or_create_changelist('changelist 5'), all_cl_numbers[5])
+            self.assertEqual(len(mock.history), 2)
+
+            # Deleted changelists should not be remembered
+            self.assertTrue(self._p4.delete_changelist(all_cl_numbers[5]))
+            self.assertNotIn(self._p4.get_or_create_changelist('changelist 5'), all_cl_numbers)
+
     def test_delete_changelist(self):
         ''' delete_changelist should delete pending changelist '''
         with mock_p4():
@@ -946,3 +995,180 @@ class _P4Tests(unittest.TestCase):
 
             self.assertListEqual([('/test_client/file_3', 'add')],
                                  sorted(cl_3_modified_files))
+
+class _TaggedOutputTests(unittest.TestCase):
+
+    def test_iter_tagged_records(self):
+        ''' Tagged output should be parsed one record at a time, missing
+            fields not shifting following records '''
+        output = ['... depotFile //depot/file_1\r\n',
+                  '... clientFile /p4root/file_1\r\n',
+                  '... headAction edit\r\n',
+                  '\r\n',
+                  '... depotFile //depot/file_2\n',
+                  '... clientFile /p4root/file_2\n',
+                  '... ... otherOpen0 user@client\n',
+                  '\n',
+                  '\n',
+                  '... change 400\n',
+                  '... desc first line\n',
+                  'second line\n']
+        records = list(nimp.utils.p4.iter_tagged_records(output))
+        self.assertListEqual(records,
+                             [{'depotFile': '//depot/file_1', 'clientFile': '/p4root/file_1', 'headAction': 'edit'},
+                              {'depotFile': '//depot/file_2', 'clientFile': '/p4root/file_2', 'otherOpen0': 'user@client'},
+                              {'change': '400', 'desc': 'first line\nsecond line'}])
+
+    def test_iter_tagged_records_multi_paragraph(self):
+        ''' Blank lines inside a description should not end the record '''
+        output = ['... change 400\n',
+                  '... desc first paragraph\n',
+                  '\n',
+                  'second paragraph\n',
+                  '\n',
+                  '\n',
+                  'third paragraph\n',
+                  '\n',
+                  '... change 401\n',
+                  '... desc other\n',
+                  '\n']
+        records = list(nimp.utils.p4.iter_tagged_records(output))
+        self.assertListEqual(records,
+                             [{'change': '400', 'desc': 'first paragraph\n\nsecond paragraph\n\n\nthird paragraph'},
+                              {'change': '401', 'desc': 'other'}])
+
+class _FakeP4Api:
+    ''' Stands for the P4 module of p4python '''
+    class P4Exception(Exception):
+        ''' P4API error '''
+
+class _FakeP4ApiConnection:
+    ''' Mocks a P4API connection, commands results being given as functions
+        taking the command arguments '''
+    def __init__(self, **commands):
+        self.commands = commands
+        self.calls = []
+        self.errors = []
+        self.warnings = []
+        self.input = None
+
+    def run(self, command, *args):
+        self.calls.append((command,) + args)
+        self.errors = []
+        self.warnings = []
+        return self.commands[command](self, *args)
+
+class _P4ApiTests(unittest.TestCase):
+
+    @staticmethod
+    def _get_client(connection):
+        return nimp.utils.p4.P4ApiClient(connection = connection)
+
+    def test_get_workspace(self):
+        ''' Tagged results should be parsed as with the p4 executable '''
+        connection = _FakeP4ApiConnection(info = lambda *_: [{'userName': 'test_user', 'clientName': 'test_client'}])
+        self.assertEqual(self._get_client(connection).get_workspace(), 'test_client')
+        self.assertListEqual(connection.calls, [('info',)])
+
+    def test_get_files_status(self):
+        ''' Files given through stdin should be passed as arguments, and
+            warnings should be reported on stderr '''
+        def _fstat(connection, *args):
+            connection.warnings = ['%s - no such file(s).' % it for it in args if it != '/p4root/file_1']
+            return [{'clientFile': '/p4root/file_1', 'headAction': 'edit', 'action': 'edit'}]
+
+        connection = _FakeP4ApiConnection(fstat = _fstat)
+        with unittest.mock.patch('nimp.utils.p4._P4API', _FakeP4Api):
+            files_status = list(self._get_client(connection).get_files_status('/p4root/file_1', '/p4root/file_2'))
+        self.assertListEqual(files_status, [('/p4root/file_1', 'edit', 'edit')])
+        self.assertListEqual(connection.calls, [('fstat', '/p4root/file_1', '/p4root/file_2')])
+
+    def test_reconcile(self):
+        ''' List fields should be rendered as indexed tagged fields '''
+        def _describe(*_):
+            return [{'change': '400', 'depotFile': ['//depot/file_1', '//depot/file_2'], 'action': ['edit', 'add']}]
+        def _where(_, *files):
+            return [{'depotFile': it, 'path': os.path.join('/missing', it[2:])} for it in files]
+
+        connection = _FakeP4ApiConnection(describe = _describe, where = _where,
+                                          revert = lambda *_: [], delete = lambda *_: [], reconcile = lambda *_: [])
+        with unittest.mock.patch('nimp.utils.p4._P4API', _FakeP4Api):
+            self.assertTrue(self._get_client(connection).reconcile('400', '/p4root/...'))
+        self.assertIn(('where', '//depot/file_1'), connection.calls)
+        self.assertIn(('delete', '-c', '400', '/missing/depot/file_1'), connection.calls)
+
+    def test_submit_empty_changelist(self):
+        ''' P4API errors should be reported as p4 executable errors '''
+        def _submit(connection, *_):
+            connection.errors = ['No files to submit.']
+            raise _FakeP4Api.P4Exception('[P4#run] Errors during command execution')
+
+        connection = _FakeP4ApiConnection(submit = _submit, change = lambda *_: ['Change 400 deleted.'])
+        with unittest.mock.patch('nimp.utils.p4._P4API', _FakeP4Api):
+            self.assertTrue(self._get_client(connection).submit('400'))
+        self.assertListEqual(connection.calls, [('submit', '-f', 'revertunchanged', '-c', '400'), ('change', '-d', '400')])
+
+    def test_threads_use_own_connection(self):
+        ''' Sharded operations should run concurrently, each worker thread
+            having its own P4API connection '''
+        barrier = threading.Barrier(2, timeout = 5)
+        connections = []
+        def _edit(connection, *_):
+            # Fails with BrokenBarrierError if chunks don't overlap
+            barrier.wait()
+            return []
+
+        class _P4(_FakeP4ApiConnection):
+            def __init__(self):
+                super().__init__(edit = _edit)
+                connections.append(self)
+            def connect(self):
+                pass
+
+        connection = _FakeP4ApiConnection()
+        client = nimp.utils.p4.P4ApiClient('p4port', 'user', None, 'test_threads_client', connection = connection)
+        env = argparse.Namespace(chunk_size = 1, jobs = 2, p4_operation = 'checkout')
+        with unittest.mock.patch('nimp.utils.p4._P4API', _FakeP4Api), \
+             unittest.mock.patch.object(_FakeP4Api, 'P4', _P4, create = True):
+            self.assertTrue(nimp.base_commands.p4._run_sharded(env, lambda chunk: client._call('edit', *chunk)[0] == 0,
+                                                               ['file_1', 'file_2']))
+        self.assertEqual(len(connections), 2)
+        self.assertListEqual(connection.calls, [])
+
+    def test_sync_refreshes_snapshot(self):
+        ''' Files synced using P4API should be seen by later filesets, and
+            connections should be closed when nimp exits '''
+        connection = _FakeP4ApiConnection(sync = lambda *_: [])
+        connection.disconnect = unittest.mock.Mock()
+        with unittest.mock.patch('nimp.utils.p4._P4API', _FakeP4Api), \
+             unittest.mock.patch('nimp.sys.filesystem.refresh_snapshot') as refresh_snapshot:
+            self.assertEqual(self._get_client(connection)._call('sync')[0], 0) # pylint: disable = protected-access
+        refresh_snapshot.assert_called_once_with()
+
+        with unittest.mock.patch.dict('nimp.utils.p4._P4API_CONNECTIONS', { (0, None, None, None): connection }):
+            nimp.utils.p4._disconnect_p4api_connections() # pylint: disable = protected-access
+            self.assertDictEqual(nimp.utils.p4._P4API_CONNECTIONS, {}) # pylint: disable = protected-access
+        connection.disconnect.assert_called_once_with()
+
+class _FilesetTests(unittest.TestCase):
+
+    def test_run_sharded(self):
+        ''' Fileset operations should be split in chunks, and failures of
+            every chunk reported at once '''
+        env = argparse.Namespace(chunk_size = 3, jobs = 2, p4_operation = 'checkout')
+        files = [ 'file_%d' % i for i in range(8) ]
+        chunks = []
+        def _operation(chunk):
+            chunks.append(chunk)
+            return 'file_4' not in chunk
+
+        with self.assertLogs(level = 'INFO') as logs:
+            self.assertFalse(nimp.base_commands.p4._run_sharded(env, _operation, files))
+        self.assertListEqual(sorted(chunks), [files[0:3], files[3:6], files[6:8]])
+        self.assertIn('ERROR:root:  file_5', logs.output)
+        self.assertNotIn('ERROR:root:  file_6', logs.output)
+
+        chunks.clear()
+        env.chunk_size = 10
+        self.assertTrue(nimp.base_commands.p4._run_sharded(env, _operation, files[:4]))
+        self.assertListEqual(chunks, [files[:4]])
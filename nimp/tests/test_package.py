@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Package command unit tests '''
+
+import argparse
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import nimp.base_commands.package
+import nimp.sys.content_hash
+import nimp.sys.filesystem
+import nimp.system
+
+class _StageManifestTests(unittest.TestCase):
+
+    def _stage(self, root, *files):
+        manifest = nimp.base_commands.package.StageManifest(root + '/stage')
+        manifest.load()
+        with unittest.mock.patch('nimp.system._copy_file_data', wraps = nimp.system._copy_file_data) as copyfile:
+            for name in files:
+                nimp.base_commands.package.Package._stage_file(manifest.stage_directory, root + '/source/' + name, name,
+                                                               False, manifest)
+            manifest.save(False)
+        return [ os.path.basename(it[0][0]) for it in copyfile.call_args_list ]
+
+    def test_incremental_stage(self):
+        ''' Incremental staging should only copy changed files and remove the
+            ones which are not staged anymore '''
+        with tempfile.TemporaryDirectory() as root:
+            nimp.sys.filesystem.reset_snapshot()
+            nimp.sys.content_hash.reset_index()
+            for name in [ 'a', 'b', 'directory/c' ]:
+                os.makedirs(os.path.dirname(root + '/source/' + name), exist_ok = True)
+                with open(root + '/source/' + name, 'w') as source_file:
+                    source_file.write(name)
+
+            self.assertListEqual(self._stage(root, 'a', 'b', 'directory'), [ 'a', 'b', 'c' ])
+            self.assertListEqual(self._stage(root, 'a', 'b', 'directory'), [])
+
+            with open(root + '/source/a', 'w') as source_file:
+                source_file.write('changed')
+            os.utime(root + '/source/b', ns = (0, 0))
+            self.assertListEqual(self._stage(root, 'a', 'b'), [ 'a' ])
+            self.assertFalse(os.path.exists(root + '/stage/directory/c'))
+            with open(root + '/stage/a') as staged_file:
+                self.assertEqual(staged_file.read(), 'changed')
+
+    def test_removed_source(self):
+        ''' Files removed from a staged directory, or not generated anymore,
+            should be removed from the stage directory by the next run '''
+        with tempfile.TemporaryDirectory() as root:
+            nimp.sys.filesystem.reset_snapshot()
+            nimp.sys.content_hash.reset_index()
+            for name in [ 'directory/a', 'directory/b', 'template' ]:
+                os.makedirs(os.path.dirname(root + '/source/' + name), exist_ok = True)
+                with open(root + '/source/' + name, 'w') as source_file:
+                    source_file.write(name)
+
+            manifest = nimp.base_commands.package.StageManifest(root + '/stage')
+            manifest.load()
+            nimp.base_commands.package.Package._stage_file(manifest.stage_directory, root + '/source/directory', 'directory', False, manifest)
+            nimp.base_commands.package.Package._stage_and_transform_file(manifest.stage_directory, root + '/source/template', 'generated',
+                                                                         { 'configuration': 'Test' }, False, manifest)
+            manifest.save(False)
+            self.assertTrue(os.path.exists(root + '/stage/directory/b'))
+            self.assertTrue(os.path.exists(root + '/stage/generated'))
+
+            os.remove(root + '/source/directory/b')
+            self.assertListEqual(self._stage(root, 'directory'), [])
+            self.assertTrue(os.path.exists(root + '/stage/directory/a'))
+            self.assertFalse(os.path.exists(root + '/stage/directory/b'))
+            self.assertFalse(os.path.exists(root + '/stage/generated'))
+
+    def test_uat_stage_ignores_incremental(self):
+        ''' Incremental staging should be ignored when AutomationTool stages
+            files, since it doesn't remove the ones not staged anymore '''
+        env = argparse.Namespace(dry_run = True, incremental_stage = True, link_staged_files = False,
+                                 unreal_version = 5.1, root_dir = '/root_dir', is_dne_legacy_ue4 = False)
+        package_configuration = nimp.base_commands.package.UnrealPackageConfiguration(env)
+        package_configuration.package_type = 'application'
+        package_configuration.stage_directory = '/root_dir/Saved/StagedBuilds'
+        package_configuration.uat_directory = '/root_dir/Engine/Binaries/DotNET'
+        package_configuration.editor_cmd_exe = 'UnrealEditor-Cmd.exe'
+        package_configuration.unreal_major = 5
+        package_configuration.project = 'Game'
+        package_configuration.target_platform = 'Win64'
+        package_configuration.binary_configuration = 'Development'
+        with unittest.mock.patch('nimp.sys.process.call', return_value = 0) as call, \
+             unittest.mock.patch('nimp.unreal.get_p4_args_for_commandlet', return_value = []), \
+             unittest.mock.patch.object(nimp.base_commands.package.Package, '_clean_uat_logs'), \
+             unittest.mock.patch.object(nimp.base_commands.package.Package, '_backup_uat_logs'), \
+             self.assertLogs(level = 'WARNING'):
+            nimp.base_commands.package.Package.stage(env, package_configuration)
+        self.assertIsNone(package_configuration.stage_manifest)
+        self.assertNotIn('-NoCleanStage', call.call_args[0][0])
+
+    def test_linked_stage(self):
+        ''' Staged files should be links to their source when asked '''
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(root + '/source')
+            with open(root + '/source/a', 'w') as source_file:
+                source_file.write('a')
+            manifest = nimp.base_commands.package.StageManifest(root + '/stage', use_links = True)
+            manifest.stage([ (root + '/source/a', 'a') ], False)
+            self.assertTrue(os.path.samefile(root + '/source/a', root + '/stage/a'))
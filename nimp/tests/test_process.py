@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Process utilities unit tests '''
+
+import subprocess
+import sys
+import unittest
+import unittest.mock
+
+import nimp.sys.platform
+import nimp.sys.process
+
+_OUTPUT_SCRIPT = ('import sys\n'
+                  'for i in range(1000):\n'
+                  '    print("out %d" % i)\n'
+                  '    print("err %d" % i, file = sys.stderr)\n'
+                  'sys.stdout.write("no newline")\n')
+
+_INVALID_UTF8_SCRIPT = r'import sys; sys.stdout.buffer.write(b"d\xc3\xa9j\xc3\xa0\ncaf\xe9\nok\n")'
+
+_STDIN_SCRIPT = 'import sys; sys.stdout.write(sys.stdin.read().upper())'
+
+class _ProcessTests(unittest.TestCase):
+
+    def _check_pump(self, use_selector):
+        with unittest.mock.patch('nimp.sys.process._USE_SELECTOR_PUMP', use_selector):
+            result, output, error = nimp.sys.process.call([sys.executable, '-c', _OUTPUT_SCRIPT],
+                                                          capture_output = True, hide_output = True)
+            self.assertEqual(result, 0)
+            self.assertEqual(output, ''.join('out %d\n' % i for i in range(1000)) + 'no newline')
+            self.assertEqual(error, ''.join('err %d\n' % i for i in range(1000)))
+
+            stdin = 'some input\n' * 10000
+            result, output, _ = nimp.sys.process.call([sys.executable, '-c', _STDIN_SCRIPT], stdin = stdin,
+                                                      capture_output = True, hide_output = True)
+            self.assertEqual(result, 0)
+            self.assertEqual(output, stdin.upper())
+
+            result = nimp.sys.process.call([sys.executable, '-c', 'import sys; sys.exit(3)'], hide_output = True)
+            self.assertEqual(result, 3)
+
+    def test_thread_pump(self):
+        ''' Thread pump should forward stdout, stderr and stdin '''
+        self._check_pump(False)
+
+    @unittest.skipIf(nimp.sys.platform.is_windows(), 'Selector pump is not available on Windows')
+    def test_selector_pump(self):
+        ''' Selector pump should forward stdout, stderr and stdin '''
+        self._check_pump(True)
+
+    @unittest.skipIf(nimp.sys.platform.is_windows(), 'Selector pump is not available on Windows')
+    def test_selector_pump_timeout(self):
+        ''' Selector pump should honour heartbeat and timeout '''
+        with unittest.mock.patch('nimp.sys.process._USE_SELECTOR_PUMP', True):
+            command = [sys.executable, '-c', 'import time; time.sleep(5)']
+            with self.assertLogs(level = 'INFO') as logs:
+                with self.assertRaises(subprocess.TimeoutExpired):
+                    nimp.sys.process.call(command, heartbeat = 0.1, timeout = 0.5, hide_output = True)
+            self.assertTrue(any('Keepalive' in it for it in logs.output))
+
+    def test_decoding_fallback(self):
+        ''' Lines that aren't valid in the requested encoding should not
+            affect the decoding of other lines '''
+        _, output, _ = nimp.sys.process.call([sys.executable, '-c', _INVALID_UTF8_SCRIPT],
+                                             capture_output = True, hide_output = True)
+        lines = output.split('\n')
+        self.assertEqual(lines[0], 'd\u00e9j\u00e0')
+        self.assertTrue(lines[1].startswith('caf'))
+        self.assertEqual(lines[2:], ['ok', ''])
+
+    def test_spool_output(self):
+        ''' Spooled captures should be readable line by line, whether they
+            stayed in memory or not '''
+        result, output, error = nimp.sys.process.call([sys.executable, '-c', _OUTPUT_SCRIPT],
+                                                      capture_output = True, hide_output = True, spool_output = True)
+        with output, error:
+            self.assertEqual(result, 0)
+            self.assertFalse(output.spilled)
+            self.assertEqual(list(output), [ 'out %d\n' % i for i in range(1000) ] + [ 'no newline' ])
+            self.assertEqual(error.read(), ''.join('err %d\n' % i for i in range(1000)))
+
+        with nimp.sys.process.SpooledOutput(max_size = 100) as output:
+            for i in range(100):
+                output.append('line %d\r\n' % i)
+            self.assertTrue(output.spilled)
+            self.assertEqual(list(output), [ 'line %d\r\n' % i for i in range(100) ])
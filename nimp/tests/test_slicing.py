@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Job slicing unit tests '''
+
+import argparse
+import json
+import os
+import tempfile
+import unittest
+
+import nimp.utils.slicing
+
+class _SlicingTests(unittest.TestCase):
+
+    def test_partition(self):
+        ''' Heavy items should be spread so that slices have close costs '''
+        costs = { 'a': 10, 'b': 9, 'c': 1, 'd': 1, 'e': 1, 'f': 1, 'g': 8 }
+        slices = nimp.utils.slicing.partition(costs.keys(), 3, costs.get)
+        self.assertListEqual(slices, [ [ 'a', 'f' ], [ 'b', 'd' ], [ 'c', 'e', 'g' ] ])
+        self.assertListEqual(sorted(it for slice in slices for it in slice), sorted(costs))
+
+    def test_get_slice(self):
+        ''' Every slicing mode should give each item to exactly one slice '''
+        with tempfile.TemporaryDirectory() as directory:
+            files = [ os.path.join(directory, 'file_%d' % i) for i in range(10) ]
+            for i, file in enumerate(files):
+                with open(file, 'w') as fp:
+                    fp.write('x' * (1 + i ** 3))
+            history_file = os.path.join(directory, 'history.json')
+            history = { file: 100 if file == files[0] else 1 for file in files }
+            with open(history_file, 'w') as fp:
+                json.dump(history, fp)
+
+            for mode in nimp.utils.slicing.SLICE_MODES:
+                env = argparse.Namespace(slice_job_count = 3, slice_mode = mode, slice_history = history_file)
+                slices = []
+                for index in range(1, 4):
+                    env.slice_job_index = index
+                    slices.append(nimp.utils.slicing.get_slice(env, files))
+                self.assertListEqual(sorted(it for slice in slices for it in slice), files)
+                if mode == 'history':
+                    self.assertListEqual(slices[0], [ files[0] ])
+                if mode == 'size':
+                    self.assertListEqual(slices[0], [ files[9] ])
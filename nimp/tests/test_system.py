@@ -24,8 +24,16 @@
 
 import os
 import itertools
+import sys
+import tempfile
+import types
 import unittest
+import unittest.mock
 
+import nimp.environment
+import nimp.sys.content_hash
+import nimp.sys.filesystem
+import nimp.sys.process
 import nimp.tests.utils
 import nimp.system
 
@@ -72,6 +80,36 @@ class _FileSetTests(unittest.TestCase):
         files, _ = _file_mapper()
         self._check_files(files(), ('', ''))
 
+    def test_changed(self):
+        ''' Changed should discard files whose destination has the same
+            content, whatever their modification time '''
+        with tempfile.TemporaryDirectory() as test_dir:
+            for name, content in [ ('src/a', 'a'), ('src/b', 'b'), ('src/c', 'c'), ('dest/a', 'a'), ('dest/b', 'x') ]:
+                nimp.tests.utils.create_file(os.path.join(test_dir, name), content)
+            os.utime(os.path.join(test_dir, 'dest/a'), ns = (0, 0))
+            nimp.sys.filesystem.reset_snapshot()
+            nimp.sys.content_hash.reset_index()
+            files = nimp.system.FileMapper(_yield_mapper, format_args = { 'test_dir': test_dir })
+            files.src('{test_dir}/src').to('{test_dir}/dest').glob('*').changed()
+            self.assertListEqual(sorted(os.path.basename(src) for src, _ in files()), [ 'b', 'c' ])
+
+    def test_files_written_between_evaluations(self):
+        ''' Files written by child processes or directly between two
+            evaluations should be seen by the second one '''
+        with tempfile.TemporaryDirectory() as test_dir:
+            nimp.tests.utils.create_file(os.path.join(test_dir, 'a.ext1'), '')
+            nimp.sys.filesystem.reset_snapshot()
+            files = nimp.system.FileMapper(_yield_mapper, format_args = { 'test_dir': test_dir })
+            files.src('{test_dir}').to('.').glob('*.ext1')
+            self.assertListEqual([ dest for _, dest in files() ], [ 'a.ext1' ])
+
+            script = 'open(%r, "w").close()' % os.path.join(test_dir, 'b.ext1')
+            self.assertEqual(nimp.sys.process.call([ sys.executable, '-c', script ], hide_output = True), 0)
+            self.assertListEqual([ dest for _, dest in files() ], [ 'a.ext1', 'b.ext1' ])
+
+            open(os.path.join(test_dir, 'c.ext1'), 'w').close()
+            self.assertListEqual([ dest for _, dest in files.stream() ], [ 'a.ext1', 'b.ext1', 'c.ext1' ])
+
     def test_exclude(self):
         ''' Exclude should remove files matching one of the given patterns.  '''
         files, src = _file_mapper()
@@ -84,6 +122,15 @@ class _FileSetTests(unittest.TestCase):
         src.glob('foo/bar/corge.ext1', 'foo/bar/corge.ext2').exclude_ignore_case('*rGE.ext2')
         self._check_files(files(), ('foo/bar/corge.ext1', 'foo/bar/corge.ext1'))
 
+    def test_exclude_many(self):
+        ''' Files matching any of many exclude patterns should be removed '''
+        files, src = _file_mapper(ext='ext2')
+        src.glob('**').exclude(*[ '*.ext%d' % i for i in range(3, 100) ], '*.{ext}', '*/bar')
+        self._check_files(files(), ('foo', 'foo'),
+                          ('foo/bar/corge.ext1', 'foo/bar/corge.ext1'),
+                          ('foo/quux.ext1', 'foo/quux.ext1'),
+                          ('qux.ext1', 'qux.ext1'))
+
     def test_files(self):
         ''' Files mapper should discard directories '''
         files, src = _file_mapper()
@@ -122,6 +169,46 @@ class _FileSetTests(unittest.TestCase):
         files = itertools.chain(mapper(), mapper())
         self._check_files(files, ('qux.ext1', 'qux.ext1'))
 
+    def test_stream(self):
+        ''' Streaming should find the same files as calling the mapper '''
+        def _create_mapper():
+            files, src = _file_mapper()
+            src.glob('**')
+            src.to('dest').glob('foo/**/*.ext1', '*/*/*.ext2').once()
+            return files
+        self.assertListEqual(sorted(_create_mapper().stream()), sorted(_create_mapper()()))
+        self.assertListEqual(_create_mapper().to_list(), sorted(set(_create_mapper()())))
+
+    def test_to_list_cache(self):
+        ''' Files lists of filesets should be reused by later runs until
+            the files they were computed from change '''
+        with tempfile.TemporaryDirectory() as root_dir:
+            set_module = types.ModuleType('filesets.cached_set')
+            set_module.__file__ = os.path.join(root_dir, 'cached_set.py')
+            set_module.map = lambda mapper: mapper.src('{root_dir}/content').to('.').glob('*.ext1')
+            with open(set_module.__file__, 'w') as set_file:
+                set_file.write('# Fileset')
+            os.makedirs(os.path.join(root_dir, 'content'))
+            nimp.tests.utils.create_file(os.path.join(root_dir, 'content', 'foo.ext1'), '')
+
+            def _to_list():
+                nimp.sys.filesystem.reset_snapshot()
+                mapper = nimp.system.FileMapper(_yield_mapper, format_args = { 'root_dir': root_dir, 'cache_filesets': True })
+                mapper.load_set('cached_set')
+                return mapper.to_list()
+
+            def _expected(*names):
+                return [ (nimp.system.standardize_path(os.path.join(root_dir, 'content', it)), it) for it in names ]
+
+            with unittest.mock.patch.dict(sys.modules, { 'filesets.cached_set': set_module }):
+                self.assertListEqual(_to_list(), _expected('foo.ext1'))
+                with unittest.mock.patch.object(nimp.system.FileMapper, 'stream') as stream:
+                    self.assertListEqual(_to_list(), _expected('foo.ext1'))
+                    stream.assert_not_called()
+
+                nimp.tests.utils.create_file(os.path.join(root_dir, 'content', 'bar.ext1'), '')
+                self.assertListEqual(_to_list(), _expected('bar.ext1', 'foo.ext1'))
+
     def test_recursive(self):
         ''' Recursive mapper should include all childrens of an added
             directory. '''
@@ -150,3 +237,53 @@ class _FileSetTests(unittest.TestCase):
         files, src = _file_mapper()
         src.src('foo').to('dest').glob('quux.ext1')
         self._check_files(files(), ('foo/quux.ext1', 'dest/quux.ext1'))
+
+class _CopyTests(unittest.TestCase):
+
+    def test_copy_files(self):
+        ''' Copying files should create directories and retry failed copies '''
+        with tempfile.TemporaryDirectory() as test_dir:
+            file_collection = [ (os.path.join(test_dir, 'src'), os.path.join(test_dir, 'dest', 'empty')) ]
+            for index in range(20):
+                source = os.path.join(test_dir, 'src', 'file%d' % index)
+                nimp.tests.utils.create_file(source, 'content %d' % index)
+                file_collection.append((source, os.path.join(test_dir, 'dest', str(index % 3), 'file%d' % index)))
+
+            failures = [ os.path.join(test_dir, 'src', 'file7') ]
+            copy_file_data = nimp.system._copy_file_data # pylint: disable = protected-access
+            def _copy_file_data(source, destination):
+                if source in failures:
+                    failures.remove(source)
+                    raise OSError('Copy failed')
+                copy_file_data(source, destination)
+
+            with unittest.mock.patch('nimp.system._copy_file_data', side_effect = _copy_file_data):
+                copied_size = nimp.system.copy_files(file_collection, retry_delay = 0)
+            self.assertEqual(copied_size, sum(len('content %d' % index) for index in range(20)))
+            self.assertTrue(os.path.isdir(os.path.join(test_dir, 'dest', 'empty')))
+            for index, (_, destination) in enumerate(file_collection[1:]):
+                with open(destination) as destination_file:
+                    self.assertEqual(destination_file.read(), 'content %d' % index)
+
+class _FormatTests(unittest.TestCase):
+
+    def test_format_cache(self):
+        ''' Cached interpolations should follow environment changes '''
+        env = nimp.environment.Environment()
+        env.platform = 'win64'
+        files = nimp.system.map_files(env)
+        self.assertEqual(env.format('{platform}/%%'), 'win64/%')
+        self.assertEqual(files._format('{platform}/%%'), 'win64/%') # pylint: disable = protected-access
+        env.platform = 'linux'
+        self.assertEqual(env.format('{platform}/%%'), 'linux/%')
+        self.assertEqual(files._format('{platform}/%%'), 'linux/%') # pylint: disable = protected-access
+        self.assertEqual(env.format('{platform}', platform = 'xsx'), 'xsx')
+        with self.assertRaises(KeyError):
+            env.format('{missing}')
+
+        # Plain dictionaries may be modified in place
+        format_args = { 'platform': 'win64' }
+        files = nimp.system.FileMapper(None, format_args)
+        self.assertEqual(files._format('{platform}'), 'win64') # pylint: disable = protected-access
+        format_args['platform'] = 'linux'
+        self.assertEqual(files._format('{platform}'), 'linux') # pylint: disable = protected-access
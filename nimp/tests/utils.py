@@ -24,12 +24,18 @@
 
 import abc
 import contextlib
+import functools
+import http.server
+import io
 import os.path
+import threading
 import unittest.mock
 
 import pyfakefs.fake_filesystem_unittest
 
 import nimp.system
+import nimp.sys.content_hash
+import nimp.sys.filesystem
 import nimp.sys.platform
 import nimp.sys.process
 
@@ -45,20 +51,30 @@ class MockCommand(metaclass=abc.ABCMeta):
 
 @contextlib.contextmanager
 def mock_capture_process_output(*mock_commands):
-    ''' Mocks calls to popen '''
+    ''' Mocks calls to nimp.sys.process.call '''
     mock_dict = {}
     for it in mock_commands:
         assert isinstance(it, MockCommand)
         mock_dict[it.command] = it
 
-    def _mock(directory, command, stdin = None, _ = True):
-        assert directory is not None
+    def _mock(command, stdin = None, capture_output = False, spool_output = False, **_):
         executable = command[0]
         if executable not in mock_dict:
-            return (0, '', '')
-        return mock_dict[executable].get_result(command[1:], stdin = stdin)
+            result = (0, '', '')
+        else:
+            result = mock_dict[executable].get_result(command[1:], stdin = stdin)
+        if not capture_output:
+            return result[0]
+        if spool_output:
+            exit_code, output, error = result
+            spooled_output = nimp.sys.process.SpooledOutput()
+            spooled_output.append(output)
+            spooled_error = nimp.sys.process.SpooledOutput()
+            spooled_error.append(error)
+            return exit_code, spooled_output, spooled_error
+        return result
 
-    with unittest.mock.patch('nimp.system.capture_process_output') as mock:
+    with unittest.mock.patch('nimp.sys.process.call') as mock:
         with unittest.mock.patch('nimp.sys.platform.is_msys') as mock_is_msys:
             mock_is_msys.return_value = False
             mock.side_effect = _mock
@@ -75,8 +91,14 @@ def mock_filesystem():
     ''' Sets up a mock filesystem '''
     patcher = pyfakefs.fake_filesystem_unittest.Patcher()
     patcher.setUp()
-    yield patcher.fs
-    patcher.tearDown()
+    nimp.sys.filesystem.reset_snapshot()
+    nimp.sys.content_hash.reset_index()
+    try:
+        yield patcher.fs
+    finally:
+        patcher.tearDown()
+        nimp.sys.filesystem.reset_snapshot()
+        nimp.sys.content_hash.reset_index()
 
 def create_file( name, content):
     ''' Creates a file on the fake file system '''
@@ -91,3 +113,66 @@ def dry_run_mock():
     with mock_capture_process_output():
         with mock_call_process():
             yield
+
+class _RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    ''' Serves files with range requests support, and can drop connections
+        to test resumed downloads '''
+
+    def __init__(self, *arguments, server_state, **keyword_arguments):
+        self.server_state = server_state
+        super().__init__(*arguments, **keyword_arguments)
+
+    def log_message(self, *_): # pylint: disable = arguments-differ
+        pass
+
+    def send_head(self):
+        self.server_state['requests'].append((self.path, self.headers.get('Range')))
+        path = self.translate_path(self.path)
+        range_header = self.headers.get('Range')
+        if os.path.isdir(path) or not os.path.isfile(path) or range_header is None:
+            return super().send_head()
+        start, end = range_header[ len('bytes=') : ].split('-')
+        source_file = open(path, 'rb') # pylint: disable = consider-using-with
+        size = os.fstat(source_file.fileno()).st_size
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+        source_file.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        if end < size - 1:
+            with source_file:
+                return io.BytesIO(source_file.read(end + 1 - start))
+        return source_file
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def copyfile(self, source, outputfile):
+        failures = self.server_state['failures'].get(self.path)
+        if not failures:
+            return super().copyfile(source, outputfile)
+        # Send part of the content, then drop the connection
+        outputfile.write(source.read(failures.pop()))
+        outputfile.flush()
+        self.close_connection = True
+        return None
+
+@contextlib.contextmanager
+def serve_http(directory, failures = None):
+    ''' Serves a directory over HTTP on localhost, yields the server URL and
+        the list of received (path, range) requests. Failures map paths to
+        numbers of bytes after which connections are dropped, once each. '''
+    failures = { path: list(reversed(sizes)) for path, sizes in (failures or {}).items() }
+    server_state = { 'requests': [], 'failures': failures }
+    handler = functools.partial(_RangeRequestHandler, directory = directory, server_state = server_state)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server_thread = threading.Thread(target = server.serve_forever, daemon = True)
+    server_thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/' % server.server_address[1], server_state['requests']
+    finally:
+        server.shutdown()
+        server.server_close()
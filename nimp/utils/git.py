@@ -21,6 +21,7 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 ''' Git utilities '''
+import concurrent.futures
 import logging
 import giteapy
 from giteapy.rest import ApiException
@@ -28,6 +29,11 @@ from datetime import datetime, timezone
 import time
 
 import nimp.sys.process
+import nimp.system
+
+
+# Commits requested at the same time from the Gitea API
+GITEA_THREAD_COUNT = 8
 
 
 def get_branch():
@@ -108,16 +114,53 @@ def initialize_gitea_api_context(env):
     configuration.host = env.gitea_host
     configuration.api_key['access_token'] = env.gitea_access_token
     api_instance = giteapy.RepositoryApi(giteapy.ApiClient(configuration))
-    return {
+    gitea_context = {
         'instance': api_instance,
         'repo_owner': env.gitea_repo_owner,
-        'repo_name': env.gitea_repo_name
+        'repo_name': env.gitea_repo_name,
+        'cache_env': env if hasattr(env, 'root_dir') else None,
+        'cache_key': [ env.gitea_host, env.gitea_repo_owner, env.gitea_repo_name ],
+        'commit_timestamps': {},
     }
+    # Commit timestamps never change, they are kept between nimp runs
+    if gitea_context['cache_env'] is not None:
+        gitea_context['commit_timestamps'] = nimp.system.load_cache(env, 'gitea', gitea_context['cache_key']) or {}
+    return gitea_context
 
 def get_gitea_commit_timestamp(gitea_context, commit_sha):
     if not commit_sha:
         return None
-
+    return get_gitea_commit_timestamps(gitea_context, [ commit_sha ])[commit_sha]
+
+def get_gitea_commit_timestamps(gitea_context, commit_shas, thread_count = GITEA_THREAD_COUNT):
+    ''' Returns a dictionary of commit timestamps, or None for commits which
+        were not found, requesting the ones not cached concurrently '''
+    commit_timestamps = gitea_context.setdefault('commit_timestamps', {})
+    missing_shas = sorted({ sha for sha in commit_shas if sha and sha not in commit_timestamps })
+    if missing_shas:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = thread_count) as executor:
+            resolved_timestamps = dict(zip(missing_shas, executor.map(lambda sha: _request_commit_timestamp(gitea_context, sha), missing_shas)))
+        # Missing commits may be pushed later, only found ones are cached
+        resolved_timestamps = { sha: timestamp for sha, timestamp in resolved_timestamps.items() if timestamp is not None }
+        if resolved_timestamps:
+            commit_timestamps.update(resolved_timestamps)
+            _save_commit_timestamps(gitea_context, resolved_timestamps)
+    return { sha: commit_timestamps.get(sha) if sha else None for sha in commit_shas }
+
+def _save_commit_timestamps(gitea_context, resolved_timestamps):
+    cache_env = gitea_context.get('cache_env')
+    if cache_env is None:
+        return
+    cache_key = gitea_context['cache_key']
+    try:
+        # Merge with entries saved meanwhile by concurrent nimp runs
+        cached_timestamps = nimp.system.load_cache(cache_env, 'gitea', cache_key) or {}
+        cached_timestamps.update(resolved_timestamps)
+        nimp.system.save_cache(cache_env, 'gitea', cache_key, cached_timestamps)
+    except OSError as exception:
+        logging.warning('Failed to save commit timestamps: %s', exception)
+
+def _request_commit_timestamp(gitea_context, commit_sha):
     api_commit_timestamp = None
     try:
         api_response = gitea_context['instance'].repo_get_single_commit(
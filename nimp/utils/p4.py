@@ -23,14 +23,30 @@
 ''' Perforce utilities '''
 
 import argparse
+import atexit
 import logging
 import os
 import os.path
 import re
+import threading
 
+import nimp.sys.filesystem
 import nimp.sys.process
 import nimp.system
 
+# Optional P4API (p4python) support; see :class:`P4ApiClient`
+_P4API = nimp.system.try_import('P4')
+
+# P4API connections, kept open until nimp exits, by thread then by
+# (port, user, client); they can't be used by several threads at the same
+# time, so each thread running p4 commands opens its own
+_P4API_CONNECTIONS = {}
+_P4API_LOCK = threading.Lock()
+
+# Pending changelists found or created by get_or_create_changelist, by
+# (port, user, client) then by lowercase description
+_PENDING_CHANGELISTS = {}
+
 _CREATE_CHANGELIST_FORM_TEMPLATE = "\
 Change: new\n\
 User:   {user}\n\
@@ -91,8 +107,78 @@ def get_client(env):
     user   = env.p4user   if hasattr(env, 'p4user') else None
     pwd    = env.p4pass   if hasattr(env, 'p4pass') else None
     client = env.p4client if hasattr(env, 'p4client') else None
+    if _P4API is not None:
+        try:
+            connection = _get_p4api_connection(port, user, pwd, client)
+            return P4ApiClient(port, user, pwd, client, connection = connection)
+        except _P4API.P4Exception as ex:
+            logging.warning('Cannot connect using P4API, falling back to p4 executable: %s', ex)
     return P4(port, user, pwd, client)
 
+def _get_p4api_connection(port, user, password, client):
+    key = (threading.get_ident(), port, user, client)
+    with _P4API_LOCK:
+        connection = _P4API_CONNECTIONS.get(key)
+    if connection is None:
+        # Keys are per thread, so connecting doesn't need to hold the lock
+        connection = _P4API.P4()
+        if port is not None:
+            connection.port = port
+        if user is not None:
+            connection.user = user
+        if password is not None:
+            connection.password = password
+        if client is not None:
+            connection.client = client
+        connection.exception_level = 1 # Only raise on errors, not on warnings
+        connection.connect()
+        if password is not None:
+            connection.run_login()
+        with _P4API_LOCK:
+            _P4API_CONNECTIONS[key] = connection
+    return connection
+
+def _disconnect_p4api_connections():
+    with _P4API_LOCK:
+        all_connections = list(_P4API_CONNECTIONS.values())
+        _P4API_CONNECTIONS.clear()
+    for connection in all_connections:
+        try:
+            connection.disconnect()
+        except Exception as ex: # pylint: disable = broad-except
+            logging.debug('Cannot disconnect from P4API: %s', ex)
+
+atexit.register(_disconnect_p4api_connections)
+
+def iter_tagged_records(lines):
+    ''' Parses -ztag output lines, yielding a dictionary of fields for each
+        blank line separated record. Indexed fields (e.g. depotFile0 in
+        describe output) are kept as is; untagged lines continue the value
+        of the previous field (e.g. multi-line descriptions), blank lines
+        followed by such a continuation being part of the value. '''
+    record = {}
+    key = None
+    blank_lines = 0
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('... '):
+            if blank_lines > 0 and record:
+                yield record
+                record = {}
+            blank_lines = 0
+            # Nested fields are written as '... ... name value'
+            while line.startswith('... '):
+                line = line[4:]
+            key, _, value = line.partition(' ')
+            record[key] = value
+        elif line == '':
+            blank_lines += 1
+        elif key is not None:
+            record[key] += '\n' * (blank_lines + 1) + line
+            blank_lines = 0
+    if record:
+        yield record
+
 class P4:
     ''' P4 Client '''
     #pylint: disable=too-many-public-methods
@@ -133,6 +219,8 @@ class P4:
     def delete_changelist(self, cl_number):
         ''' Deletes a changelist from client '''
         output = self._run("change", "-d", cl_number)
+        if output is not None:
+            self._forget_changelist(cl_number)
         return output is not None
 
     def get_files_status(self, *files):
@@ -143,41 +231,13 @@ class P4:
             if os.path.isdir(filename):
                 files[i] = filename + '/...'
 
-        command = self._get_p4_command('-x', '-', 'fstat')
-        _, output, error = nimp.sys.process.call(command, stdin='\n'.join(files), capture_output=True)
-        files_infos = (output .strip()+ '\n\n' + error.strip()).strip().replace('\r', '').split('\n\n')
-
-        for file_info in files_infos:
-            file_info = file_info.strip()
-
-            if file_info == '':
-                continue
-
-            if "no such file(s)" in file_info or "file(s) not in client" in file_info:
-                continue
-
-            if 'is not under client\'s root' in file_info:
-                continue
-
-            file_name_match   = re.search(r"\.\.\.\s*clientFile\s*(.*)", file_info)
-            head_action_match = re.search(r"\.\.\.\s*headAction\s*(\w*)", file_info)
-            action_match      = re.search(r"\.\.\.\s*action\s*(\w*)", file_info)
-
-            assert file_name_match is not None
-
-            file_name = file_name_match.group(1)
-
-            if action_match is not None:
-                action = action_match.group(1)
-            else:
-                action = None
-
-            if head_action_match is not None:
-                head_action = head_action_match.group(1)
-            else:
-                head_action = None
-
-            yield (file_name, head_action, action)
+        _, output, error = self._call('-x', '-', 'fstat', stdin='\n'.join(files), encoding='utf-8')
+        # Missing files are only reported on stderr, and are ignored
+        with output, error:
+            for record in iter_tagged_records(output):
+                if 'clientFile' not in record:
+                    continue
+                yield (record['clientFile'], record.get('headAction'), record.get('action'))
 
     def edit(self, cl_number, *files):
         ''' Open given file for input in given changelist '''
@@ -196,25 +256,28 @@ class P4:
 
     def reconcile(self, cl_number, *files):
         ''' Reconciles given files in given cl '''
+        ret = self.revert_missing_and_unchanged(cl_number)
+        return self.reconcile_files(cl_number, *files) and ret
 
-        files = [self._escape_filename(x) for x in files]
+    def revert_missing_and_unchanged(self, cl_number):
+        ''' Reverts unchanged files of given cl, and marks for delete files
+            edited in it that no longer exist '''
         ret = True
 
         # List all currently edited depot files in our changelist
         edited_files = []
-        for depot_file, action in self._parse_command_output(['describe', cl_number],
-                                                             r'^\.\.\. depotFile\d* (.*)$',
-                                                             r'^\.\.\. action\d* (.*)$'):
-            if action == 'edit':
-                edited_files.append(depot_file)
+        for record in self.run_tagged('describe', cl_number):
+            index = 0
+            while f'depotFile{index}' in record:
+                if record.get(f'action{index}') == 'edit':
+                    edited_files.append(record[f'depotFile{index}'])
+                index += 1
 
         # Find edited files that no longer exist on the filesystem
         files_to_delete = []
-        for depot_file, path in self._parse_command_output(['-x', '-', 'where'],
-                                                           r'^\.\.\. depotFile\d* (.*)$',
-                                                           r'^\.\.\. path\d* (.*)$',
-                                                           stdin='\n'.join(edited_files)):
-            if not os.path.exists(path):
+        for record in self.run_tagged('-x', '-', 'where', stdin='\n'.join(edited_files)):
+            path = record.get('path')
+            if path is not None and not os.path.exists(path):
                 logging.debug('Manually reverting and deleting checked out and missing file %s', path)
                 files_to_delete.append(path)
 
@@ -229,12 +292,18 @@ class P4:
         if self._run('revert', '-a', '-c', cl_number) is None:
             ret = False
 
+        return ret
+
+    def reconcile_files(self, cl_number, *files):
+        ''' Opens given files in given cl if they were added, edited or
+            deleted, without looking at files already in the cl '''
+        files = [self._escape_filename(x) for x in files]
+        # Like get_files_status, directories are reconciled recursively
+        files = [x + '/...' if os.path.isdir(x) else x for x in files]
+
         # Reconcile files with -a: add missing files to checkout if necessary
         #                  and -f: allow usage of # @ % * characters
-        if self._run('-x', '-', 'reconcile', '-f', '-a', '-c', cl_number, stdin='\n'.join(files)) is None:
-            ret = False
-
-        return ret
+        return self._run('-x', '-', 'reconcile', '-f', '-a', '-c', cl_number, stdin='\n'.join(files)) is not None
 
     def get_changelist_description(self, cl_number):
         ''' Returns description of given changelist '''
@@ -258,22 +327,28 @@ class P4:
 
     def get_or_create_changelist(self, description):
         ''' Creates or returns changelist number if it's not already created '''
-        pending_changelists = self.get_pending_changelists()
-
-        for cl_number in pending_changelists:
-            pending_cl_desc = self.get_changelist_description(cl_number)
-
-            assert pending_cl_desc is not None
+        known_changelists = self._get_known_changelists()
+        if description.lower() in known_changelists:
+            return known_changelists[description.lower()]
 
+        # A single query fetches descriptions of all pending changelists
+        workspace = self.get_workspace()
+        assert isinstance(workspace, str)
+        for record in self.run_tagged('changes', '-l', '-c', workspace, '-s', 'pending'):
+            if 'change' not in record:
+                continue
+            pending_cl_desc = record.get('desc', '').strip()
             if description.lower() == pending_cl_desc.lower():
-                return cl_number
+                known_changelists[description.lower()] = record['change']
+                return record['change']
 
         user = self.get_user()
         change_list_form = _CREATE_CHANGELIST_FORM_TEMPLATE.format(user        = user,
-                                                                   workspace   = self.get_workspace(),
+                                                                   workspace   = workspace,
                                                                    description = description)
 
         for changelist, in self._parse_command_output(["change", "-i"], r"Change (\d+) created\.", stdin = change_list_form):
+            known_changelists[description.lower()] = changelist
             return changelist
 
     def get_pending_changelists(self):
@@ -297,8 +372,9 @@ class P4:
 
     def is_file_versioned(self, file_path):
         ''' Checks if a file is known by the source control '''
-        command = self._get_p4_command("fstat", file_path)
-        _, output, error = nimp.sys.process.call(command, capture_output=True)
+        _, output, error = self._call("fstat", file_path, encoding='utf-8')
+        with output, error:
+            output, error = output.read(), error.read()
         # Checks if the file was not added then deleted
         if re.search(r"\.\.\.\s*headAction\s*delete", output) is not None:
             return False
@@ -331,8 +407,9 @@ class P4:
     def submit(self, cl_number):
         ''' Submits given changelist '''
         logging.info("Submiting changelist %s...", cl_number)
-        command = self._get_p4_command('submit', '-f', 'revertunchanged', '-c', cl_number)
-        _, _, error = nimp.sys.process.call(command, capture_output=True)
+        _, output, error = self._call('submit', '-f', 'revertunchanged', '-c', cl_number, encoding='utf-8')
+        with output, error:
+            error = error.read()
 
         if error is not None and error != "":
             if "No files to submit." in error:
@@ -341,11 +418,15 @@ class P4:
             logging.error("%s", error)
             return False
 
+        self._forget_changelist(cl_number)
         return True
 
-    def sync(self, *files, cl_number = None):
-        ''' Udpate given file '''
+    def sync(self, *files, cl_number = None, parallel = None):
+        ''' Udpate given file, optionally using given number of parallel
+            transfer threads '''
         command = ["sync"]
+        if parallel is not None and parallel > 1:
+            command.append('--parallel=threads=%d' % parallel)
 
         file_list = [self._escape_filename(x) for x in files]
         if cl_number is not None:
@@ -353,8 +434,9 @@ class P4:
 
         command.extend(file_list)
 
-        command = self._get_p4_command(*command)
-        result, _, error = nimp.sys.process.call(command, capture_output=True, encoding='cp437')
+        result, output, error = self._call(*command)
+        with output, error:
+            error = error.read()
         if (result != 0 or error != '') and 'file(s) up-to-date' not in error:
             return False
 
@@ -363,12 +445,27 @@ class P4:
     def get_modified_files(self, *cl_numbers, root = '//...'):
         ''' Returns files modified by given changelists '''
         for cl_number in cl_numbers:
-            for filename, action in self._parse_command_output(["fstat", "-e", cl_number , root],
-                                                               r"^\.\.\. depotFile(.*)$",
-                                                               r"^\.\.\. headAction(.*)",
-                                                               hide_output=True):
+            for record in self.run_tagged("fstat", "-e", cl_number , root, hide_output=True):
+                filename = record.get('depotFile')
                 filename = os.path.normpath(filename) if filename is not None else ''
-                yield filename, action
+                yield filename, record.get('headAction')
+
+    def run_tagged(self, *args, stdin = None, hide_output = False, encoding='cp437'):
+        ''' Runs a p4 command and yields its tagged output one record at a
+            time, as a dictionary of fields '''
+        output = self._run(*args, stdin = stdin, hide_output = hide_output, encoding=encoding, spool_output=True)
+        if output is not None:
+            with output:
+                yield from iter_tagged_records(output)
+
+    def _get_known_changelists(self):
+        return _PENDING_CHANGELISTS.setdefault((self._port, self._user, self._client), {})
+
+    def _forget_changelist(self, cl_number):
+        known_changelists = self._get_known_changelists()
+        for description, known_cl_number in list(known_changelists.items()):
+            if known_cl_number == cl_number:
+                del known_changelists[description]
 
     @staticmethod
     def _escape_filename(name):
@@ -392,13 +489,25 @@ class P4:
         command += list(args)
         return command
 
-    def _run(self, *args, stdin=None, hide_output=False, encoding='cp437'):
+    def _call(self, *args, stdin=None, hide_output=False, encoding='cp437'):
+        ''' Runs a p4 command once, returning its exit code and its spooled
+            stdout and stderr '''
         command = self._get_p4_command(*args)
+        return nimp.sys.process.call(command, stdin=stdin, encoding=encoding, capture_output=True,
+                                     hide_output=hide_output, spool_output=True)
 
+    def _run(self, *args, stdin=None, hide_output=False, encoding='cp437', spool_output=False):
         for _ in range(5):
-            result, output, error = nimp.sys.process.call(command, stdin=stdin, encoding=encoding, capture_output=True, hide_output=hide_output)
+            result, output, error = self._call(*args, stdin=stdin, hide_output=hide_output, encoding=encoding)
+            with error:
+                error = error.read()
+            if not spool_output:
+                with output:
+                    output = output.read()
 
             if 'Operation took too long ' in error:
+                if spool_output:
+                    output.close()
                 continue
 
             has_fatal_errors = False
@@ -409,24 +518,91 @@ class P4:
 
             if result != 0 or has_fatal_errors:
                 logging.info('p4 command failed: %s', error)
+                if spool_output:
+                    output.close()
                 return None
 
             return output
 
     def _parse_command_output(self, command, *patterns, stdin = None, hide_output = False, encoding='cp437'):
-        output = self._run(*command, stdin = stdin, hide_output = hide_output, encoding=encoding)
+        output = self._run(*command, stdin = stdin, hide_output = hide_output, encoding=encoding, spool_output=True)
 
         if output is not None:
-            match_list = []
-
-            for pattern in patterns:
-                matches = list(re.finditer(pattern, output, re.MULTILINE))
-                result = []
-                for match in matches:
-                    match_string = match.group(1)
-                    match_string = match_string.strip()
-                    result.append(match_string)
-                match_list.append(result)
+            # Output is scanned line by line, only matches are kept in memory
+            patterns = [ re.compile(pattern, re.MULTILINE) for pattern in patterns ]
+            match_list = [ [] for _ in patterns ]
+            with output:
+                for line in output:
+                    for pattern, result in zip(patterns, match_list):
+                        for match in pattern.finditer(line):
+                            match_string = match.group(1)
+                            match_string = match_string.strip()
+                            result.append(match_string)
 
             for elem in zip(*match_list):
                 yield elem
+
+
+class P4ApiClient(P4):
+    ''' P4 Client using a persistent P4API (p4python) connection instead of
+        spawning a p4 process for each command. Command results are rendered
+        as p4 -ztag would print them, so all P4 methods behave the same. '''
+
+    def __init__(self, port = None, user = None, password = None, client = None, connection = None):
+        super().__init__(port, user, password, client)
+        assert connection is not None
+        self._connection = connection
+        self._connection_thread = threading.get_ident()
+
+    def _get_connection(self):
+        # Other threads (e.g. p4 fileset -j workers) use their own connection
+        if threading.get_ident() == self._connection_thread:
+            return self._connection
+        return _get_p4api_connection(self._port, self._user, self._password, self._client)
+
+    def _call(self, *args, stdin=None, hide_output=False, encoding='cp437'):
+        args = list(args)
+        # Arguments read from stdin are passed directly with P4API
+        if args[0:2] == ['-x', '-']:
+            args = args[2:] + [ line for line in (stdin or '').split('\n') if line ]
+            stdin = None
+
+        if not hide_output:
+            logging.info('Running "%s" using P4API', ['p4'] + args)
+
+        output = nimp.sys.process.SpooledOutput()
+        error = nimp.sys.process.SpooledOutput()
+        result = 0
+        try:
+            connection = self._get_connection()
+        except _P4API.P4Exception as ex:
+            error.append('Cannot connect using P4API: %s\n' % ex)
+            return 1, output, error
+
+        if stdin is not None:
+            connection.input = stdin
+        try:
+            for item in connection.run(*args):
+                output.append(_format_tagged_record(item))
+        except _P4API.P4Exception:
+            result = 1
+        finally:
+            # Like p4 processes, commands may have modified files
+            nimp.sys.filesystem.refresh_snapshot()
+        for message in list(connection.errors) + list(connection.warnings):
+            error.append(message.rstrip('\n') + '\n')
+        return result, output, error
+
+
+def _format_tagged_record(item):
+    ''' Renders a P4API result the way p4 -ztag prints it '''
+    if not isinstance(item, dict):
+        return str(item).rstrip('\n') + '\n'
+    lines = []
+    for key, value in item.items():
+        if isinstance(value, list):
+            for index, value_it in enumerate(value):
+                lines.append('... %s%d %s\n' % (key, index, value_it))
+        else:
+            lines.append('... %s %s\n' % (key, value))
+    return ''.join(lines) + '\n'
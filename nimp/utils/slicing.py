@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Job slicing utilities
+
+    History slicing reads costs from a JSON object mapping item paths to a
+    number, e.g. ``{"Content/Maps/Level.umap": 120.5}``; nimp doesn't
+    record them itself, they are meant to be exported from the timings of
+    whatever processes the items (e.g. cook logs). Paths are compared after
+    normalization, relative ones being relative to the working directory. '''
+
+import heapq
+import json
+import logging
+import os
+
+
+SLICE_MODES = [ 'round-robin', 'size', 'history' ]
+
+
+def add_arguments(parser):
+    ''' Adds arguments selecting how items are spread between slices '''
+    parser.add_argument('--slice-mode',
+                        choices = SLICE_MODES,
+                        default = 'round-robin',
+                        help = 'how to spread items between slices: by index, or balancing '
+                               'their size on disk or their cost in --slice-history')
+    parser.add_argument('--slice-history',
+                        metavar = '<file>',
+                        help = 'JSON object mapping item paths to their cost (e.g. seconds '
+                               'taken by a previous run), items missing from it costing as '
+                               'much as an average known one')
+
+
+def partition(items, slice_count, weight):
+    ''' Splits items in slice_count lists of close total weight, giving each
+        item, heaviest first, to the lightest slice so far (greedy LPT) '''
+    slices = [ [] for _ in range(slice_count) ]
+    loads = [ (0, index) for index in range(slice_count) ]
+    weighted_items = sorted(((weight(item), item) for item in items), key = lambda it: (-it[0], it[1]))
+    for item_weight, item in weighted_items:
+        load, index = heapq.heappop(loads)
+        slices[index].append(item)
+        heapq.heappush(loads, (load + item_weight, index))
+    return [ sorted(it) for it in slices ]
+
+
+def get_slice(env, items):
+    ''' Returns the items of the env.slice_job_index slice (starting at 1) out
+        of env.slice_job_count, using env.slice_mode; items are paths for
+        size and history modes '''
+    if env.slice_job_count is None or env.slice_job_count <= 1:
+        return items
+
+    slice_mode = getattr(env, 'slice_mode', 'round-robin')
+    if slice_mode == 'round-robin':
+        # Demanding files tend to be in the same directory, so spreading
+        # consecutive items is a decent heuristic when costs are unknown
+        return [ it for idx, it in enumerate(items) if idx % env.slice_job_count == env.slice_job_index - 1 ]
+
+    if slice_mode == 'size':
+        weight = _get_file_size
+    else:
+        weight = _get_history_weight(load_history(env.slice_history))
+    return partition(items, env.slice_job_count, weight)[env.slice_job_index - 1]
+
+
+def load_history(history_file_path):
+    ''' Loads a JSON file mapping item paths to their cost, see the module
+        documentation for its format '''
+    if history_file_path is None or not os.path.exists(history_file_path):
+        logging.warning('No slicing history found, slices will be balanced by item count')
+        return {}
+    with open(history_file_path) as history_file:
+        return { _normalize_path(path): cost for path, cost in json.load(history_file).items() }
+
+
+def _get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _get_history_weight(history):
+    # Unknown items are assumed to cost as much as an average known one
+    default_weight = sum(history.values()) / len(history) if history else 1
+    return lambda path: history.get(_normalize_path(path), default_weight)
+
+
+def _normalize_path(path):
+    return os.path.normcase(os.path.normpath(path))
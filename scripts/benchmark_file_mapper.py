@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import nimp.sys.filesystem # pylint: disable = wrong-import-position
+import nimp.system # pylint: disable = wrong-import-position
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compares sorted and streaming FileMapper evaluation")
+    parser.add_argument("--dirs", type = int, default = 500, help = "number of directories in the synthetic tree")
+    parser.add_argument("--files", type = int, default = 200, help = "number of files per directory")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        for dir_index in range(arguments.dirs):
+            directory = os.path.join(root, "Content", "Dir%03d" % (dir_index // 50), "Sub%03d" % dir_index)
+            os.makedirs(directory)
+            for file_index in range(arguments.files):
+                extension = "uasset" if file_index % 4 else "umap"
+                open(os.path.join(directory, "File%04d.%s" % (file_index, extension)), "w").close()
+
+        def _create_mapper():
+            mapper = nimp.system.FileMapper(None)
+            content = mapper.src(root).to(".")
+            content.glob("Content/**/*.uasset", "Content/**/*.umap").exclude("*/Sub0?0/*")
+            content.src("Content").glob("**").files().to("Copy")
+            return mapper
+
+        # Old to_list behaviour: nodes sort their results, then everything is
+        # sorted again; and consumers not caring about the order at all
+        evaluations = [ ("to_list sorted", lambda mapper: sorted(set(mapper()))),
+                        ("to_list stream", lambda mapper: sorted(set(mapper.stream()))),
+                        ("iterate sorted", lambda mapper: sum(1 for _ in mapper())),
+                        ("iterate stream", lambda mapper: sum(1 for _ in mapper.stream())) ]
+
+        # Evaluations reuse the directory snapshot filled first, until the
+        # end of the scope, so that only mappers are measured
+        with nimp.sys.filesystem.snapshot_scope():
+            _create_mapper()()
+            for name, evaluate in evaluations:
+                wall = _measure_time(lambda: evaluate(_create_mapper()))
+                peak = _measure_memory(lambda: evaluate(_create_mapper()))
+                print("%-16s %7.3fs, peak memory %7.1f MiB" % (name, wall, peak / 1024 / 1024))
+        nimp.sys.filesystem.reset_snapshot()
+
+
+def _measure_time(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def _measure_memory(function):
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import nimp.sys.process # pylint: disable = wrong-import-position
+
+
+_CHILD_SCRIPT = "import sys\nfor i in range({count}):\n    sys.stdout.write('Line %d of some child process output\\n' % i)\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compares nimp.sys.process.call output pumps")
+    parser.add_argument("--lines", type = int, default = 1000000, help = "lines printed by the child process")
+    parser.add_argument("--calls", type = int, default = 200, help = "number of short calls (p4-like workload)")
+    parser.add_argument("--capture", action = "store_true", help = "use capture_output=True")
+    arguments = parser.parse_args()
+
+    # Child output goes through the logging machinery like in nimp (see
+    # nimp.summary), but not to the terminal
+    devnull = open(os.devnull, "w")
+    child_logger = logging.getLogger("child_processes")
+    child_logger.propagate = False
+    child_logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    child_logger.addHandler(handler)
+
+    pumps = [ ("threads", False) ]
+    if not nimp.sys.platform.is_windows():
+        pumps.append(("selector", True))
+
+    for name, use_selector in pumps:
+        nimp.sys.process._USE_SELECTOR_PUMP = use_selector # pylint: disable = protected-access
+
+        wall, cpu = _measure(lambda: _call(arguments.lines, arguments.capture))
+        print("%-8s %9d lines: %7.3fs wall, %7.3fs cpu, %10.0f lines/s" % (name, arguments.lines, wall, cpu, arguments.lines / wall))
+
+        wall, cpu = _measure(lambda: [ _call(1, arguments.capture) for _ in range(arguments.calls) ])
+        print("%-8s %9d calls: %7.3fs wall, %7.3fs cpu, %7.2fms cpu/call" % (name, arguments.calls, wall, cpu, 1000 * cpu / arguments.calls))
+
+
+def _call(count, capture):
+    command = [ sys.executable, "-c", _CHILD_SCRIPT.format(count = count) ]
+    return nimp.sys.process.call(command, capture_output = capture, hide_output = False)
+
+
+def _measure(function):
+    # Only measure the nimp side: children times are excluded from os.times()
+    start_wall = time.perf_counter()
+    start_times = os.times()
+    function()
+    end_times = os.times()
+    wall = time.perf_counter() - start_wall
+    cpu = (end_times.user - start_times.user) + (end_times.system - start_times.system)
+    return wall, cpu
+
+
+if __name__ == "__main__":
+    main()